@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Database Format - What the analyzer and the database reader share
+The default game phases positions are keyed by, atomic file writes, and
+loading the master database from JSON or NDJSON
+"""
+
+import os
+import json
+
+# Default game phases: the middlegame starts at ply 30 (move 16) and the
+# endgame at ply 80 (move 41); positions are keyed by the last 8, 6 and 4
+# moves in the opening, middlegame and endgame
+PHASE_PLIES = (30, 80)
+PHASE_WINDOWS = (8, 6, 4)
+
+
+def write_atomic(path, write, mode='wb'):
+    """Write a file through a temporary name so readers never see half of it"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def load_database(path):
+    """(opening_repertoire, tactical_book, metadata) of a master database in JSON or NDJSON"""
+    if str(path).endswith('.ndjson'):
+        repertoire = {}
+        tactical_book = {}
+        metadata = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['type'] == 'opening':
+                    repertoire[record['position']] = record['moves']
+                elif record['type'] == 'tactic':
+                    tactical_book.setdefault(record['phase'], {})[record['position']] = record['moves']
+                elif record['type'] == 'metadata':
+                    metadata = {name: value for name, value in record.items() if name != 'type'}
+        return repertoire, tactical_book, metadata
+    with open(path, encoding='utf-8') as f:
+        database = json.load(f)
+    return database['opening_repertoire'], database['tactical_book'], database.get('metadata', {})
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Database Reader - Lazy, sharded lookups into the master database
+Splits master_database.json into small shards by phase and first move of
+the position key, and answers move queries loading only the shards used
+"""
+
+import os
+import sys
+import json
+import argparse
+from collections import OrderedDict
+from pathlib import Path
+
+from database_format import PHASE_PLIES, PHASE_WINDOWS, load_database, write_atomic
+
+# Bump when the shard layout changes, so old shard directories are re-split
+SHARD_FORMAT_VERSION = 2
+
+# Moves in the position key of each phase, and the key of an empty window
+# (the default windows PGNAnalyzer.parse_games counts; a database records
+# the ones it was built with in its metadata)
+PHASES = ('opening', 'middlegame', 'endgame')
+WINDOWS = dict(zip(PHASES, PHASE_WINDOWS))
+EMPTY_KEYS = {'opening': 'start', 'middlegame': 'middlegame', 'endgame': 'endgame'}
+
+# Default cache bounds of DatabaseReader
+CACHED_POSITIONS = 4096
+CACHED_SHARDS = 16
+
+
+def position_key(move_history, phase, windows=WINDOWS):
+    """Database key of the position after move_history in phase
+
+    Keys are made like PGNAnalyzer.count_games makes them: the opening
+    window is as long as the history allows, the other phases' windows
+    are left empty until the history fills them.
+    """
+    history = list(move_history)
+    window = windows[phase]
+    if phase == 'opening':
+        size = min(len(history), window)
+    else:
+        size = window if len(history) >= window else 0
+    return ' '.join(history[len(history) - size:]) if size else EMPTY_KEYS[phase]
+
+
+def game_phase(move_history, phase_plies=PHASE_PLIES):
+    """Phase of the position after move_history, from its ply count"""
+    plies = len(move_history)
+    if plies < phase_plies[0]:
+        return 'opening'
+    return 'middlegame' if plies < phase_plies[1] else 'endgame'
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return {'path': str(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def split_database(database_path, shard_dir):
+    """Split a master database (JSON or NDJSON) into shards under shard_dir
+
+    Opening positions come from the opening repertoire (moves with
+    weights), middlegame and endgame ones from the tactical book (moves
+    only). Each (phase, first move of the key) group becomes one JSON
+    shard, listed in manifest.json with its size. The manifest also keeps
+    the phase boundaries and windows from the database's metadata (the
+    defaults for databases without them). Returns the manifest.
+    """
+    repertoire, tactical_book, metadata = load_database(database_path)
+    phases = {
+        'opening': repertoire,
+        'middlegame': tactical_book.get('middlegame', {}),
+        'endgame': tactical_book.get('endgame', {}),
+    }
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = {
+        'version': SHARD_FORMAT_VERSION,
+        'source': _source_stat(database_path),
+        'phase_plies': metadata.get('phase_plies', list(PHASE_PLIES)),
+        'windows': dict(zip(PHASES, metadata.get('windows', PHASE_WINDOWS))),
+        'shards': {},
+    }
+    for phase, positions in phases.items():
+        groups = {}
+        for key, moves in positions.items():
+            groups.setdefault(key.split(' ', 1)[0], {})[key] = moves
+        shards = manifest['shards'][phase] = {}
+        for number, (first_move, group) in enumerate(sorted(groups.items())):
+            name = f"{phase}-{number:05d}.json"
+            write_atomic(shard_dir / name, lambda f: json.dump(group, f, separators=(',', ':')), 'w')
+            shards[first_move] = {'file': name, 'positions': len(group)}
+    # The manifest goes last, so a split that was cut short is not used
+    write_atomic(shard_dir / 'manifest.json', lambda f: json.dump(manifest, f, indent=1), 'w')
+    written = {entry['file'] for shards in manifest['shards'].values() for entry in shards.values()}
+    for path in shard_dir.glob('*-[0-9][0-9][0-9][0-9][0-9].json'):
+        if path.name not in written:
+            path.unlink()
+    return manifest
+
+
+class DatabaseReader:
+    """Lazy lookups into a database split by split_database
+
+    Opening only reads the manifest, which also gives the phase
+    boundaries and windows positions are keyed with. A shard is loaded
+    the first time a position in it is asked for and kept in an LRU of at
+    most max_shards shards; looked-up positions are kept in their own LRU
+    of max_positions entries, so hot positions stay cached after their
+    shard is evicted.
+    stats() reports cache hits and misses and shard loads and evictions.
+    """
+
+    def __init__(self, shard_dir, max_positions=CACHED_POSITIONS, max_shards=CACHED_SHARDS):
+        self.shard_dir = Path(shard_dir)
+        with open(self.shard_dir / 'manifest.json', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != SHARD_FORMAT_VERSION:
+            raise ValueError(f"{self.shard_dir} has shard format {self.manifest.get('version')}, "
+                             f"expected {SHARD_FORMAT_VERSION}")
+        self.phase_plies = self.manifest['phase_plies']
+        self.windows = self.manifest['windows']
+        self.max_positions = max_positions
+        self.max_shards = max_shards
+        self.hits = 0
+        self.misses = 0
+        self.shard_loads = 0
+        self.shard_evictions = 0
+        self._positions = OrderedDict()
+        self._shards = OrderedDict()
+
+    @classmethod
+    def open(cls, database_path='/app/master_database.json', shard_dir=None, **cache_sizes):
+        """Reader for a database, re-splitting it first if its shards are missing or stale"""
+        shard_dir = Path(shard_dir or f"{os.path.splitext(database_path)[0]}_shards")
+        manifest_path = shard_dir / 'manifest.json'
+        stale = True
+        if manifest_path.exists():
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            stale = (manifest.get('version') != SHARD_FORMAT_VERSION
+                     or manifest.get('source') != _source_stat(database_path))
+        if stale:
+            split_database(database_path, shard_dir)
+        return cls(shard_dir, **cache_sizes)
+
+    def _shard(self, phase, first_move):
+        """Positions of one shard, loading it on first use; None if there is no such shard"""
+        shard_id = (phase, first_move)
+        shard = self._shards.get(shard_id)
+        if shard is not None:
+            self._shards.move_to_end(shard_id)
+            return shard
+        entry = self.manifest['shards'].get(phase, {}).get(first_move)
+        if entry is None:
+            return None
+        with open(self.shard_dir / entry['file'], encoding='utf-8') as f:
+            shard = json.load(f)
+        self.shard_loads += 1
+        self._shards[shard_id] = shard
+        if len(self._shards) > self.max_shards:
+            self._shards.popitem(last=False)
+            self.shard_evictions += 1
+        return shard
+
+    def position(self, move_history, phase=None):
+        """(phase, key) of the position after move_history
+
+        Without a phase, it follows from the number of moves played.
+        """
+        if phase is None:
+            phase = game_phase(move_history, self.phase_plies)
+        return phase, position_key(move_history, phase, self.windows)
+
+    def get_moves(self, move_history, phase=None):
+        """Moves stored for the position after move_history, or None
+
+        Opening positions give [{'move', 'weight'}, ...] from the opening
+        repertoire, middlegame and endgame positions a list of moves from
+        the tactical book, best first. Without a phase, it follows from
+        the number of moves played.
+        """
+        phase, key = self.position(move_history, phase)
+        cache_key = (phase, key)
+        positions = self._positions
+        if cache_key in positions:
+            self.hits += 1
+            positions.move_to_end(cache_key)
+            return positions[cache_key]
+        self.misses += 1
+        shard = self._shard(phase, key.split(' ', 1)[0])
+        moves = shard.get(key) if shard is not None else None
+        positions[cache_key] = moves
+        if len(positions) > self.max_positions:
+            positions.popitem(last=False)
+        return moves
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'lookups': lookups,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'cached_positions': len(self._positions),
+            'loaded_shards': len(self._shards),
+            'shard_loads': self.shard_loads,
+            'shard_evictions': self.shard_evictions,
+            'total_shards': sum(len(shards) for shards in self.manifest['shards'].values()),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split the master database into shards and query them')
+    parser.add_argument('--database', default='/app/master_database.json',
+                        help='master database, JSON or NDJSON (default: %(default)s)')
+    parser.add_argument('--shard-dir', help='where the shards are kept (default: next to the database)')
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+    commands.add_parser('split', help='(re-)split the database into shards')
+    query = commands.add_parser('query', help='print the moves stored after a sequence of moves')
+    query.add_argument('moves', nargs='*', help='SAN moves played so far, e.g. e4 e5 Nf3')
+    query.add_argument('--phase', choices=PHASES,
+                       help='game phase to look the position up in (default: from the number of moves)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'split':
+        shard_dir = args.shard_dir or f"{os.path.splitext(args.database)[0]}_shards"
+        manifest = split_database(args.database, shard_dir)
+        for phase, shards in manifest['shards'].items():
+            positions = sum(entry['positions'] for entry in shards.values())
+            print(f"  {phase}: {positions} positions in {len(shards)} shards")
+        print(f"Saved shards to {shard_dir}")
+        return 0
+
+    reader = DatabaseReader.open(args.database, args.shard_dir)
+    phase, key = reader.position(args.moves, args.phase)
+    moves = reader.get_moves(args.moves, phase)
+    if moves is None:
+        print(f"No {phase} entry for {key!r}")
+        return 1
+    print(json.dumps(moves, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,141 +4,3606 @@ PGN Analyzer - Extract masterclass patterns from legendary games
 Processes Carlsen, Fischer, Morphy, and AlphaZero PGN files
 """
 
+import io
+import os
 import re
+import sys
+import bz2
+import gzip
+import lzma
+import math
+import mmap
+import struct
+import sqlite3
+import hashlib
 import json
-from collections import defaultdict, Counter
+import pickle
+import time
+import heapq
+import random
+import itertools
+import argparse
+import queue
+import resource
+import threading
+import subprocess
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from database_format import PHASE_PLIES, PHASE_WINDOWS, load_database, write_atomic
+
+# Read buffer for the streaming game reader; memory use stays at roughly one
+# buffer plus the game currently being parsed, whatever the file size.
+READ_BUFFER_SIZE = 1 << 16
+
+# Compressed inputs are decompressed as they are read. .zst files use the
+# zstandard package when it is installed and a zstd subprocess otherwise.
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.xz', '.zst')
+
+# Background reading (see Prefetcher): games are handed to the parser in
+# batches of PREFETCH_BATCH_GAMES, and each file's queue holds at most
+# PREFETCH_DEPTH batches
+PREFETCH_READERS = 1
+PREFETCH_BATCH_GAMES = 256
+PREFETCH_DEPTH = 16
+
+# Large files are cut into chunks of about this many bytes (on game
+# boundaries) when parsing with several worker processes.
+PARALLEL_CHUNK_SIZE = 8 << 20
+
+# Weights are accumulated as integer units of 1/WEIGHT_SCALE so that partial
+# counts built in separate processes add up exactly, in any merge order.
+WEIGHT_SCALE = 1000
+# Parsing with UNIT_WEIGHT counts every occurrence as exactly one unit
+UNIT_WEIGHT = 1 / WEIGHT_SCALE
+
+# Shard files of raw counts (see write_shard): a header, the sorted move
+# names as length-prefixed UTF-8, then one record per position in
+# (phase, key) order holding its window and (move, units) pairs, closed by
+# a record with phase SHARD_END.
+SHARD_MAGIC = b'PGNSHRD\0'
+SHARD_VERSION = 2
+SHARD_HEADER = struct.Struct('<8sHHIQII3B')   # magic, version, reserved, moves, games, phase plies, windows
+SHARD_POSITION = struct.Struct('<BQBH')    # phase, key, window length, move count
+SHARD_MOVE = struct.Struct('<IQ')          # move index, units
+SHARD_END = 0xFF
+
+# NumPy aggregation (see PGNAnalyzer.enable_numpy): the plies of this many
+# games are keyed, sorted and summed as one batch
+NUMPY_BATCH_GAMES = 2000
+
+# Ranked positions (see CountTable.ranked_positions) turn into Python
+# lists this many at a time
+RANK_BLOCK_POSITIONS = 4096
+
+# Aggregated counts saved with PGNAnalyzer.save_npz
+NPZ_VERSION = 2
+
+# SQLite backend (see SQLiteStore): pending (position, move) increments are
+# flushed in one transaction once this many have accumulated
+SQLITE_BATCH_SIZE = 500000
+
+# Duplicate games (see GameDeduplicator) are games with the same main line
+# and the same values of these tags
+DEDUPE_TAGS = ('White', 'Black', 'Date', 'Round', 'Result')
+# Default sizing of the Bloom filter for --dedupe bloom
+BLOOM_CAPACITY = 10000000
+BLOOM_ERROR_RATE = 1e-4
+
+# Cached per-game tag indexes (see TagIndex and load_tag_index)
+TAG_INDEX_VERSION = 1
+
+# Snapshots of serial builds for --resume (see Checkpoint)
+CHECKPOINT_VERSION = 2
+CHECKPOINT_INTERVAL = 300.0
+
+# Saved state for incremental rebuilds (see build_incremental)
+STATE_VERSION = 1
+
+# Binary opening book (see write_binary_book): a fixed header, records of
+# (position key, move id, quantized weight) sorted by key, then the move
+# strings as length-prefixed UTF-8.
+BOOK_MAGIC = b'PGNBOOK\0'
+BOOK_VERSION = 1
+BOOK_HEADER = struct.Struct('<8sHHIQQ')   # magic, version, window, moves, records, moves offset
+BOOK_RECORD = struct.Struct('<QHH')       # key, move id, weight * BOOK_WEIGHT_SCALE
+BOOK_WEIGHT_SCALE = 65535
+OPENING_WINDOW = PHASE_WINDOWS[0]
+
+# Compiled corpus (see compile_corpus): a fixed header, the offset of every
+# game's first ply plus the total as uint64, the plies as uint16 move ids,
+# the move strings as length-prefixed UTF-8, then the number of games with
+# a FEN tag as uint64 and (game as uint64, length-prefixed FEN) for each.
+# Everything is little-endian.
+CORPUS_MAGIC = b'PGNCORP\0'
+CORPUS_VERSION = 2
+CORPUS_HEADER = struct.Struct('<8sHHIQQQq32s')  # magic, version, reserved, moves, games, plies,
+                                                # source size, mtime_ns and SHA-256
+
+
+# Count table entries pack (position_id, move_id) into one integer key
+MOVE_ID_BITS = 24
+MOVE_ID_MASK = (1 << MOVE_ID_BITS) - 1
+# Position hashes are already well mixed, so index slots use their low bits
+# directly; an entry's slot is offset from its position's by the move id.
+_MOVE_SLOT_STEP = 0x9E3779B1
+
+# Position keys are 64-bit polynomial hashes of the last few moves. Each
+# move has a fixed code derived from its SAN text, so a key depends only on
+# the moves themselves and is the same in every process and every run.
+HASH_MASK = (1 << 64) - 1
+HASH_BASE = 0x100000001B3
+HASH_POWERS = [pow(HASH_BASE, k, 1 << 64) for k in range(16)]
+
+# Approximate ingestion (see CountMinSketch): memory for the sketch and the
+# weight a (position, move) pair must reach before it gets an exact entry,
+# which is about two occurrences at the player weights used by main().
+SKETCH_BUDGET = 64 << 20
+SKETCH_DEPTH = 4
+SKETCH_MIN_WEIGHT = 4.0
+
+
+def move_code(move):
+    """Stable 64-bit code of a SAN move used by the position hashes"""
+    return int.from_bytes(hashlib.blake2b(move.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def position_key(moves):
+    """Hash a window of SAN moves the way the analyzer keys positions
+    
+    An empty window hashes to 0, which is also the key of the 'start',
+    'middlegame' and 'endgame' catch-all positions.
+    """
+    key = 0
+    for move in moves:
+        key = (key * HASH_BASE + move_code(move)) & HASH_MASK
+    return key
+
+
+def weight_units(weight):
+    """Convert a player weight to integer count units"""
+    return int(round(weight * WEIGHT_SCALE))
+
+
+# Comments are cut out of the movetext first, then variations from the
+# innermost out, all in C. The moves and results are then picked out of
+# what is left; move numbers, NAGs and !/? glyphs match no token and are
+# skipped, and a result or castling glued to a number (10-0, $0-1) is part
+# of that number. Castling written with zeros is spelled O-O afterwards.
+_COMMENT = re.compile(r'\{[^}]*\}?|;[^\n]*')
+_VARIATION = re.compile(r'\([^()]*\)')
+_MOVETEXT_TOKEN = re.compile(r'[A-Za-z][^\s{}();$.!?]*|\*|(?<![\d$])(?:0-0(?:-0)?[+#]?|1-0|0-1|1/2-1/2)')
+RESULTS = frozenset(['1-0', '0-1', '1/2-1/2', '*'])
+
+
+def tokenize_movetext(movetext):
+    """SAN moves of the main line, or None if the game has no result
+    
+    Everything inside (nested) variations is skipped, and the main line
+    ends at the first result outside comments and variations. Castling
+    comes back as O-O or O-O-O, however it was written.
+    """
+    if '{' in movetext or ';' in movetext:
+        movetext = _COMMENT.sub(' ', movetext)
+    if '(' in movetext or ')' in movetext:
+        removed = 1
+        while removed:
+            movetext, removed = _VARIATION.subn(' ', movetext)
+        # A variation that is never closed runs to the end of the game
+        unclosed = movetext.find('(')
+        if unclosed >= 0:
+            movetext = movetext[:unclosed]
+        movetext = movetext.replace(')', ' ')
+    
+    tokens = _MOVETEXT_TOKEN.findall(movetext)
+    if '0-0' in movetext:
+        tokens = [token.replace('0', 'O') if token.startswith('0-0') else token for token in tokens]
+    results = RESULTS.intersection(tokens)
+    return tokens[:min(map(tokens.index, results))] if results else None
+
+
+def _decode_line(raw):
+    return raw.decode('utf-8', errors='ignore').rstrip('\r\n')
+
+
+def is_compressed(filename):
+    return str(filename).lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def find_pgn(path):
+    """path itself if it exists, else the first compressed copy of it, else None"""
+    for candidate in [str(path)] + [f"{path}{suffix}" for suffix in COMPRESSED_SUFFIXES]:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def pgn_size(filename):
+    """Uncompressed size of a PGN file in bytes, or None if it is not cheap to know"""
+    if not is_compressed(filename):
+        return os.path.getsize(filename)
+    if filename.lower().endswith('.gz'):
+        # The gzip trailer ends with the input size modulo 2**32
+        with open(filename, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return int.from_bytes(f.read(4), 'little')
+    return None
+
+
+@contextmanager
+def open_pgn(filename, buffer_size=READ_BUFFER_SIZE):
+    """Open a PGN file for binary reading, decompressing it on the fly"""
+    name = str(filename).lower()
+    if name.endswith('.gz'):
+        f = gzip.open(filename, 'rb')
+    elif name.endswith('.bz2'):
+        f = bz2.open(filename, 'rb')
+    elif name.endswith('.xz'):
+        f = lzma.open(filename, 'rb')
+    elif name.endswith('.zst') and zstandard is not None:
+        f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True),
+                              buffer_size)
+    elif name.endswith('.zst'):
+        process = subprocess.Popen(['zstd', '-dcq', '--', str(filename)], stdout=subprocess.PIPE,
+                                   bufsize=buffer_size)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        # A negative status is the SIGPIPE from closing the pipe early
+        if returncode > 0:
+            raise OSError(f"zstd could not decompress {filename} (exit status {returncode})")
+        return
+    else:
+        f = open(filename, 'rb', buffering=buffer_size)
+    with f:
+        yield f
+
+
+def iter_pgn_games(filename, start=0, end=None, buffer_size=READ_BUFFER_SIZE):
+    """Yield the text of each game (tag pairs plus movetext) in a PGN file.
+
+    The file is read line by line, so only the game being assembled is held
+    in memory, and compressed files are decompressed as a stream (see
+    open_pgn). A blank line followed by an [Event tag starts a new game,
+    which is the same split the analyzer has always used. start and end
+    are byte offsets of game boundaries (see find_game_boundaries) and
+    restrict reading to the games in between.
+    """
+    for _, _, game_text in iter_pgn_game_spans(filename, start, end, buffer_size):
+        yield game_text
+
+
+def iter_pgn_game_spans(filename, start=0, end=None, buffer_size=READ_BUFFER_SIZE):
+    """Like iter_pgn_games, but yield (offset, size, text) for each game
+    
+    offset and size are the bytes of the game's own lines in the
+    (uncompressed) file, without the blank line before the next game, so
+    read_pgn_games can fetch the same text again later.
+    """
+    lines = []
+    offset = start
+    game_start = start
+    line_start = start
+    with open_pgn(filename, buffer_size) as f:
+        if start:
+            _skip_to(f, filename, start)
+        for raw in f:
+            line = _decode_line(raw)
+            if line.startswith('[Event') and lines and lines[-1] == '':
+                yield game_start, line_start - game_start, '\n'.join(lines[:-1])
+                lines = []
+                game_start = offset
+                if end is not None and offset >= end:
+                    return
+            lines.append(line)
+            line_start = offset
+            offset += len(raw)
+    if lines:
+        yield game_start, offset - game_start, '\n'.join(lines)
+
+
+def read_pgn_games(filename, spans, buffer_size=READ_BUFFER_SIZE):
+    """Yield the text of the games at (offset, size) spans of a PGN file
+    
+    Spans must be in file order. Plain files seek straight to each game;
+    compressed streams are read through and skipped up to it.
+    """
+    with open_pgn(filename, buffer_size) as f:
+        position = 0
+        for offset, size in spans:
+            _skip_to(f, filename, offset, position)
+            data = f.read(size)
+            position = offset + size
+            # Split lines the way file iteration does
+            raw_lines = data.split(b'\n')
+            if data.endswith(b'\n'):
+                raw_lines.pop()
+            yield '\n'.join(_decode_line(raw) for raw in raw_lines)
+
+
+def _skip_to(f, filename, offset, position=0):
+    """Move a stream from open_pgn at position to offset
+    
+    Plain files seek; compressed streams are read through and skipped.
+    """
+    if not is_compressed(filename):
+        f.seek(offset)
+        return
+    while position < offset:
+        skipped = len(f.read(min(offset - position, 1 << 20)))
+        if not skipped:
+            raise ValueError(f"{filename} ends before offset {offset}")
+        position += skipped
+
+
+def find_game_boundaries(filename, chunk_size=PARALLEL_CHUNK_SIZE):
+    """Split a PGN file into (start, end) byte ranges of whole games
+    
+    Compressed files cannot be entered mid-stream, so they are one range
+    of (0, None).
+    """
+    if is_compressed(filename):
+        return [(0, None)]
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        target = chunk_size
+        while target < size:
+            f.seek(target)
+            offset = target + len(f.readline())  # skip the partial line
+            boundary = size
+            prev_blank = False
+            for raw in f:
+                line = _decode_line(raw)
+                if prev_blank and line.startswith('[Event'):
+                    boundary = offset
+                    break
+                prev_blank = line == ''
+                offset += len(raw)
+            if boundary >= size:
+                break
+            bounds.append(boundary)
+            target = boundary + chunk_size
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+class Prefetcher:
+    """Reads PGN files in background threads while the parser works
+    
+    Files are read in order by a pool of reader threads, each into its
+    own bounded queue of game batches, so while the parser consumes one
+    file the next ones are already being read and decompressed. Reading
+    stops early when a queue is full. Errors in a reader are raised in
+    the parser when it reaches that file.
+    
+    starts maps files to the byte offset to start reading at. statistics()
+    reports the queue depth the parser found and the time each side spent
+    blocked on the other.
+    """
+    
+    _DONE = object()
+    
+    def __init__(self, filenames, readers=PREFETCH_READERS, depth=PREFETCH_DEPTH,
+                 batch_games=PREFETCH_BATCH_GAMES, starts=None):
+        self.filenames = [str(filename) for filename in filenames]
+        starts = {str(filename): start for filename, start in (starts or {}).items()}
+        self.readers = readers
+        self.depth = depth
+        self.batch_games = batch_games
+        self.batches = 0
+        self.max_depth = 0
+        self.reader_wait = 0.0
+        self.parser_wait = 0.0
+        self.current = None
+        self._depth_total = 0
+        self._depth_samples = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._queues = [queue.Queue(depth) for _ in self.filenames]
+        self._executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='pgn-reader')
+        for filename, batches in zip(self.filenames, self._queues):
+            self._executor.submit(self._read, filename, starts.get(filename, 0), batches)
+    
+    def _read(self, filename, start, batches):
+        try:
+            batch = []
+            for span in iter_pgn_game_spans(filename, start):
+                batch.append(span)
+                if len(batch) >= self.batch_games:
+                    if not self._put(batches, batch):
+                        return
+                    batch = []
+            if batch and not self._put(batches, batch):
+                return
+        except Exception as exc:
+            self._put(batches, exc)
+        self._put(batches, self._DONE)
+    
+    def _put(self, batches, item):
+        """Queue item, waiting while the queue is full; False once closed"""
+        if self._closed.is_set():
+            return False
+        try:
+            batches.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        start = time.perf_counter()
+        try:
+            while not self._closed.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            with self._lock:
+                self.reader_wait += time.perf_counter() - start
+    
+    def games(self, filename):
+        """Yield the game texts of one of the files, in file order"""
+        for _, _, game_text in self.spans(filename):
+            yield game_text
+    
+    def spans(self, filename):
+        """Yield (offset, size, text) for the games of one of the files, in file order"""
+        batches = self._queues[self.filenames.index(str(filename))]
+        self.current = batches
+        while True:
+            depth = batches.qsize()
+            self._depth_total += depth
+            self._depth_samples += 1
+            self.max_depth = max(self.max_depth, depth)
+            try:
+                item = batches.get_nowait()
+            except queue.Empty:
+                start = time.perf_counter()
+                item = batches.get()
+                self.parser_wait += time.perf_counter() - start
+            if item is self._DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            self.batches += 1
+            yield from item
+    
+    @property
+    def queue_depth(self):
+        """Batches waiting in the queue of the file being parsed"""
+        return self.current.qsize() if self.current is not None else 0
+    
+    def statistics(self):
+        return {
+            'readers': self.readers,
+            'queue_capacity': self.depth,
+            'batch_games': self.batch_games,
+            'batches': self.batches,
+            'mean_queue_depth': self._depth_total / self._depth_samples if self._depth_samples else 0.0,
+            'max_queue_depth': self.max_depth,
+            'reader_wait_seconds': self.reader_wait,
+            'parser_wait_seconds': self.parser_wait,
+        }
+    
+    def close(self):
+        """Stop the readers and wait for them to exit"""
+        self._closed.set()
+        for batches in self._queues:
+            while True:
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    break
+        self._executor.shutdown(wait=True, cancel_futures=True)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+_TAG_PAIR = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$', re.M)
+_RESULT_CODES = {'1-0': 1, '1/2-1/2': 0, '0-1': -1}
+
+
+def eco_code(eco):
+    """ECO code as a number (A00 -> 0, E99 -> 499), or -1 if it is not one"""
+    if len(eco) == 3 and eco[0] in 'ABCDE' and eco[1:].isdigit():
+        return 'ABCDE'.index(eco[0]) * 100 + int(eco[1:])
+    return -1
+
+
+def _tag_number(value):
+    return int(value) if value.isdigit() and int(value) < 1 << 16 else 0
+
+
+class TagIndex:
+    """Columnar index of the tag pairs of every game in a PGN file
+    
+    Each column is a typed array with one value per game: the byte offset
+    and size of the game (see iter_pgn_game_spans), the white and black
+    players as ids into players, their Elo ratings, the year, the ECO code
+    (see eco_code) and the result (1, 0 or -1 for a white win, draw or
+    black win). Unknown numbers are 0, -1 for ECO and -2 for the result.
+    """
+    
+    COLUMNS = {
+        'offset': 'Q', 'size': 'I', 'white': 'I', 'black': 'I', 'white_elo': 'H',
+        'black_elo': 'H', 'year': 'H', 'eco': 'h', 'result': 'b',
+    }
+    
+    def __init__(self):
+        self.columns = {name: array(code) for name, code in self.COLUMNS.items()}
+        self.players = []
+        self._player_ids = {}
+    
+    def __len__(self):
+        return len(self.columns['offset'])
+    
+    @classmethod
+    def build(cls, filename):
+        """Index every game of a PGN file in one pass, without parsing movetext"""
+        index = cls()
+        for offset, size, game_text in iter_pgn_game_spans(filename):
+            index.add(offset, size, dict(_TAG_PAIR.findall(game_text.split('\n\n', 1)[0])))
+        return index
+    
+    def add(self, offset, size, tags):
+        columns = self.columns
+        columns['offset'].append(offset)
+        columns['size'].append(size)
+        columns['white'].append(self._player(tags.get('White', '?')))
+        columns['black'].append(self._player(tags.get('Black', '?')))
+        columns['white_elo'].append(_tag_number(tags.get('WhiteElo', '')))
+        columns['black_elo'].append(_tag_number(tags.get('BlackElo', '')))
+        columns['year'].append(_tag_number(tags.get('Date', '')[:4]))
+        columns['eco'].append(eco_code(tags.get('ECO', '')))
+        columns['result'].append(_RESULT_CODES.get(tags.get('Result'), -2))
+    
+    def _player(self, name):
+        player_id = self._player_ids.get(name)
+        if player_id is None:
+            player_id = self._player_ids[name] = len(self.players)
+            self.players.append(name)
+        return player_id
+    
+    def select(self, player=None, years=None, min_elo=None, eco=None):
+        """(offset, size) spans of the games that pass every given filter
+        
+        player matches either player's name, case-insensitively and as a
+        substring. years and eco are inclusive (first, last) ranges, and
+        min_elo must be reached by both players.
+        """
+        columns = self.columns
+        keep = range(len(self))
+        if player is not None:
+            needle = player.lower()
+            ids = {i for i, name in enumerate(self.players) if needle in name.lower()}
+            white, black = columns['white'], columns['black']
+            keep = [i for i in keep if white[i] in ids or black[i] in ids]
+        if years is not None:
+            first, last = years
+            year = columns['year']
+            keep = [i for i in keep if first <= year[i] <= last]
+        if min_elo is not None:
+            white_elo, black_elo = columns['white_elo'], columns['black_elo']
+            keep = [i for i in keep if white_elo[i] >= min_elo and black_elo[i] >= min_elo]
+        if eco is not None:
+            first, last = eco
+            codes = columns['eco']
+            keep = [i for i in keep if first <= codes[i] <= last]
+        offset, size = columns['offset'], columns['size']
+        return [(offset[i], size[i]) for i in keep]
+
+
+def load_tag_index(filename, cache_dir):
+    """The TagIndex of a PGN file, rebuilt only when the file has changed
+    
+    The columns are pickled in cache_dir under a hash of the file's path
+    and reused while its size and modification time are unchanged.
+    """
+    stat = os.stat(filename)
+    name = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    path = Path(cache_dir) / f"{name}.tags.pickle"
+    if path.exists():
+        saved = _load_pickle(path)
+        if (saved.get('version') == TAG_INDEX_VERSION and saved['size'] == stat.st_size
+                and saved['mtime_ns'] == stat.st_mtime_ns):
+            index = TagIndex()
+            index.columns = saved['columns']
+            index.players = saved['players']
+            return index
+    index = TagIndex.build(filename)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    saved = {'version': TAG_INDEX_VERSION, 'path': str(filename), 'size': stat.st_size,
+             'mtime_ns': stat.st_mtime_ns, 'columns': index.columns, 'players': index.players}
+    write_atomic(path, lambda f: pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL))
+    return index
+
+
+def game_fingerprint(header, moves):
+    """128-bit digest of a game's DEDUPE_TAGS and main line
+    
+    The main line comes from tokenize_movetext, so move numbers, comments,
+    NAGs, variations and line wrapping do not change the fingerprint.
+    """
+    tags = dict(_TAG_PAIR.findall(header))
+    text = '\x1f'.join(tags.get(name, '?').strip() for name in DEDUPE_TAGS) + '\x1e' + ' '.join(moves)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+class BloomFilter:
+    """Bloom filter over 128-bit fingerprints
+    
+    Sized for capacity fingerprints at error_rate false positives. The
+    bit positions come from the fingerprint's two halves by double
+    hashing, so no further hashing is needed.
+    """
+    
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.bits = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.bits + 7) // 8)
+    
+    @property
+    def nbytes(self):
+        return len(self._bits)
+    
+    @property
+    def false_positive_rate(self):
+        """Chance that a new fingerprint is taken for one already added"""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+    
+    def add(self, fingerprint):
+        """Add a fingerprint; return True if it was (probably) added before"""
+        first = int.from_bytes(fingerprint[:8], 'little')
+        step = int.from_bytes(fingerprint[8:16], 'little') | 1
+        bits = self._bits
+        present = True
+        for i in range(self.hashes):
+            index = (first + i * step) % self.bits
+            mask = 1 << (index & 7)
+            if not bits[index >> 3] & mask:
+                bits[index >> 3] |= mask
+                present = False
+        if not present:
+            self.count += 1
+        return present
+
+
+class GameDeduplicator:
+    """Recognizes games that were already counted, across input files
+    
+    In 'exact' mode every fingerprint (see game_fingerprint) is kept in a
+    set. In 'bloom' mode a fixed-size BloomFilter is used instead, which
+    wrongly drops about its false positive rate of unique games. dropped
+    counts the repeats found per source.
+    """
+    
+    def __init__(self, mode='exact', capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.mode = mode
+        self.bloom = BloomFilter(capacity, error_rate) if mode == 'bloom' else None
+        self.dropped = {}
+        self.source = None
+        self._seen = set()
+    
+    def begin(self, source):
+        """Attribute the repeats found from now on to source"""
+        self.source = str(source)
+        self.dropped.setdefault(self.source, 0)
+    
+    def is_duplicate(self, header, moves):
+        fingerprint = game_fingerprint(header, moves)
+        if self.bloom is not None:
+            duplicate = self.bloom.add(fingerprint)
+        else:
+            duplicate = fingerprint in self._seen
+            self._seen.add(fingerprint)
+        if duplicate:
+            self.dropped[self.source] = self.dropped.get(self.source, 0) + 1
+        return duplicate
+    
+    def statistics(self):
+        stats = {
+            'mode': self.mode,
+            'games_dropped': sum(self.dropped.values()),
+            'dropped_by_file': dict(self.dropped),
+        }
+        if self.bloom is not None:
+            stats['bloom_bytes'] = self.bloom.nbytes
+            stats['bloom_hashes'] = self.bloom.hashes
+            stats['false_positive_rate'] = self.bloom.false_positive_rate
+        return stats
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None if unknown"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes
+    
+    Read from VmHWM where /proc has it: ru_maxrss carries over from the
+    parent through fork and exec, so a spawned process would report at
+    least its parent's peak.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class RunStats:
+    """Stage timers and progress reporting for one run
+    
+    stage() adds the wall time of a block to a named timer. tick() is
+    called for every game read and prints games/s, an ETA (from bytes read
+    out of total_bytes), the prefetch queue depth and the current RSS
+    every interval seconds. With
+    fine=True, parse_games also splits its own time into read, tokenize
+    and count via lap().
+    """
+    
+    def __init__(self, total_bytes=0, interval=10.0, fine=False):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.fine = fine
+        self.timers = Counter()
+        self.games = 0
+        self.bytes = 0
+        # Prefetcher whose queue statistics are reported, if any
+        self.prefetch = None
+        self.started = time.perf_counter()
+        self._next_report = self.started + interval
+        self._mark = self.started
+    
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start
+    
+    def lap(self, name):
+        """Charge the time since the previous lap to name"""
+        now = time.perf_counter()
+        self.timers[name] += now - self._mark
+        self._mark = now
+    
+    def add_timers(self, timers):
+        self.timers.update(timers)
+    
+    def tick(self, games=1, size=0):
+        self.games += games
+        self.bytes += size
+        if self.interval:
+            now = time.perf_counter()
+            if now >= self._next_report:
+                self._next_report = now + self.interval
+                self.print_progress(now)
+    
+    def print_progress(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.started
+        rate = self.games / elapsed if elapsed else 0.0
+        line = f"  ... {self.games} games, {rate:.0f} games/s"
+        if self.total_bytes and self.bytes:
+            remaining = max(0.0, elapsed * (self.total_bytes - self.bytes) / self.bytes)
+            line += f", ETA {int(remaining) // 60}:{int(remaining) % 60:02d}"
+        if self.prefetch is not None:
+            line += f", queue {self.prefetch.queue_depth}/{self.prefetch.depth}"
+        rss = current_rss()
+        if rss is not None:
+            line += f", RSS {rss >> 20} MiB"
+        print(line, flush=True)
+    
+    def report(self):
+        """Machine-readable summary of the run so far"""
+        elapsed = time.perf_counter() - self.started
+        report = {
+            'wall_seconds': elapsed,
+            'games_read': self.games,
+            'bytes_read': self.bytes,
+            'games_per_second': self.games / elapsed if elapsed else 0.0,
+            'peak_rss_bytes': peak_rss(),
+            'stages': dict(self.timers),
+        }
+        if self.prefetch is not None:
+            report['prefetch'] = self.prefetch.statistics()
+        return report
+
+
+class MoveTable:
+    """Interns SAN move strings to small integer ids"""
+    
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.codes = []
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def intern(self, move):
+        move_id = self.ids.get(move)
+        if move_id is None:
+            move_id = self.ids[move] = len(self.names)
+            self.names.append(move)
+            self.codes.append(move_code(move))
+        return move_id
+
+
+class CountMinSketch:
+    """Count-min sketch of weighted counts over 64-bit keys
+    
+    Each of depth rows maps a key to one of width counters with its own
+    multiply-shift hash. Updates are conservative (only counters below the
+    new estimate are raised), so an estimate is never below the true count
+    and, with probability at least 1 - delta, exceeds it by at most
+    epsilon * total, where epsilon = e / width and delta = e ** -depth.
+    """
+    
+    def __init__(self, width, depth=SKETCH_DEPTH):
+        if width & (width - 1):
+            raise ValueError(f"sketch width must be a power of two, got {width}")
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._shift = 65 - width.bit_length()
+        self._multipliers = [move_code(f'sketch row {row}') | 1 for row in range(depth)]
+        self._counts = array('q', bytes(8 * width * depth))
+    
+    @classmethod
+    def for_budget(cls, budget, depth=SKETCH_DEPTH):
+        """Widest sketch whose counters fit in budget bytes"""
+        width = 1 << max(0, (budget // (8 * depth)).bit_length() - 1)
+        return cls(width, depth)
+    
+    @property
+    def nbytes(self):
+        return self._counts.itemsize * len(self._counts)
+    
+    @property
+    def epsilon(self):
+        return math.e / self.width
+    
+    @property
+    def delta(self):
+        return math.exp(-self.depth)
+    
+    def _indexes(self, key):
+        shift = self._shift
+        width = self.width
+        return [row * width + (((key * multiplier) & HASH_MASK) >> shift)
+                for row, multiplier in enumerate(self._multipliers)]
+    
+    def add(self, key, units):
+        """Add units to a key and return its new estimate"""
+        counts = self._counts
+        indexes = self._indexes(key)
+        estimate = min([counts[i] for i in indexes]) + units
+        for i in indexes:
+            if counts[i] < estimate:
+                counts[i] = estimate
+        self.total += units
+        return estimate
+    
+    def estimate(self, key):
+        counts = self._counts
+        return min([counts[i] for i in self._indexes(key)])
+
+
+class CountTable:
+    """Compact (position, move) -> weight store for one game phase
+    
+    Positions are keyed by 64-bit hashes of their move window and moves
+    by interned ids. Everything lives in typed arrays with packed
+    open-addressing indexes: one over (position hash, move_id) entries
+    holding the accumulated weight units, and one over position hashes
+    that is only consulted when a new entry appears. Position ids are
+    assigned in first-seen order, and items() yields positions and their
+    moves in the order they were first seen.
+    
+    The readable key of a position (its moves joined by spaces) is only
+    needed for output, so the table just keeps the window's move ids in
+    a side array and rebuilds the string on demand. An empty window reads
+    as empty_label.
+    
+    With a sketch attached (see PGNAnalyzer.enable_sketch), a new
+    (position, move) pair is only stored once its sketched weight reaches
+    min_units, and starts from that estimate.
+    """
+    
+    sketch = None
+    sketch_salt = 0
+    min_units = 0
+    
+    # Everything arrays() exports besides the two index masks
+    _ARRAYS = ('_hashes', '_window_start', '_window_moves', '_position_slots',
+               '_entry_hashes', '_keys', '_units', '_slots')
+    
+    def __init__(self, moves=None, empty_label='start'):
+        self.moves = moves if moves is not None else MoveTable()
+        self.empty_label = empty_label
+        # Positions
+        self._hashes = array('Q')
+        self._window_start = array('q', [0])
+        self._window_moves = array('i')
+        self._position_slots = array('i', [-1]) * 1024
+        self._position_mask = 1023
+        # (position, move) entries
+        self._entry_hashes = array('Q')
+        self._keys = array('q')
+        self._units = array('q')
+        self._slots = array('i', [-1]) * 1024
+        self._mask = 1023
+    
+    def __len__(self):
+        return len(self._hashes)
+    
+    @property
+    def entries(self):
+        return len(self._keys)
+    
+    @property
+    def total_units(self):
+        """Sum of all counted weight units"""
+        return sum(self._units)
+    
+    def add(self, key, move_id, units, history=(), end=0, size=0):
+        """Add weight units to a move played from a position
+        
+        key is the position hash. The window itself, history[end - size:end],
+        is only copied the first time the position is seen.
+        """
+        entry_hashes = self._entry_hashes
+        keys = self._keys
+        slots = self._slots
+        mask = self._mask
+        slot = (key + move_id * _MOVE_SLOT_STEP) & mask
+        entry = slots[slot]
+        while entry >= 0:
+            if entry_hashes[entry] == key and keys[entry] & MOVE_ID_MASK == move_id:
+                self._units[entry] += units
+                return
+            slot = (slot + 1) & mask
+            entry = slots[slot]
+        
+        # First time this move is played from this position
+        sketch = self.sketch
+        if sketch is not None:
+            # Salted by phase so the tables can share one sketch
+            pair = ((key * HASH_BASE + self.moves.codes[move_id]) & HASH_MASK) ^ self.sketch_salt
+            estimate = sketch.add(pair, units)
+            if estimate < self.min_units:
+                return
+            units = estimate
+        entry = len(keys)
+        slots[slot] = entry
+        entry_hashes.append(key)
+        self._units.append(units)
+        
+        hashes = self._hashes
+        position_slots = self._position_slots
+        position_mask = self._position_mask
+        slot = key & position_mask
+        pos_id = position_slots[slot]
+        while pos_id >= 0 and hashes[pos_id] != key:
+            slot = (slot + 1) & position_mask
+            pos_id = position_slots[slot]
+        if pos_id < 0:
+            pos_id = len(hashes)
+            position_slots[slot] = pos_id
+            hashes.append(key)
+            self._window_moves.extend(history[end - size:end])
+            self._window_start.append(len(self._window_moves))
+            if 3 * pos_id > 2 * position_mask:
+                self._position_slots, self._position_mask = _grow_index(hashes, position_mask)
+        keys.append(pos_id << MOVE_ID_BITS | move_id)
+        
+        # Keep the indexes at most two thirds full
+        if 3 * entry > 2 * mask:
+            self._slots, self._mask = _grow_index(
+                [h + (k & MOVE_ID_MASK) * _MOVE_SLOT_STEP for h, k in zip(entry_hashes, keys)], mask)
+    
+    def add_batch(self, keys, move_ids, units, history, ends, sizes):
+        """add() for NumPy arrays of distinct (position, move) rows, in order
+        
+        The table ends up exactly as if add() had been called row by row,
+        but rows are looked up and new ones inserted with NumPy, probing
+        the indexes for all rows at once. Row i adds units[i] to move
+        move_ids[i] from position keys[i], whose window is
+        history[ends[i] - sizes[i]:ends[i]]. Not for tables with a sketch.
+        """
+        keys = keys.astype(np.uint64)
+        move_ids = move_ids.astype(np.int64)
+        # Same low bits as the Python ints add() uses, so the same slots
+        slot_keys = keys + move_ids.astype(np.uint64) * np.uint64(_MOVE_SLOT_STEP)
+        entry_hashes = np.frombuffer(self._entry_hashes, dtype=np.uint64)
+        table_keys = np.frombuffer(self._keys, dtype=np.int64)
+        entries = _probe(np.frombuffer(self._slots, dtype=np.int32), self._mask, slot_keys,
+                         lambda rows, found: (entry_hashes[found] == keys[rows])
+                         & (table_keys[found] & MOVE_ID_MASK == move_ids[rows]))
+        known = entries >= 0
+        np.frombuffer(self._units, dtype=np.int64)[entries[known]] += units[known]
+        # Views of the arrays have to go before the arrays can grow
+        del entry_hashes, table_keys
+        new = np.flatnonzero(~known)
+        if not len(new):
+            return
+        keys, move_ids, slot_keys = keys[new], move_ids[new], slot_keys[new]
+        
+        hashes = np.frombuffer(self._hashes, dtype=np.uint64)
+        positions = _probe(np.frombuffer(self._position_slots, dtype=np.int32), self._position_mask, keys,
+                           lambda rows, found: hashes[found] == keys[rows])
+        del hashes
+        # New positions are numbered in the order of their first row
+        unseen = np.flatnonzero(positions < 0)
+        _, first, inverse = np.unique(keys[unseen], return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        number = np.empty(len(order), dtype=np.int64)
+        number[order] = np.arange(len(order))
+        position_count = len(self._hashes)
+        positions[unseen] = position_count + number[inverse.ravel()]
+        first_rows = new[unseen[first[order]]]
+        window_sizes = sizes[first_rows].astype(np.int64)
+        window_starts = np.repeat(ends[first_rows] - window_sizes, window_sizes)
+        window_offsets = np.arange(len(window_starts)) - np.repeat(np.cumsum(window_sizes) - window_sizes, window_sizes)
+        self._hashes.frombytes(keys[unseen[first[order]]].tobytes())
+        self._window_start.frombytes((len(self._window_moves) + np.cumsum(window_sizes)).tobytes())
+        self._window_moves.frombytes(history[window_starts + window_offsets].astype(np.int32).tobytes())
+        entry_count = len(self._keys)
+        self._entry_hashes.frombytes(keys.tobytes())
+        self._units.frombytes(units[new].astype(np.int64).tobytes())
+        self._keys.frombytes((positions << MOVE_ID_BITS | move_ids).tobytes())
+        
+        # Same growth rule as add(): indexes at most two thirds full
+        mask = self._position_mask
+        while 3 * (len(self._hashes) - 1) > 2 * mask:
+            mask = 4 * mask + 3
+        if mask != self._position_mask:
+            slots = np.full(mask + 1, -1, dtype=np.int32)
+            _insert(slots, mask, np.frombuffer(self._hashes, dtype=np.uint64), np.arange(len(self._hashes)))
+            self._position_slots, self._position_mask = array('i', slots.tobytes()), mask
+        else:
+            _insert(np.frombuffer(self._position_slots, dtype=np.int32), mask,
+                    keys[unseen[first[order]]], np.arange(position_count, len(self._hashes)))
+        mask = self._mask
+        while 3 * (len(self._keys) - 1) > 2 * mask:
+            mask = 4 * mask + 3
+        if mask != self._mask:
+            table_keys = np.frombuffer(self._keys, dtype=np.int64)
+            all_slot_keys = (np.frombuffer(self._entry_hashes, dtype=np.uint64)
+                             + (table_keys & MOVE_ID_MASK).astype(np.uint64) * np.uint64(_MOVE_SLOT_STEP))
+            slots = np.full(mask + 1, -1, dtype=np.int32)
+            _insert(slots, mask, all_slot_keys, np.arange(len(table_keys)))
+            del table_keys
+            self._slots, self._mask = array('i', slots.tobytes()), mask
+        else:
+            _insert(np.frombuffer(self._slots, dtype=np.int32), mask, slot_keys,
+                    np.arange(entry_count, len(self._keys)))
+    
+    def key(self, pos_id):
+        """64-bit hash key of a position"""
+        return self._hashes[pos_id]
+    
+    def label(self, pos_id):
+        """Readable key of a position: its window joined by spaces"""
+        start, end = self._window_start[pos_id], self._window_start[pos_id + 1]
+        if start == end:
+            return self.empty_label
+        names = self.moves.names
+        return ' '.join(names[m] for m in self._window_moves[start:end])
+    
+    def window(self, pos_id):
+        """SAN moves of a position's window"""
+        names = self.moves.names
+        return [names[m] for m in self._window_moves[self._window_start[pos_id]:self._window_start[pos_id + 1]]]
+    
+    def iter_positions(self):
+        """Yield (pos_id, [(move_id, units), ...]) in first-seen order"""
+        keys = self._keys
+        units = self._units
+        # Entries are appended as they are first seen and position ids grow
+        # with them, so this stable sort is nearly linear.
+        order = sorted(range(len(keys)), key=lambda entry: keys[entry] >> MOVE_ID_BITS)
+        moves = []
+        current = 0
+        for entry in order:
+            pos_id = keys[entry] >> MOVE_ID_BITS
+            if pos_id != current:
+                yield current, moves
+                moves = []
+                current = pos_id
+            moves.append((keys[entry] & MOVE_ID_MASK, units[entry]))
+        if moves:
+            yield current, moves
+    
+    def items(self):
+        """Yield (position, {move: units}) pairs in first-seen order"""
+        names = self.moves.names
+        for pos_id, moves in self.iter_positions():
+            yield self.label(pos_id), {names[m]: units for m, units in moves}
+    
+    def ranked_positions(self, top_n, limit=None):
+        """Positions with at least two moves, most played first
+        
+        Yields (position, [(move, units), ...]) pairs with the top_n moves
+        of each position (ties go to the alphabetically first move).
+        Positions are ranked by total weight with ties broken by position
+        key, so the result depends only on the counts, not on the order
+        games were read in. With NumPy installed the ranking runs over the
+        table's arrays, otherwise with bounded heaps; either way labels
+        and move names are only built as the pairs are consumed.
+        """
+        names = self.moves.names
+        rank = self._rank_numpy if np is not None else self._rank_heap
+        for pos_id, top_moves in rank(top_n, limit):
+            yield self.label(pos_id), [(names[m], units) for m, units in top_moves]
+    
+    def _rank_heap(self, top_n, limit):
+        """(pos_id, [(move_id, units), ...]) pairs for ranked_positions"""
+        names = self.moves.names
+        
+        def rank_key(move):
+            return (-move[1], names[move[0]])
+        
+        candidates = (
+            (-sum(units for _, units in moves), self._hashes[pos_id], pos_id,
+             heapq.nsmallest(top_n, moves, key=rank_key))
+            for pos_id, moves in self.iter_positions()
+            if len(moves) >= 2
+        )
+        ranked = sorted(candidates) if limit is None else heapq.nsmallest(limit, candidates)
+        for _, _, pos_id, top_moves in ranked:
+            yield pos_id, top_moves
+    
+    def _rank_numpy(self, top_n, limit):
+        """_rank_heap computed with NumPy
+        
+        One lexsort orders the entries by position, weight and move name,
+        which leaves every position as a segment with its top moves first.
+        With limit, np.partition on the segment totals finds the cut-off so
+        only the positions that can make it are sorted. The ranking stays
+        in arrays; pairs are made RANK_BLOCK_POSITIONS at a time.
+        """
+        if not self._keys:
+            return
+        names = self.moves.names
+        name_rank = np.empty(len(names), dtype=np.int64)
+        name_rank[sorted(range(len(names)), key=names.__getitem__)] = np.arange(len(names))
+        
+        keys = np.asarray(self._keys)
+        units = np.asarray(self._units)
+        position = keys >> MOVE_ID_BITS
+        move = keys & MOVE_ID_MASK
+        order = np.lexsort((name_rank[move], -units, position))
+        position, move, units = position[order], move[order], units[order]
+        starts = np.flatnonzero(np.diff(position, prepend=-1))
+        lengths = np.diff(starts, append=len(position))
+        totals = np.add.reduceat(units, starts)
+        
+        segments = np.flatnonzero(lengths >= 2)
+        if limit is not None and 0 < limit < len(segments):
+            cutoff = -np.partition(-totals[segments], limit - 1)[limit - 1]
+            segments = segments[totals[segments] >= cutoff]
+        hashes = np.asarray(self._hashes)[position[starts[segments]]]
+        segments = segments[np.lexsort((hashes, -totals[segments]))]
+        if limit is not None:
+            segments = segments[:limit]
+        
+        starts = starts[segments]
+        lengths = np.minimum(lengths[segments], top_n)
+        for first in range(0, len(segments), RANK_BLOCK_POSITIONS):
+            block_starts = starts[first:first + RANK_BLOCK_POSITIONS]
+            block_lengths = lengths[first:first + RANK_BLOCK_POSITIONS]
+            # The top entries of the block's positions, one after another
+            rows = (np.repeat(block_starts - np.cumsum(block_lengths) + block_lengths, block_lengths)
+                    + np.arange(block_lengths.sum()))
+            block_moves = move[rows].tolist()
+            block_units = units[rows].tolist()
+            end = 0
+            for pos_id, length in zip(position[block_starts].tolist(), block_lengths.tolist()):
+                yield pos_id, list(zip(block_moves[end:end + length], block_units[end:end + length]))
+                end += length
+    
+    def arrays(self):
+        """The table's typed arrays as NumPy arrays, for PGNAnalyzer.save_npz"""
+        arrays = {name.lstrip('_'): np.asarray(getattr(self, name)) for name in self._ARRAYS}
+        arrays['position_mask'] = np.int64(self._position_mask)
+        arrays['mask'] = np.int64(self._mask)
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, arrays, moves, empty_label):
+        """Rebuild a table from arrays(); the indexes are reloaded, not rebuilt"""
+        table = cls(moves, empty_label)
+        for name in cls._ARRAYS:
+            values = arrays[name.lstrip('_')]
+            setattr(table, name, array(getattr(table, name).typecode, values.tobytes()))
+        table._position_mask = int(arrays['position_mask'])
+        table._mask = int(arrays['mask'])
+        return table
+    
+    def merge(self, other, factor=1):
+        """Add every count of another table, multiplied by factor, into this one
+        
+        With NumPy all of other's entries go through one add_batch call,
+        in the order iter_positions() yields them, which leaves the table
+        as adding them one at a time would. Without NumPy, or with a
+        sketch, they are added one at a time.
+        """
+        if np is None or self.sketch is not None:
+            self._merge_entries(other, factor)
+        else:
+            self._merge_batch(other, factor)
+    
+    def _merge_entries(self, other, factor):
+        """merge() one add() call per entry"""
+        intern = self.moves.intern
+        names = other.moves.names
+        for pos_id, moves in other.iter_positions():
+            history = [intern(m) for m in other.window(pos_id)]
+            key = other._hashes[pos_id]
+            for move_id, units in moves:
+                self.add(key, intern(names[move_id]), units * factor, history, len(history), len(history))
+    
+    def _merge_batch(self, other, factor):
+        """merge() with add_batch over other's arrays"""
+        if not other._keys:
+            return
+        keys = np.frombuffer(other._keys, dtype=np.int64)
+        window_start = np.frombuffer(other._window_start, dtype=np.int64)
+        window_moves = np.frombuffer(other._window_moves, dtype=np.int32)
+        # Other's move ids to this table's; only the moves other uses are interned
+        intern = self.moves.intern
+        names = other.moves.names
+        used = np.unique(np.concatenate((keys & MOVE_ID_MASK, window_moves))).tolist()
+        remap = np.zeros(len(names), dtype=np.int64)
+        remap[used] = [intern(names[m]) for m in used]
+        if not self._keys and np.array_equal(remap[used], used):
+            # Into an empty table with the same move ids: a scaled copy
+            for name in self._ARRAYS:
+                setattr(self, name, array(getattr(self, name).typecode, getattr(other, name)))
+            self._units = array('q', (np.frombuffer(other._units, dtype=np.int64) * factor).tobytes())
+            self._position_mask, self._mask = other._position_mask, other._mask
+            return
+        # iter_positions() order: by position, then first seen
+        order = np.argsort(keys >> MOVE_ID_BITS, kind='stable')
+        positions = keys[order] >> MOVE_ID_BITS
+        ends = window_start[positions + 1]
+        self.add_batch(np.frombuffer(other._hashes, dtype=np.uint64)[positions], remap[keys[order] & MOVE_ID_MASK],
+                       np.frombuffer(other._units, dtype=np.int64)[order] * factor, remap[window_moves],
+                       ends, ends - window_start[positions])
+
+
+def _grow_index(keys, mask):
+    """Rebuild an open-addressing index over keys at four times the size"""
+    mask = 4 * mask + 3
+    return _fill_index(keys, mask), mask
+
+
+def _fill_index(keys, mask):
+    """Open-addressing index of mask + 1 slots over keys
+    
+    Slots hold the position of a key in keys, or -1 when empty.
+    """
+    slots = array('i', [-1]) * (mask + 1)
+    for i, key in enumerate(keys):
+        slot = key & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        slots[slot] = i
+    return slots
+
+
+def _probe(slots, mask, slot_keys, matches):
+    """Look slot_keys up in an open-addressing index with NumPy
+    
+    Returns, for every key, the slot value v for which matches(rows, v)
+    holds, or -1 where probing reaches an empty slot first. All keys
+    probe together, one slot further each round.
+    """
+    found = np.full(len(slot_keys), -1, dtype=np.int64)
+    slot = (slot_keys & np.uint64(mask)).astype(np.int64)
+    pending = np.arange(len(slot_keys))
+    while len(pending):
+        values = slots[slot[pending]].astype(np.int64)
+        occupied = values >= 0
+        pending, values = pending[occupied], values[occupied]
+        hit = matches(pending, values)
+        found[pending[hit]] = values[hit]
+        pending = pending[~hit]
+        slot[pending] = (slot[pending] + 1) & mask
+    return found
+
+
+def _insert(slots, mask, slot_keys, values):
+    """Put values into an open-addressing index with NumPy
+    
+    Each value takes the first empty slot from its key's home slot on.
+    When several want the same empty slot in a round, the first of them
+    gets it and the others probe on.
+    """
+    slot = (slot_keys & np.uint64(mask)).astype(np.int64)
+    pending = np.arange(len(values))
+    while len(pending):
+        empty = slots[slot[pending]] < 0
+        claims = np.flatnonzero(empty)
+        _, first = np.unique(slot[pending[claims]], return_index=True)
+        placed = pending[claims[first]]
+        slots[slot[placed]] = values[placed]
+        busy = pending[~empty]
+        slot[busy] = (slot[busy] + 1) & mask
+        settled = np.zeros(len(pending), dtype=bool)
+        settled[claims[first]] = True
+        pending = pending[~settled]
+
+
+def _drop_entries(arrays, keep):
+    """CountTable.arrays() without the entries where keep is False
+    
+    Positions left without entries go too; the rest keep their order,
+    and both indexes are refilled at their old sizes.
+    """
+    keys = arrays['keys'][keep]
+    position = keys >> MOVE_ID_BITS
+    kept = np.zeros(len(arrays['hashes']), dtype=bool)
+    kept[position] = True
+    renumber = np.cumsum(kept) - 1
+    keys = renumber[position] << MOVE_ID_BITS | keys & MOVE_ID_MASK
+    lengths = np.diff(arrays['window_start'])
+    hashes = arrays['hashes'][kept]
+    entry_hashes = arrays['entry_hashes'][keep]
+    position_mask = int(arrays['position_mask'])
+    mask = int(arrays['mask'])
+    position_slots = np.full(position_mask + 1, -1, dtype=np.int32)
+    _insert(position_slots, position_mask, hashes, np.arange(len(hashes)))
+    slots = np.full(mask + 1, -1, dtype=np.int32)
+    _insert(slots, mask, entry_hashes + (keys & MOVE_ID_MASK).astype(np.uint64) * np.uint64(_MOVE_SLOT_STEP),
+            np.arange(len(keys)))
+    return {
+        'hashes': hashes,
+        'window_start': np.concatenate(([0], np.cumsum(lengths[kept]))),
+        'window_moves': arrays['window_moves'][np.repeat(kept, lengths)],
+        'position_slots': position_slots,
+        'entry_hashes': entry_hashes,
+        'keys': keys,
+        'units': arrays['units'][keep],
+        'slots': slots,
+        'position_mask': position_mask,
+        'mask': mask,
+    }
+
+
+def _drop_zero_entries(analyzer):
+    """The analyzer's counts without entries whose units came to zero"""
+    counts = []
+    for table in analyzer.export_counts():
+        units = np.frombuffer(table._units, dtype=np.int64)
+        if not units.all():
+            arrays = table.arrays()
+            table = CountTable.from_arrays(_drop_entries(arrays, arrays['units'] != 0), table.moves,
+                                           table.empty_label)
+        counts.append(table)
+    return PGNAnalyzer.from_counts(counts, analyzer.phase_plies, analyzer.windows)
+
+
+def _npz_phases(path, data):
+    """(phase_plies, windows) of an open file written by save_npz, after checking its version"""
+    if int(data['version']) != NPZ_VERSION:
+        raise ValueError(f"{path} is npz version {int(data['version'])}, expected {NPZ_VERSION}")
+    return tuple(data['phase_plies'].tolist()), tuple(data['windows'].tolist())
+
+
+def _signed(key):
+    """A 64-bit position key as the signed integer SQLite stores"""
+    return key - (1 << 64) if key >> 63 else key
+
+
+class SQLiteStore:
+    """Pattern counts kept in a SQLite database instead of in memory
+    
+    counts holds (phase, position, move, units) rows and positions the
+    readable key of every (phase, position); both are WITHOUT ROWID tables
+    clustered on their primary keys. Positions are stored as signed 64-bit
+    integers, and the journal is in WAL mode. The secondary indexes for ad
+    hoc queries are created by finish_load(), after the bulk load.
+    """
+    
+    def __init__(self, path, batch_size=SQLITE_BATCH_SIZE):
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS counts (phase TEXT NOT NULL, position INTEGER NOT NULL, '
+                'move TEXT NOT NULL, units INTEGER NOT NULL, PRIMARY KEY (phase, position, move)) WITHOUT ROWID')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS positions (phase TEXT NOT NULL, position INTEGER NOT NULL, '
+                'label TEXT NOT NULL, PRIMARY KEY (phase, position)) WITHOUT ROWID')
+        self.tables = []
+        self.loaded = False
+    
+    def table(self, phase, moves, empty_label):
+        table = SQLiteTable(self, phase, moves, empty_label)
+        self.tables.append(table)
+        return table
+    
+    def finish_load(self):
+        """Flush every table and index the counts for querying"""
+        for table in self.tables:
+            table.flush()
+        if not self.loaded:
+            with self.connection:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS counts_by_move ON counts (phase, move)')
+                self.connection.execute('CREATE INDEX IF NOT EXISTS positions_by_label ON positions (phase, label)')
+            self.connection.execute('ANALYZE')
+            self.loaded = True
+    
+    def close(self):
+        self.finish_load()
+        self.connection.close()
+
+
+class SQLiteTable:
+    """CountTable counterpart that accumulates into a SQLiteStore
+    
+    add() sums increments per (position, move) in a dict and writes them
+    with one INSERT ... ON CONFLICT DO UPDATE per row when the batch is
+    full, so memory holds at most one batch whatever the corpus size.
+    Ranking runs as SQL with window functions.
+    """
+    
+    merge = CountTable._merge_entries
+    
+    def __init__(self, store, phase, moves, empty_label):
+        self.store = store
+        self.phase = phase
+        self.moves = moves
+        self.empty_label = empty_label
+        self._pending = {}
+        self._windows = {}
+    
+    def add(self, key, move_id, units, history=(), end=0, size=0):
+        pending = self._pending
+        pair = (key, move_id)
+        if pair in pending:
+            pending[pair] += units
+            return
+        pending[pair] = units
+        if key not in self._windows:
+            self._windows[key] = history[end - size:end]
+        if len(pending) >= self.store.batch_size:
+            self.flush()
+    
+    def flush(self):
+        """Write the pending increments in one transaction"""
+        if not self._pending:
+            return
+        names = self.moves.names
+        phase = self.phase
+        with self.store.connection as connection:
+            connection.executemany(
+                'INSERT INTO positions (phase, position, label) VALUES (?, ?, ?) ON CONFLICT DO NOTHING',
+                ((phase, _signed(key), ' '.join(names[m] for m in window) or self.empty_label)
+                 for key, window in self._windows.items()))
+            connection.executemany(
+                'INSERT INTO counts (phase, position, move, units) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (phase, position, move) DO UPDATE SET units = units + excluded.units',
+                ((phase, _signed(key), names[move_id], units)
+                 for (key, move_id), units in self._pending.items()))
+        self._pending = {}
+        self._windows = {}
+    
+    def __len__(self):
+        self.store.finish_load()
+        return self.store.connection.execute(
+            'SELECT COUNT(*) FROM positions WHERE phase = ?', (self.phase,)).fetchone()[0]
+    
+    def ranked_positions(self, top_n, limit=None):
+        """Same ranking as CountTable.ranked_positions, computed in SQL
+        
+        Signed positions sort in unsigned key order with the non-negative
+        ones first.
+        """
+        self.store.finish_load()
+        rows = self.store.connection.execute('''
+            WITH totals AS (
+                SELECT position, SUM(units) AS total FROM counts
+                WHERE phase = :phase
+                GROUP BY position HAVING COUNT(*) >= 2
+                ORDER BY total DESC, position < 0, position
+                LIMIT :limit
+            ), ranked AS (
+                SELECT c.position, c.move, c.units, t.total,
+                       ROW_NUMBER() OVER (PARTITION BY c.position ORDER BY c.units DESC, c.move) AS rank
+                FROM totals AS t JOIN counts AS c ON c.phase = :phase AND c.position = t.position
+            )
+            SELECT r.position, p.label, r.move, r.units
+            FROM ranked AS r JOIN positions AS p ON p.phase = :phase AND p.position = r.position
+            WHERE r.rank <= :top_n
+            ORDER BY r.total DESC, r.position < 0, r.position, r.rank
+        ''', {'phase': self.phase, 'limit': -1 if limit is None else limit, 'top_n': top_n})
+        for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            yield group[0][1], [(move, units) for _, _, move, units in group]
+
+
+# Board replay (see Board and BoardTable). Squares are 0x88 indexes
+# (rank * 16 + file), so a square is off the board when it has a 0x88 bit.
+_KNIGHT_OFFSETS = (33, 31, 18, 14, -14, -18, -31, -33)
+_KING_OFFSETS = (1, -1, 16, -16, 15, 17, -15, -17)
+_ROOK_DIRECTIONS = (1, -1, 16, -16)
+_BISHOP_DIRECTIONS = (15, 17, -15, -17)
+_SAN_MOVE = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?')
+_START_RANKS = ('RNBQKBNR', 'P' * 8, '', '', '', '', 'p' * 8, 'rnbqkbnr')
+# Games that start from a set-up position carry it in a FEN tag
+_FEN_TAG = re.compile(r'^\[FEN\s+"([^"]*)"\]', re.M)
+
+# Castling rights as bits of a mask: K, Q, k, q. Moving from or to one of
+# these squares clears the rights that need the piece on it.
+_CASTLING_FLAGS = 'KQkq'
+_CASTLING_KEEP = [15] * 128
+_CASTLING_KEEP[0x04] = 15 & ~3
+_CASTLING_KEEP[0x07] = 15 & ~1
+_CASTLING_KEEP[0x00] = 15 & ~2
+_CASTLING_KEEP[0x74] = 15 & ~12
+_CASTLING_KEEP[0x77] = 15 & ~4
+_CASTLING_KEEP[0x70] = 15 & ~8
+
+
+def _zobrist_keys():
+    """Random 64-bit keys for Zobrist hashing, the same on every run"""
+    rng = random.Random(0x2B0B81)
+    pieces = {piece: [rng.getrandbits(64) for _ in range(128)] for piece in 'PNBRQKpnbrqk'}
+    rights = [rng.getrandbits(64) for _ in range(4)]
+    castling = [0] * 16
+    for mask in range(16):
+        for bit in range(4):
+            if mask >> bit & 1:
+                castling[mask] ^= rights[bit]
+    return pieces, rng.getrandbits(64), castling, [rng.getrandbits(64) for _ in range(8)]
+
+
+ZOBRIST_PIECES, ZOBRIST_BLACK, ZOBRIST_CASTLING, ZOBRIST_EN_PASSANT = _zobrist_keys()
+
+
+class Board:
+    """Chess board on a 0x88 array, replayed from SAN moves
+    
+    key is a Zobrist hash of the position (pieces, side to move, castling
+    rights and the en passant file), updated incrementally by apply().
+    The en passant file only counts when a pawn could capture there, so
+    transpositions that differ by an unusable double step hash alike.
+    SAN is resolved against the pieces on the board; pins are only looked
+    at when two pieces could otherwise make the same move, which is also
+    when SAN relies on them. Moves are trusted to be legal otherwise.
+    """
+    
+    __slots__ = ('squares', 'white', 'castling', 'en_passant', 'ep_key', 'kings', 'key')
+    
+    def __init__(self, fen=None):
+        """The start position, or the position of a FEN (ValueError if it cannot be read)"""
+        self.squares = [''] * 128
+        self.white = True
+        self.castling = 15
+        self.en_passant = -1
+        self.ep_key = 0
+        if fen is None:
+            for rank, pieces in enumerate(_START_RANKS):
+                for file, piece in enumerate(pieces):
+                    self.squares[rank * 16 + file] = piece
+        else:
+            self._setup(fen)
+        self.kings = [self.squares.index('K'), self.squares.index('k')]
+        key = ZOBRIST_CASTLING[self.castling] ^ self.ep_key ^ (0 if self.white else ZOBRIST_BLACK)
+        for square, piece in enumerate(self.squares):
+            if piece:
+                key ^= ZOBRIST_PIECES[piece][square]
+        self.key = key
+    
+    def _setup(self, fen):
+        """Read the first four fields of a FEN; castling rights must be KQkq letters"""
+        fields = fen.split()
+        if len(fields) < 2 or fields[1] not in ('w', 'b'):
+            raise ValueError(f"not a FEN: {fen!r}")
+        ranks = fields[0].split('/')
+        if len(ranks) != 8:
+            raise ValueError(f"not a FEN: {fen!r}")
+        for rank, text in zip(range(7, -1, -1), ranks):
+            file = 0
+            for char in text:
+                if char in '12345678':
+                    file += int(char)
+                elif char in 'PNBRQKpnbrqk' and file < 8:
+                    self.squares[rank * 16 + file] = char
+                    file += 1
+                else:
+                    raise ValueError(f"not a FEN: {fen!r}")
+            if file != 8:
+                raise ValueError(f"not a FEN: {fen!r}")
+        if self.squares.count('K') != 1 or self.squares.count('k') != 1:
+            raise ValueError(f"FEN needs one king of each side: {fen!r}")
+        self.white = fields[1] == 'w'
+        castling = fields[2] if len(fields) > 2 else '-'
+        if castling != '-' and (not castling or set(castling) - set(_CASTLING_FLAGS)):
+            # e.g. Chess960 rook files, which O-O and O-O-O here do not know
+            raise ValueError(f"unsupported castling rights {castling!r}")
+        self.castling = sum(1 << bit for bit, flag in enumerate(_CASTLING_FLAGS) if flag in castling)
+        en_passant = fields[3] if len(fields) > 3 else '-'
+        if re.fullmatch(r'[a-h][36]', en_passant):
+            square = (int(en_passant[1]) - 1) * 16 + ord(en_passant[0]) - 97
+            # The pawn that just moved two squares, and who could take it
+            moved = square - 16 if self.white else square + 16
+            if self.squares[moved] == ('p' if self.white else 'P'):
+                self.en_passant = square
+                capturer = 'P' if self.white else 'p'
+                if any(not side & 0x88 and self.squares[side] == capturer for side in (moved - 1, moved + 1)):
+                    self.ep_key = ZOBRIST_EN_PASSANT[square & 7]
+    
+    def fen(self):
+        """FEN of the position without the move counters"""
+        ranks = []
+        for rank in range(7, -1, -1):
+            text = ''
+            empty = 0
+            for square in range(rank * 16, rank * 16 + 8):
+                piece = self.squares[square]
+                if piece:
+                    text += (str(empty) if empty else '') + piece
+                    empty = 0
+                else:
+                    empty += 1
+            ranks.append(text + (str(empty) if empty else ''))
+        castling = ''.join(flag for bit, flag in enumerate(_CASTLING_FLAGS) if self.castling >> bit & 1)
+        en_passant = '-'
+        if self.ep_key:
+            en_passant = 'abcdefgh'[self.en_passant & 7] + str((self.en_passant >> 4) + 1)
+        return f"{'/'.join(ranks)} {'w' if self.white else 'b'} {castling or '-'} {en_passant}"
+    
+    def attacked(self, square, by_white):
+        """Whether a piece of the given side attacks square"""
+        squares = self.squares
+        if by_white:
+            pawn, knight, bishop, rook, queen, king = 'PNBRQK'
+            pawn_sources = (square - 15, square - 17)
+        else:
+            pawn, knight, bishop, rook, queen, king = 'pnbrqk'
+            pawn_sources = (square + 15, square + 17)
+        for source in pawn_sources:
+            if not source & 0x88 and squares[source] == pawn:
+                return True
+        for offset in _KNIGHT_OFFSETS:
+            source = square + offset
+            if not source & 0x88 and squares[source] == knight:
+                return True
+        for offset in _KING_OFFSETS:
+            source = square + offset
+            if not source & 0x88 and squares[source] == king:
+                return True
+        for directions, slider in ((_ROOK_DIRECTIONS, rook), (_BISHOP_DIRECTIONS, bishop)):
+            for direction in directions:
+                source = square + direction
+                while not source & 0x88:
+                    piece = squares[source]
+                    if piece:
+                        if piece == slider or piece == queen:
+                            return True
+                        break
+                    source += direction
+        return False
+    
+    def _safe(self, origin, target):
+        """Whether moving the piece on origin to target leaves its king out of check"""
+        squares = self.squares
+        moved, captured = squares[origin], squares[target]
+        squares[origin], squares[target] = '', moved
+        safe = not self.attacked(self.kings[not self.white], not self.white)
+        squares[origin], squares[target] = moved, captured
+        return safe
+    
+    def resolve(self, san):
+        """(origin, target, promotion) of a SAN move; raises ValueError if it cannot be played"""
+        san = san.rstrip('+#!?')
+        white = self.white
+        squares = self.squares
+        if san in ('O-O', 'O-O-O'):
+            return self._castle(san)
+        match = _SAN_MOVE.fullmatch(san)
+        if match is None:
+            raise ValueError(f"not a SAN move: {san!r}")
+        piece, from_file, from_rank, target, promotion = match.groups()
+        target_square = (int(target[1]) - 1) * 16 + ord(target[0]) - 97
+        captured = squares[target_square]
+        if captured and captured.isupper() == white:
+            raise ValueError(f"{san} lands on a piece of its own side")
+        
+        if piece is None:
+            pawn = 'P' if white else 'p'
+            forward = 16 if white else -16
+            if from_file is not None:
+                origin = target_square - forward + ord(from_file) - ord(target[0])
+                if not captured and target_square != self.en_passant:
+                    raise ValueError(f"{san} captures nothing")
+            else:
+                if captured:
+                    raise ValueError(f"{san} is blocked")
+                origin = target_square - forward
+                if not origin & 0x88 and not squares[origin]:
+                    origin -= forward
+            if origin & 0x88 or squares[origin] != pawn:
+                raise ValueError(f"no pawn can play {san}")
+            if promotion:
+                promotion = promotion if white else promotion.lower()
+            return origin, target_square, promotion or ''
+        
+        mover = piece if white else piece.lower()
+        candidates = []
+        if piece == 'N' or piece == 'K':
+            for offset in (_KNIGHT_OFFSETS if piece == 'N' else _KING_OFFSETS):
+                origin = target_square + offset
+                if not origin & 0x88 and squares[origin] == mover:
+                    candidates.append(origin)
+        else:
+            directions = {'B': _BISHOP_DIRECTIONS, 'R': _ROOK_DIRECTIONS}.get(piece, _KING_OFFSETS)
+            for direction in directions:
+                origin = target_square + direction
+                while not origin & 0x88:
+                    if squares[origin]:
+                        if squares[origin] == mover:
+                            candidates.append(origin)
+                        break
+                    origin += direction
+        if from_file is not None:
+            candidates = [origin for origin in candidates if origin & 7 == ord(from_file) - 97]
+        if from_rank is not None:
+            candidates = [origin for origin in candidates if origin >> 4 == int(from_rank) - 1]
+        if len(candidates) > 1:
+            candidates = [origin for origin in candidates if self._safe(origin, target_square)]
+        if len(candidates) != 1:
+            raise ValueError(f"{san} matches {len(candidates)} pieces")
+        return candidates[0], target_square, ''
+    
+    def _castle(self, san):
+        """resolve() for O-O and O-O-O
+        
+        The king and the rook have to be on their squares with the right
+        to castle kept, nothing in between, and the king may not be in
+        check or pass through or land on an attacked square.
+        """
+        white = self.white
+        squares = self.squares
+        origin = 0x04 if white else 0x74
+        kingside = san == 'O-O'
+        rook = origin + 3 if kingside else origin - 4
+        right = (1 if kingside else 2) << (0 if white else 2)
+        if (not self.castling & right or squares[origin] != ('K' if white else 'k')
+                or squares[rook] != ('R' if white else 'r')):
+            raise ValueError(f"{san} is not allowed here")
+        if any(squares[square] for square in range(min(origin, rook) + 1, max(origin, rook))):
+            raise ValueError(f"{san} is blocked")
+        step = 1 if kingside else -1
+        if any(self.attacked(square, not white) for square in (origin, origin + step, origin + 2 * step)):
+            raise ValueError(f"{san} would castle out of, through or into check")
+        return origin, origin + 2 * step, ''
+    
+    def apply(self, move):
+        """Play a move from resolve() and update the hash"""
+        origin, target, promotion = move
+        squares = self.squares
+        pieces = ZOBRIST_PIECES
+        piece = squares[origin]
+        captured = squares[target]
+        key = self.key ^ self.ep_key ^ ZOBRIST_BLACK
+        key ^= pieces[piece][origin]
+        if captured:
+            key ^= pieces[captured][target]
+        elif target == self.en_passant and piece in 'Pp':
+            # En passant: the captured pawn is behind the target square
+            behind = target - 16 if piece == 'P' else target + 16
+            key ^= pieces[squares[behind]][behind]
+            squares[behind] = ''
+        placed = promotion or piece
+        squares[origin] = ''
+        squares[target] = placed
+        key ^= pieces[placed][target]
+        
+        if piece in 'Kk':
+            self.kings[piece == 'k'] = target
+            if abs(target - origin) == 2:
+                # Castling also moves the rook
+                rook_from, rook_to = (origin + 3, origin + 1) if target > origin else (origin - 4, origin - 1)
+                rook = squares[rook_from]
+                squares[rook_from] = ''
+                squares[rook_to] = rook
+                key ^= pieces[rook][rook_from] ^ pieces[rook][rook_to]
+        castling = self.castling & _CASTLING_KEEP[origin] & _CASTLING_KEEP[target]
+        key ^= ZOBRIST_CASTLING[self.castling] ^ ZOBRIST_CASTLING[castling]
+        self.castling = castling
+        
+        # A double step only enters the hash if a pawn could take en passant
+        self.en_passant = -1
+        self.ep_key = 0
+        if piece in 'Pp' and abs(target - origin) == 32:
+            self.en_passant = (origin + target) // 2
+            enemy = 'p' if piece == 'P' else 'P'
+            for side in (target - 1, target + 1):
+                if not side & 0x88 and squares[side] == enemy:
+                    self.ep_key = ZOBRIST_EN_PASSANT[target & 7]
+                    key ^= self.ep_key
+                    break
+        self.white = not self.white
+        self.key = key
+    
+    def play(self, san):
+        self.apply(self.resolve(san))
+
+
+class BoardTable(CountTable):
+    """CountTable keyed by the Zobrist hashes of replayed boards
+    
+    Positions are labeled with their FEN instead of a move window, so the
+    same position reached by different move orders is one entry. The FEN
+    is only built the first time a position is seen.
+    """
+    
+    def __init__(self, moves=None, empty_label=''):
+        super().__init__(moves, empty_label)
+        self._fens = []
+    
+    def add(self, key, move_id, units, position=None):
+        """Add weight units to a move played from a position
+        
+        position is the Board before the move, or the position's FEN.
+        """
+        positions = len(self._hashes)
+        CountTable.add(self, key, move_id, units)
+        if len(self._hashes) > positions:
+            self._fens.append(position if isinstance(position, str) else position.fen())
+    
+    def label(self, pos_id):
+        return self._fens[pos_id]
+    
+    def window(self, pos_id):
+        return []
+    
+    def _merge_entries(self, other, factor):
+        intern = self.moves.intern
+        names = other.moves.names
+        for pos_id, moves in other.iter_positions():
+            key = other._hashes[pos_id]
+            for move_id, units in moves:
+                self.add(key, intern(names[move_id]), units * factor, other.label(pos_id))
+    
+    def _merge_batch(self, other, factor):
+        positions = len(self._hashes)
+        CountTable._merge_batch(self, other, factor)
+        # New positions were numbered in the order of other's, so their
+        # FENs follow in that order too
+        added = np.isin(np.frombuffer(other._hashes, dtype=np.uint64),
+                        np.frombuffer(self._hashes, dtype=np.uint64)[positions:])
+        self._fens.extend(other._fens[pos_id] for pos_id in np.flatnonzero(added).tolist())
+
+
+def _parse_chunk(task):
+    """Worker entry point: count one byte range of a PGN file
+    
+    Returns (games, counts, (replay errors, set-up games), timers);
+    timers is None unless fine-grained timing was asked for.
+    """
+    filename, start, end, weight, fine, numpy_batch, board_replay, phase_plies, windows = task
+    analyzer = PGNAnalyzer(phase_plies, windows)
+    analyzer.numpy_batch = numpy_batch
+    if board_replay:
+        analyzer.enable_board()
+    if fine:
+        analyzer.run_stats = RunStats(interval=0, fine=True)
+    games = analyzer.parse_games(iter_pgn_games(filename, start, end), weight)
+    return (games, analyzer.export_counts(), (analyzer.replay_errors, analyzer.setup_games),
+            analyzer.run_stats and analyzer.run_stats.timers)
+
+
 class PGNAnalyzer:
-    def __init__(self):
-        self.opening_book = defaultdict(lambda: defaultdict(int))
-        self.middlegame_patterns = defaultdict(lambda: defaultdict(int))
-        self.endgame_patterns = defaultdict(lambda: defaultdict(int))
+    @classmethod
+    def from_counts(cls, counts, phase_plies=PHASE_PLIES, windows=PHASE_WINDOWS):
+        """Create an analyzer around tables returned by export_counts()
+        
+        phase_plies and windows must be those the tables were counted with.
+        """
+        analyzer = cls(phase_plies, windows)
+        analyzer.opening_book, analyzer.middlegame_patterns, analyzer.endgame_patterns = counts
+        analyzer.moves = analyzer.opening_book.moves
+        return analyzer
+    
+    def __init__(self, phase_plies=PHASE_PLIES, windows=PHASE_WINDOWS):
+        if not 0 < phase_plies[0] <= phase_plies[1]:
+            raise ValueError(f"phase boundaries must be increasing plies, got {phase_plies}")
+        if len(windows) != 3 or not all(0 <= window < len(HASH_POWERS) for window in windows):
+            raise ValueError(f"windows must be three lengths below {len(HASH_POWERS)}, got {windows}")
+        # Plies at which the middlegame and the endgame start, and the
+        # moves in the position window of each phase
+        self.phase_plies = tuple(phase_plies)
+        self.windows = tuple(windows)
+        # The three phase tables share one move interning table
+        self.moves = MoveTable()
+        self.opening_book = CountTable(self.moves, 'start')
+        self.middlegame_patterns = CountTable(self.moves, 'middlegame')
+        self.endgame_patterns = CountTable(self.moves, 'endgame')
+        self.sketch = None
+        # Games that passed the filters and were counted, over all inputs
+        self.games_counted = 0
+        # GameDeduplicator when skipping repeated games with enable_dedupe()
+        self.dedupe = None
+        # Positions are replayed boards after enable_board()
+        self.board_replay = False
+        self.replay_errors = 0
+        # Games replayed from the position in their FEN tag
+        self.setup_games = 0
+        # Games per batch when counting with enable_numpy(), 0 for per-ply
+        self.numpy_batch = 0
+        # SQLiteStore when counting with use_sqlite()
+        self.store = None
+        # Optional RunStats for timers and progress output
+        self.run_stats = None
         self.tactical_moves = []
         self.brilliant_positions = []
         
-    def parse_pgn_file(self, filename, player_name, weight=1.0):
-        """Parse a PGN file and extract patterns"""
+    def use_sqlite(self, path, batch_size=SQLITE_BATCH_SIZE):
+        """Count into a SQLite database at path instead of in memory
+        
+        Returns the SQLiteStore; close() it when done. Counts already in
+        the database are added to, so start from a new file for a fresh
+        build.
+        """
+        self.store = SQLiteStore(path, batch_size)
+        self.opening_book = self.store.table('opening', self.moves, 'start')
+        self.middlegame_patterns = self.store.table('middlegame', self.moves, 'middlegame')
+        self.endgame_patterns = self.store.table('endgame', self.moves, 'endgame')
+        return self.store
+    
+    def enable_sketch(self, budget=SKETCH_BUDGET, min_weight=SKETCH_MIN_WEIGHT, depth=SKETCH_DEPTH):
+        """Switch to approximate ingestion through a count-min sketch
+        
+        Moves whose weight from a position stays below min_weight are
+        dropped instead of stored, so memory is bounded by the sketch plus
+        the pairs that clear the threshold. Every pair that reaches
+        min_weight is kept, and a kept count overstates the true weight by
+        at most the bound reported in get_statistics(). Not available with
+        board replay.
+        """
+        if self.board_replay:
+            raise ValueError("the sketch cannot be combined with board replay")
+        self.sketch = CountMinSketch.for_budget(budget, depth)
+        self.min_weight = min_weight
+        for table in (self.opening_book, self.middlegame_patterns, self.endgame_patterns):
+            table.sketch = self.sketch
+            table.sketch_salt = move_code(table.empty_label)
+            table.min_units = weight_units(min_weight)
+    
+    def enable_numpy(self, batch_games=NUMPY_BATCH_GAMES):
+        """Count plies in NumPy batches of batch_games games
+        
+        The tables end up with the same counts as per-ply counting; only
+        the order in which positions are first seen changes.
+        """
+        if np is None:
+            raise RuntimeError("NumPy aggregation needs the numpy package")
+        self.numpy_batch = batch_games
+    
+    def enable_board(self):
+        """Key positions by replayed boards instead of move windows
+        
+        Counts go into BoardTables keyed by Zobrist hashes and labeled by
+        FEN, so transpositions share one entry. Call before counting; not
+        available with the sketch.
+        """
+        if self.sketch is not None:
+            raise ValueError("board replay cannot be combined with the sketch")
+        self.board_replay = True
+        self.opening_book = BoardTable(self.moves)
+        self.middlegame_patterns = BoardTable(self.moves)
+        self.endgame_patterns = BoardTable(self.moves)
+    
+    def enable_dedupe(self, mode='exact', capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        """Skip games already seen in this analyzer (see GameDeduplicator)"""
+        self.dedupe = GameDeduplicator(mode, capacity, error_rate)
+    
+    def parse_pgn_file(self, filename, player_name, weight=1.0, games=None):
+        """Parse a PGN file and extract patterns
+        
+        games may supply the file's game texts, e.g. from a Prefetcher.
+        """
         print(f"Parsing {filename} for {player_name}...")
         
-        with open(filename, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
+        # Games are streamed one at a time instead of reading the whole file
+        if games is None:
+            games = iter_pgn_games(filename)
+        total_games = self.parse_games(games, weight, filename)
+        
+        print(f"  Processed {total_games} games from {player_name}")
+        if self.dedupe is not None:
+            print(f"  Skipped {self.dedupe.dropped[str(filename)]} duplicate games")
+        return total_games
+    
+    def parse_games(self, games, weight=1.0, source=None):
+        """Extract patterns from an iterable of game texts
         
-        # Split into games
-        games = re.split(r'\n\n(?=\[Event)', content)
+        source names the input in the per-file duplicate counts.
+        """
+        if self.dedupe is not None:
+            self.dedupe.begin(source)
+        if self.board_replay:
+            return self._count_games_board(self._iter_moves(games, setups=True), weight)
+        return self.count_games(self._iter_moves(games), weight)
+    
+    def count_games(self, games, weight=1.0):
+        """Count games given as lists of SAN moves; returns how many"""
+        if self.board_replay:
+            return self._count_games_board(((None, moves) for moves in games), weight)
+        if self.numpy_batch:
+            return self._count_games_numpy(games, weight)
+        units = weight_units(weight)
+        ids = self.moves.ids
+        intern = self.moves.intern
+        codes = self.moves.codes
+        opening_end, middlegame_end = self.phase_plies
+        opening_window, middlegame_window, endgame_window = self.windows
         total_games = 0
         
-        for game_text in games:
-            if not game_text.strip():
-                continue
-                
-            # Extract moves
-            moves_match = re.search(r'\n\n(.+?)(?:1-0|0-1|1/2-1/2|\*)', game_text, re.DOTALL)
-            if not moves_match:
-                continue
+        for moves in games:
+            total_games += 1
             
-            moves_text = moves_match.group(1)
+            # Position keys are rolling hashes: prefix[n] hashes the first n
+            # moves, so the key of the window moves[n-k:n] is
+            # prefix[n] - prefix[n-k] * HASH_BASE**k, an O(1) step per ply
+            # instead of joining the window into a string.
+            history = []
+            prefix = [0]
+            for move in moves:
+                move_id = ids.get(move)
+                if move_id is None:
+                    move_id = intern(move)
+                history.append(move_id)
+                prefix.append((prefix[-1] * HASH_BASE + codes[move_id]) & HASH_MASK)
             
-            # Clean up and extract moves
-            moves_text = re.sub(r'\{[^}]*\}', '', moves_text)  # Remove comments
-            moves_text = re.sub(r'\([^)]*\)', '', moves_text)  # Remove variations
-            moves_text = re.sub(r'\d+\.+', ' ', moves_text)    # Remove move numbers
+            # Opening phase (moves 1-15 by default), keyed by up to 8 moves
+            # or 'start'
+            add = self.opening_book.add
+            for idx in range(min(len(moves), opening_end)):
+                size = idx if idx < opening_window else opening_window
+                key = (prefix[idx] - prefix[idx - size] * HASH_POWERS[size]) & HASH_MASK
+                add(key, history[idx], units, history, idx, size)
             
-            moves = moves_text.split()
-            moves = [m for m in moves if m and m not in ['1-0', '0-1', '1/2-1/2', '*']]
+            # Middlegame phase (moves 16-40), 6 moves or 'middlegame'
+            add = self.middlegame_patterns.add
+            for idx in range(opening_end, min(len(moves), middlegame_end)):
+                size = middlegame_window if idx >= middlegame_window else 0
+                key = (prefix[idx] - prefix[idx - size] * HASH_POWERS[size]) & HASH_MASK
+                add(key, history[idx], units, history, idx, size)
             
-            if len(moves) < 10:
-                continue
+            # Endgame phase (moves 41+), 4 moves or 'endgame'
+            add = self.endgame_patterns.add
+            for idx in range(middlegame_end, len(moves)):
+                size = endgame_window if idx >= endgame_window else 0
+                key = (prefix[idx] - prefix[idx - size] * HASH_POWERS[size]) & HASH_MASK
+                add(key, history[idx], units, history, idx, size)
+        
+        return total_games
+    
+    def _iter_moves(self, games, setups=False):
+        """Yield the main line of every game text with at least 10 moves
+        
+        With setups, yields (FEN, moves) pairs instead, where FEN is the
+        game's FEN tag or None. Ticks run_stats for each game and skips
+        repeats when dedupe is on. With fine timing, the time until the
+        next game is asked for is the caller's 'count' step.
+        """
+        run_stats = self.run_stats
+        dedupe = self.dedupe
+        # lap() splits the time per game into stages when fine timing is on
+        lap = run_stats.lap if run_stats is not None and run_stats.fine else None
+        if lap:
+            lap('read')
+        
+        for game_text in games:
+            if run_stats is not None:
+                run_stats.tick(1, len(game_text) + 2)
+            if lap:
+                lap('read')
+            # Movetext starts after the blank line that ends the tags
+            start = game_text.find('\n\n')
+            moves = tokenize_movetext(game_text[start + 2:]) if start >= 0 else None
+            if lap:
+                lap('tokenize')
             
-            total_games += 1
+            if moves is None or len(moves) < 10:
+                continue
             
-            # Process moves by phase
-            position_history = []
+            # Repeats are dropped before anything is counted
+            if dedupe is not None:
+                duplicate = dedupe.is_duplicate(game_text[:start], moves)
+                if lap:
+                    lap('dedupe')
+                if duplicate:
+                    continue
             
-            for idx, move in enumerate(moves):
-                move_num = (idx // 2) + 1
-                
-                # Opening phase (moves 1-15)
-                if move_num <= 15:
-                    pos_key = ' '.join(position_history[-8:]) if position_history else 'start'
-                    self.opening_book[pos_key][move] += weight
-                    
-                # Middlegame phase (moves 16-40)
-                elif move_num <= 40:
-                    pos_key = ' '.join(position_history[-6:]) if len(position_history) >= 6 else 'middlegame'
-                    self.middlegame_patterns[pos_key][move] += weight
-                    
-                # Endgame phase (moves 41+)
-                else:
-                    pos_key = ' '.join(position_history[-4:]) if len(position_history) >= 4 else 'endgame'
-                    self.endgame_patterns[pos_key][move] += weight
-                
-                position_history.append(move)
+            self.games_counted += 1
+            if setups:
+                fen = _FEN_TAG.search(game_text, 0, start)
+                yield (fen.group(1) if fen else None), moves
+            else:
+                yield moves
+            if lap:
+                lap('count')
+    
+    def _count_games_board(self, games, weight):
+        """count_games keyed by the Zobrist hash of the replayed board
         
-        print(f"  Processed {total_games} games from {player_name}")
+        games are (FEN, moves) pairs; a game with a FEN starts from that
+        position instead of the start position. A move that cannot be
+        played on the board ends the game there and counts as a replay
+        error; the plies before it stay counted. So does a FEN that cannot
+        be read, for the whole game.
+        """
+        units = weight_units(weight)
+        ids = self.moves.ids
+        intern = self.moves.intern
+        opening_end, middlegame_end = self.phase_plies
+        total_games = 0
+        for fen, moves in games:
+            total_games += 1
+            if fen is not None:
+                self.setup_games += 1
+            try:
+                board = Board(fen)
+            except ValueError:
+                self.replay_errors += 1
+                continue
+            # Opening, then middlegame from opening_end, endgame from middlegame_end
+            add = self.opening_book.add
+            for idx, move in enumerate(moves):
+                if idx == opening_end:
+                    add = self.middlegame_patterns.add
+                if idx == middlegame_end:
+                    add = self.endgame_patterns.add
+                try:
+                    resolved = board.resolve(move)
+                except ValueError:
+                    self.replay_errors += 1
+                    break
+                move_id = ids.get(move)
+                if move_id is None:
+                    move_id = intern(move)
+                add(board.key, move_id, units, board)
+                try:
+                    board.apply(resolved)
+                except (KeyError, IndexError):
+                    # A move resolve() let through that the board cannot
+                    # take; the game ends here like any other bad move
+                    self.replay_errors += 1
+                    break
         return total_games
     
-    def generate_opening_repertoire(self, top_n=5):
-        """Generate top opening moves for each position"""
-        repertoire = {}
+    def _count_games_numpy(self, games, weight):
+        """count_games with the counting done by _count_batch"""
+        units = weight_units(weight)
+        ids = self.moves.ids
+        intern = self.moves.intern
+        total_games = 0
+        # Move ids of the batch's games back to back, and where each game starts
+        history = array('i')
+        starts = array('q')
+        for moves in games:
+            total_games += 1
+            starts.append(len(history))
+            history.extend([ids[move] if move in ids else intern(move) for move in moves])
+            if len(starts) >= self.numpy_batch:
+                self._count_batch(history, starts, units)
+                history = array('i')
+                starts = array('q')
+        if starts:
+            self._count_batch(history, starts, units)
+        return total_games
+    
+    def _count_batch(self, history, starts, units):
+        """Count a batch of games with NumPy and add the sums to the tables
+        
+        Every ply becomes a (phase, position key, move id, units) row. The
+        keys are the same rolling hashes parse_games computes, built as a
+        sum of shifted move codes (uint64 arithmetic wraps like HASH_MASK).
+        Rows are sorted and equal ones summed with np.add.reduceat, and
+        each table takes its distinct (position, move) rows in one
+        add_batch() (one add() per row for SQLite or sketched tables).
+        """
+        move_ids = np.asarray(history)
+        plies = len(move_ids)
+        first = np.asarray(starts)
+        ply = np.arange(plies) - np.repeat(first, np.diff(first, append=plies))
+        codes = np.array(self.moves.codes, dtype=np.uint64)[move_ids]
         
-        for position, moves in self.opening_book.items():
-            if len(moves) < 2:
+        # Opening below ply 30 by default (window of up to 8 moves),
+        # middlegame below ply 80 (6 moves), endgame after that (4 moves);
+        # a window longer than the game so far is empty
+        phase = np.digitize(ply, self.phase_plies)
+        windows = np.array(self.windows)[phase]
+        size = np.where(phase == 0, np.minimum(ply, windows), np.where(ply >= windows, windows, 0))
+        key = np.zeros(plies, dtype=np.uint64)
+        for back in range(1, max(self.windows) + 1):
+            rows = np.flatnonzero(size >= back)
+            key[rows] += codes[rows - back] * np.uint64(HASH_POWERS[back - 1])
+        
+        order = np.lexsort((move_ids, key, phase))
+        phase, key, move = phase[order], key[order], move_ids[order]
+        new_row = np.ones(plies, dtype=bool)
+        new_row[1:] = (phase[1:] != phase[:-1]) | (key[1:] != key[:-1]) | (move[1:] != move[:-1])
+        rows = np.flatnonzero(new_row)
+        totals = np.add.reduceat(np.full(plies, units, dtype=np.int64), rows)
+        # One ply of each row, whose window is copied for new positions
+        sample = order[rows]
+        
+        # Rows are sorted by phase, so each table gets one slice
+        bounds = np.searchsorted(phase[rows], (0, 1, 2, 3))
+        for p, table in enumerate((self.opening_book, self.middlegame_patterns, self.endgame_patterns)):
+            part = slice(bounds[p], bounds[p + 1])
+            if isinstance(table, CountTable) and table.sketch is None:
+                table.add_batch(key[rows][part], move[rows][part], totals[part], move_ids, sample[part],
+                                size[sample[part]])
                 continue
-            
-            # Get top N most frequent moves
-            sorted_moves = sorted(moves.items(), key=lambda x: x[1], reverse=True)[:top_n]
-            total = sum(count for _, count in sorted_moves)
+            for k, m, total, end, n in zip(key[rows][part].tolist(), move[rows][part].tolist(),
+                                           totals[part].tolist(), sample[part].tolist(), size[sample[part]].tolist()):
+                table.add(k, m, total, history, end, n)
+    
+    def parse_corpus(self, corpus, weight=1.0):
+        """Count the games of a compiled Corpus; returns how many
+        
+        With NumPy the plies go from the mapped arrays to _count_batch in
+        batches of numpy_batch games (NUMPY_BATCH_GAMES by default), with
+        no text to read or tokenize. Board replay, and runs without NumPy,
+        count the games' SAN moves like parse_games.
+        """
+        if self.board_replay:
+            games = ((corpus.setups.get(game), moves) for game, moves in enumerate(corpus))
+            total_games = self._count_games_board(games, weight)
+            self.games_counted += total_games
+            if self.run_stats is not None:
+                self.run_stats.tick(total_games)
+            return total_games
+        if np is None:
+            total_games = self.count_games(corpus, weight)
+            self.games_counted += total_games
+            if self.run_stats is not None:
+                self.run_stats.tick(total_games)
+            return total_games
+        units = weight_units(weight)
+        intern = self.moves.intern
+        # Corpus move ids to this analyzer's
+        remap = np.array([intern(name) for name in corpus.names], dtype=np.int32)
+        offsets, moves = corpus.arrays()
+        batch = self.numpy_batch or NUMPY_BATCH_GAMES
+        for first in range(0, corpus.games, batch):
+            last = min(first + batch, corpus.games)
+            begin, end = int(offsets[first]), int(offsets[last])
+            history = array('i', remap[moves[begin:end]].tobytes())
+            self._count_batch(history, (offsets[first:last] - begin).astype(np.int64), units)
+            self.games_counted += last - first
+            if self.run_stats is not None:
+                self.run_stats.tick(last - first)
+        return corpus.games
+    
+    def parse_pgn_files_parallel(self, pgn_files, jobs, chunk_size=PARALLEL_CHUNK_SIZE):
+        """Parse (filename, player_name, weight) files with a process pool
+        
+        Each worker counts one chunk of a file into its own partial tables.
+        Partials are merged back in file and chunk order, which gives the
+        same tables as parsing the files one after another.
+        """
+        run_stats = self.run_stats or RunStats(interval=0)
+        tasks = []
+        with run_stats.stage('split'):
+            for filename, player_name, weight in pgn_files:
+                for start, end in find_game_boundaries(filename, chunk_size):
+                    tasks.append((filename, start, end, weight, run_stats.fine, self.numpy_batch, self.board_replay,
+                                  self.phase_plies, self.windows))
+        
+        # Worker timers are summed over processes, so they can add up to
+        # more than the wall time
+        file_games = Counter()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for task, (games, counts, (replay_errors, setup_games), timers) in zip(tasks,
+                                                                                  executor.map(_parse_chunk, tasks)):
+                file_games[task[0]] += games
+                self.replay_errors += replay_errors
+                self.setup_games += setup_games
+                with run_stats.stage('merge'):
+                    self.merge_counts(counts)
+                if timers:
+                    run_stats.add_timers(timers)
+                filename, start, end = task[:3]
+                run_stats.tick(games, end - start if end is not None else pgn_size(filename) or 0)
+        
+        for filename, player_name, _ in pgn_files:
+            print(f"  Processed {file_games[filename]} games from {player_name} ({filename})")
+        return sum(file_games.values())
+    
+    def export_counts(self):
+        """Return the (picklable) opening, middlegame and endgame tables"""
+        return (self.opening_book, self.middlegame_patterns, self.endgame_patterns)
+    
+    def merge_counts(self, counts, factor=1):
+        """Add partial tables from export_counts(), multiplied by factor"""
+        if not len(self.moves):
+            # Same move ids as the partials, so empty tables can copy them
+            for name in counts[0].moves.names:
+                self.moves.intern(name)
+        tables = (self.opening_book, self.middlegame_patterns, self.endgame_patterns)
+        for table, partial in zip(tables, counts):
+            table.merge(partial, factor)
+    
+    def save_npz(self, path, games=0, **extra):
+        """Save the move names and the three tables' arrays to a .npz file
+        
+        load_npz() turns the arrays back into tables with buffer copies,
+        without re-counting or rebuilding any index. extra arrays are saved
+        alongside under their own names.
+        """
+        data = {
+            'version': np.int64(NPZ_VERSION),
+            'games': np.int64(games),
+            'phase_plies': np.array(self.phase_plies, dtype=np.int64),
+            'windows': np.array(self.windows, dtype=np.int64),
+            'moves': np.array(self.moves.names, dtype=str),
+            **extra,
+        }
+        for phase, table in zip(('opening', 'middlegame', 'endgame'), self.export_counts()):
+            for name, values in table.arrays().items():
+                data[f'{phase}.{name}'] = values
+        write_atomic(path, lambda f: np.savez(f, **data))
+    
+    @classmethod
+    def load_npz(cls, path):
+        """Return (analyzer, games) from a file written by save_npz"""
+        if np is None:
+            raise RuntimeError("Loading .npz counts needs the numpy package")
+        with np.load(path) as data:
+            phase_plies, windows = _npz_phases(path, data)
+            moves = MoveTable()
+            for name in data['moves'].tolist():
+                moves.intern(name)
+            counts = []
+            for phase, empty_label in (('opening', 'start'), ('middlegame', 'middlegame'), ('endgame', 'endgame')):
+                arrays = {key.split('.', 1)[1]: data[key] for key in data.files if key.startswith(phase + '.')}
+                counts.append(CountTable.from_arrays(arrays, moves, empty_label))
+            return cls.from_counts(counts, phase_plies, windows), int(data['games'])
+    
+    @staticmethod
+    def npz_phases(path):
+        """(phase_plies, windows) the counts in a file written by save_npz were taken with"""
+        if np is None:
+            raise RuntimeError("Loading .npz counts needs the numpy package")
+        with np.load(path) as data:
+            return _npz_phases(path, data)
+    
+    def generate_opening_repertoire(self, top_n=5):
+        """Generate top opening moves for each position"""
+        return dict(self.iter_opening_repertoire(top_n))
+    
+    def iter_opening_repertoire(self, top_n=5):
+        """Yield (position, [{'move', 'weight'}]) entries, most played position first"""
+        for position, top_moves in self.opening_book.ranked_positions(top_n):
+            total = sum(units for _, units in top_moves)
             
             if total > 0:
                 # Store with probability weights
-                repertoire[position] = [
-                    {'move': move, 'weight': count / total}
-                    for move, count in sorted_moves
+                yield position, [
+                    {'move': move, 'weight': units / total}
+                    for move, units in top_moves
                 ]
-        
-        return repertoire
     
     def generate_tactical_book(self):
-        """Generate tactical pattern database"""
+        """Generate tactical pattern database from the most played positions"""
         patterns = {
             'opening': {},
             'middlegame': {},
             'endgame': {}
         }
         
-        # Opening patterns (top 100)
-        for pos, moves in list(self.opening_book.items())[:100]:
-            if len(moves) >= 2:
-                top_moves = sorted(moves.items(), key=lambda x: x[1], reverse=True)[:3]
-                patterns['opening'][pos] = [m[0] for m in top_moves]
-        
-        # Middlegame patterns (top 50)
-        for pos, moves in list(self.middlegame_patterns.items())[:50]:
-            if len(moves) >= 2:
-                top_moves = sorted(moves.items(), key=lambda x: x[1], reverse=True)[:3]
-                patterns['middlegame'][pos] = [m[0] for m in top_moves]
-        
-        # Endgame patterns (top 30)
-        for pos, moves in list(self.endgame_patterns.items())[:30]:
-            if len(moves) >= 2:
-                top_moves = sorted(moves.items(), key=lambda x: x[1], reverse=True)[:2]
-                patterns['endgame'][pos] = [m[0] for m in top_moves]
+        # Opening (top 100), middlegame (top 50) and endgame (top 30) positions
+        for phase, table, limit, top_n in (('opening', self.opening_book, 100, 3),
+                                           ('middlegame', self.middlegame_patterns, 50, 3),
+                                           ('endgame', self.endgame_patterns, 30, 2)):
+            for position, top_moves in table.ranked_positions(top_n, limit):
+                patterns[phase][position] = [move for move, _ in top_moves]
         
         return patterns
     
     def get_statistics(self):
         """Get statistics about the database"""
-        return {
+        stats = {
             'opening_positions': len(self.opening_book),
             'middlegame_positions': len(self.middlegame_patterns),
             'endgame_positions': len(self.endgame_patterns),
             'total_positions': len(self.opening_book) + len(self.middlegame_patterns) + len(self.endgame_patterns)
         }
+        if self.sketch is not None:
+            # Kept counts are within max_overcount of the truth with
+            # probability 1 - delta; nothing that reached min_weight is missing
+            sketch = self.sketch
+            total = sketch.total / WEIGHT_SCALE
+            stats['approximate'] = {
+                'sketch_width': sketch.width,
+                'sketch_depth': sketch.depth,
+                'sketch_bytes': sketch.nbytes,
+                'min_weight': self.min_weight,
+                'sketched_weight': total,
+                'epsilon': sketch.epsilon,
+                'delta': sketch.delta,
+                'max_overcount': sketch.epsilon * total,
+            }
+        if self.dedupe is not None:
+            stats['duplicates'] = self.dedupe.statistics()
+        if self.board_replay:
+            stats['replay_errors'] = self.replay_errors
+            stats['setup_games'] = self.setup_games
+        return stats
+
+
+class BookBuilder:
+    """Collects repertoire entries for a binary book as they stream past
+    
+    add() takes the (position, [{'move', 'weight'}]) pairs of
+    iter_opening_repertoire one at a time, so the book can be filled
+    from the ranking that writes the database instead of ranking again;
+    write() sorts the records and writes the book.
+    """
+    
+    def __init__(self, window=OPENING_WINDOW):
+        self.window = window
+        self.move_ids = {}
+        self.records = []
+    
+    def add(self, position, moves):
+        """Add the moves of one position ('start' or space-separated moves)"""
+        key = 0 if position == 'start' else position_key(position.split(' '))
+        move_ids = self.move_ids
+        for entry in moves:
+            move_id = move_ids.setdefault(entry['move'], len(move_ids))
+            self.records.append((key, -entry['weight'], entry['move'], move_id, entry['weight']))
+    
+    def write(self, path):
+        """Write the book to path; returns the number of records"""
+        move_ids = self.move_ids
+        if len(move_ids) > 0xFFFF:
+            raise ValueError(f"binary book supports at most 65535 moves, got {len(move_ids)}")
+        records = sorted(self.records)
+        moves_offset = BOOK_HEADER.size + len(records) * BOOK_RECORD.size
+        
+        def write(f):
+            f.write(BOOK_HEADER.pack(BOOK_MAGIC, BOOK_VERSION, self.window, len(move_ids), len(records),
+                                     moves_offset))
+            for key, _, _, move_id, weight in records:
+                f.write(BOOK_RECORD.pack(key, move_id, round(weight * BOOK_WEIGHT_SCALE)))
+            for move in move_ids:
+                data = move.encode('utf-8')
+                f.write(bytes([len(data)]) + data)
+        
+        write_atomic(path, write)
+        return len(records)
+
+
+def write_binary_book(repertoire, path, window=OPENING_WINDOW):
+    """Write an opening repertoire as a sorted, fixed-width binary book
+    
+    repertoire maps position keys ('start' or space-separated moves) to
+    [{'move', 'weight'}] lists as produced by generate_opening_repertoire,
+    or is an iterable of such pairs. Use BinaryBook to query the result.
+    """
+    if hasattr(repertoire, 'items'):
+        repertoire = repertoire.items()
+    book = BookBuilder(window)
+    for position, moves in repertoire:
+        book.add(position, moves)
+    return book.write(path)
+
+
+class BinaryBook:
+    """Memory-mapped reader for books written by write_binary_book
+    
+    Only the header and the move strings are read up front; lookups
+    binary-search the records in place, so opening a book is nearly free
+    and processes on one host share its pages through the OS cache.
+    """
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.window, move_count, self.records, moves_offset = BOOK_HEADER.unpack_from(self._map, 0)
+        if magic != BOOK_MAGIC or version != BOOK_VERSION:
+            raise ValueError(f"{path} is not a version {BOOK_VERSION} binary book")
+        
+        self.moves = []
+        offset = moves_offset
+        for _ in range(move_count):
+            length = self._map[offset]
+            self.moves.append(self._map[offset + 1:offset + 1 + length].decode('utf-8'))
+            offset += 1 + length
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self._map.close()
+    
+    def _key_at(self, index):
+        return struct.unpack_from('<Q', self._map, BOOK_HEADER.size + index * BOOK_RECORD.size)[0]
+    
+    def lookup(self, key):
+        """[{'move', 'weight'}] stored for a position key, best move first"""
+        lo, hi = 0, self.records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        
+        result = []
+        offset = BOOK_HEADER.size + lo * BOOK_RECORD.size
+        for index in range(lo, self.records):
+            record_key, move_id, weight = BOOK_RECORD.unpack_from(self._map, offset)
+            if record_key != key:
+                break
+            result.append({'move': self.moves[move_id], 'weight': weight / BOOK_WEIGHT_SCALE})
+            offset += BOOK_RECORD.size
+        return result
+    
+    def top_moves(self, move_history, top_n=None):
+        """Book moves after a list of SAN moves played so far"""
+        key = position_key(move_history[-self.window:]) if move_history else 0
+        return self.lookup(key)[:top_n]
+
+
+def compile_corpus(filename, path, run_stats=None):
+    """Tokenize a PGN file once into a compiled corpus at path
+    
+    Holds the main line of every game parse_games would count (repeats
+    are not dropped, there are no tags to tell them by), as move ids
+    into the file's own move table, the FEN tags of games that start
+    from a set-up position, and the source file's size, modification
+    time and SHA-256 so load_corpus can tell when it is out of date.
+    Returns the number of games.
+    """
+    fingerprint = file_fingerprint(filename)
+    reader = PGNAnalyzer()
+    reader.run_stats = run_stats
+    ids = reader.moves.ids
+    intern = reader.moves.intern
+    names = reader.moves.names
+    plies = array('H')
+    offsets = array('Q', [0])
+    setups = []
+    for fen, moves in reader._iter_moves(iter_pgn_games(filename), setups=True):
+        if fen is not None:
+            setups.append((len(offsets) - 1, fen))
+        game = [ids[move] if move in ids else intern(move) for move in moves]
+        # Checked before the ids go into the uint16 array, which would overflow
+        if len(names) > 0xFFFF:
+            raise ValueError(f"compiled corpus supports at most 65535 moves, {filename} has more")
+        plies.extend(game)
+        offsets.append(len(plies))
+    if sys.byteorder != 'little':
+        plies.byteswap()
+        offsets.byteswap()
+    
+    def write(f):
+        f.write(CORPUS_HEADER.pack(CORPUS_MAGIC, CORPUS_VERSION, 0, len(names), len(offsets) - 1, len(plies),
+                                   fingerprint['size'], fingerprint['mtime_ns'], bytes.fromhex(fingerprint['sha256'])))
+        f.write(offsets.tobytes())
+        f.write(plies.tobytes())
+        for move in names:
+            data = move.encode('utf-8')
+            f.write(struct.pack('<H', len(data)) + data)
+        f.write(struct.pack('<Q', len(setups)))
+        for game, fen in setups:
+            data = fen.encode('utf-8')
+            f.write(struct.pack('<QH', game, len(data)) + data)
+    
+    write_atomic(path, write)
+    return len(offsets) - 1
+
+
+class Corpus:
+    """Memory-mapped reader for corpora written by compile_corpus
+    
+    The plies of game g are moves[offsets[g]:offsets[g + 1]], as ids into
+    names, and setups maps the games that start from a set-up position to
+    their FEN. Opening a corpus only reads the header, the move strings
+    and the FENs; iterating it yields every game as a list of SAN moves,
+    and arrays() gives the offsets and moves as NumPy views of the mapped
+    file.
+    """
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, move_count, self.games, self.plies,
+         self.size, self.mtime_ns, self.sha256) = CORPUS_HEADER.unpack_from(self._map, 0)
+        if magic != CORPUS_MAGIC or version != CORPUS_VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a version {CORPUS_VERSION} compiled corpus")
+        self._offsets_at = CORPUS_HEADER.size
+        self._moves_at = self._offsets_at + 8 * (self.games + 1)
+        
+        self.names = []
+        offset = self._moves_at + 2 * self.plies
+        for _ in range(move_count):
+            length, = struct.unpack_from('<H', self._map, offset)
+            self.names.append(self._map[offset + 2:offset + 2 + length].decode('utf-8'))
+            offset += 2 + length
+        self.setups = {}
+        count, = struct.unpack_from('<Q', self._map, offset)
+        offset += 8
+        for _ in range(count):
+            game, length = struct.unpack_from('<QH', self._map, offset)
+            self.setups[game] = self._map[offset + 10:offset + 10 + length].decode('utf-8')
+            offset += 10 + length
+    
+    def __len__(self):
+        return self.games
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self._map.close()
+    
+    def arrays(self):
+        """(offsets, moves) as NumPy arrays over the mapped file"""
+        offsets = np.frombuffer(self._map, dtype='<u8', count=self.games + 1, offset=self._offsets_at)
+        moves = np.frombuffer(self._map, dtype='<u2', count=self.plies, offset=self._moves_at)
+        return offsets, moves
+    
+    def __iter__(self):
+        names = self.names
+        offsets = array('Q', self._map[self._offsets_at:self._moves_at])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        for game in range(self.games):
+            start, end = self._moves_at + 2 * offsets[game], self._moves_at + 2 * offsets[game + 1]
+            plies = array('H', self._map[start:end])
+            if sys.byteorder != 'little':
+                plies.byteswap()
+            yield [names[move] for move in plies]
+
+
+def load_corpus(filename, cache_dir, run_stats=None):
+    """The compiled Corpus of a PGN file, compiled again only when the file has changed
+    
+    Corpora are kept in cache_dir under a hash of the file's path. One is
+    reused while the file's size and modification time match, or when
+    they changed but its SHA-256 did not.
+    """
+    path = Path(cache_dir) / f"{hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()}.corpus"
+    if path.exists():
+        try:
+            corpus = Corpus(path)
+        except (ValueError, struct.error):
+            corpus = None
+        if corpus is not None:
+            stat = os.stat(filename)
+            if corpus.size == stat.st_size and corpus.mtime_ns == stat.st_mtime_ns:
+                return corpus
+            if corpus.sha256.hex() == file_fingerprint(filename)['sha256']:
+                return corpus
+            corpus.close()
+            print(f"Changed: {filename}")
+    print(f"Compiling {filename}...")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    games = compile_corpus(filename, path, run_stats)
+    print(f"  Compiled {games} games to {path}")
+    return Corpus(path)
+
+
+def file_fingerprint(path, previous=None):
+    """Size, modification time and SHA-256 of a file for the build manifest
+    
+    The content hash is reused from the previous manifest entry when size
+    and modification time are unchanged.
+    """
+    stat = os.stat(path)
+    if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        digest = previous['sha256']
+    else:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+
+
+def write_database_json(path, metadata, repertoire, tactical_book):
+    """Stream the master database to a JSON file
+    
+    repertoire is an iterable of (position, moves) pairs. Entries are
+    written one per line as they are produced, so the full repertoire is
+    never held in memory. Returns the number of entries written.
+    """
+    def write(f):
+        nonlocal count
+        f.write('{\n"metadata": ' + json.dumps(metadata) + ',\n"opening_repertoire": {')
+        for position, moves in repertoire:
+            f.write(',\n' if count else '\n')
+            f.write(json.dumps(position) + ': ' + json.dumps(moves))
+            count += 1
+        f.write('\n},\n"tactical_book": ' + json.dumps(tactical_book) + '\n}\n')
+    
+    count = 0
+    write_atomic(path, write, 'w')
+    return count
+
+
+def write_database_ndjson(path, metadata, repertoire, tactical_book):
+    """Stream the master database as newline-delimited JSON
+    
+    The first line is {"type": "metadata", ...}; every repertoire position
+    follows as {"type": "opening", "position": ..., "moves": [...]} and
+    every tactical pattern as {"type": "tactic", "phase": ..., ...}, so the
+    file can be grepped, split or stream-read line by line. Returns the
+    number of repertoire lines written.
+    """
+    def write(f):
+        nonlocal count
+        f.write(json.dumps({'type': 'metadata', **metadata}) + '\n')
+        for position, moves in repertoire:
+            f.write(json.dumps({'type': 'opening', 'position': position, 'moves': moves}) + '\n')
+            count += 1
+        for phase, patterns in tactical_book.items():
+            for position, moves in patterns.items():
+                f.write(json.dumps({'type': 'tactic', 'phase': phase, 'position': position, 'moves': moves}) + '\n')
+    
+    count = 0
+    write_atomic(path, write, 'w')
+    return count
+
+
+def reservoir_sample(items, size, rng):
+    """Uniform sample of size items from an iterable, in one pass
+    
+    Returns (sample, items seen). This is Li's Algorithm L: once the
+    reservoir is full, the number of items to pass over before the next
+    replacement is drawn directly, so random numbers are only needed per
+    replacement, not per item.
+    """
+    if size <= 0:
+        return [], sum(1 for _ in items)
+    sample = []
+    seen = 0
+    skip = 0
+    w = 1.0
+    for item in items:
+        seen += 1
+        if seen <= size:
+            sample.append(item)
+            if seen < size:
+                continue
+        elif skip:
+            skip -= 1
+            continue
+        else:
+            sample[rng.randrange(size)] = item
+        w *= math.exp(math.log(1.0 - rng.random()) / size)
+        skip = int(math.log(1.0 - rng.random()) / math.log(1.0 - w)) if w < 1.0 else 0
+    return sample, seen
+
+
+def bernoulli_sample(items, fraction, rng):
+    """Keep each item with probability fraction; returns (sample, items seen)"""
+    sample = []
+    seen = 0
+    for item in items:
+        seen += 1
+        if rng.random() < fraction:
+            sample.append(item)
+    return sample, seen
+
+
+def compare_databases(repertoire, tactical_book, full_repertoire, full_tactical_book, top=200):
+    """How far a preview's top moves are from a full build's
+    
+    The first top positions of the full repertoire (its most played) are
+    looked up in the preview: coverage is the share found, and for those
+    found top_move_agreement is the share with the same first move,
+    top_moves_overlap the mean share of the full top moves also listed,
+    and weight_distance the mean total variation distance between the two
+    move weightings. Tactical book phases get the share of positions found
+    and the same first-move agreement.
+    """
+    positions = list(itertools.islice(full_repertoire, top))
+    found = [position for position in positions if position in repertoire]
+    agreement = overlap = distance = 0.0
+    for position in found:
+        full = {entry['move']: entry['weight'] for entry in full_repertoire[position]}
+        preview = {entry['move']: entry['weight'] for entry in repertoire[position]}
+        agreement += full_repertoire[position][0]['move'] == repertoire[position][0]['move']
+        overlap += len(full.keys() & preview.keys()) / len(full)
+        distance += sum(abs(full.get(move, 0.0) - preview.get(move, 0.0)) for move in full.keys() | preview.keys()) / 2
+    comparison = {
+        'repertoire': {
+            'positions_compared': len(positions),
+            'coverage': len(found) / len(positions) if positions else 0.0,
+            'top_move_agreement': agreement / len(found) if found else 0.0,
+            'top_moves_overlap': overlap / len(found) if found else 0.0,
+            'weight_distance': distance / len(found) if found else 0.0,
+        },
+        'tactical_book': {},
+    }
+    for phase, full_patterns in full_tactical_book.items():
+        patterns = tactical_book.get(phase, {})
+        common = [position for position in full_patterns if position in patterns]
+        same = sum(patterns[position][:1] == full_patterns[position][:1] for position in common)
+        comparison['tactical_book'][phase] = {
+            'positions_compared': len(full_patterns),
+            'coverage': len(common) / len(full_patterns) if full_patterns else 0.0,
+            'top_move_agreement': same / len(common) if common else 0.0,
+        }
+    return comparison
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def build_incremental(pgn_files, state_dir, jobs=1, run_stats=None, numpy_batch=0):
+    """Bring the saved counts in state_dir up to date with pgn_files
+    
+    state_dir holds manifest.json (path, size, content hash, weight and
+    game count of every input), the combined weighted counts and the
+    unweighted counts of each file. Only new or changed files are
+    parsed. The saved combined tables are updated in place: the counts
+    of removed files, and the old counts of changed or reweighted files,
+    are merged in with their old weight negated, those of new and changed
+    files with their weight, and entries left at zero are dropped, as are
+    the counts of files weighted 0. Reordering the files changes nothing.
+    The combined tables are re-summed from the per-file counts instead
+    when that reads less, or, without NumPy, when files went away or
+    changed. Files are parsed with run_stats, if given, and in NumPy
+    batches of numpy_batch games unless that is 0.
+    Returns (analyzer, total_games); like SourceCounts.reweighted, the
+    games of files weighted 0 are not part of the total.
+    """
+    run_stats = run_stats or RunStats(interval=0)
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = state_dir / 'manifest.json'
+    counts_path = state_dir / 'counts.pickle'
+    
+    previous = []
+    if manifest_path.exists() and counts_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == STATE_VERSION:
+            previous = manifest['files']
+    
+    def partial_path(entry):
+        return state_dir / f"{entry['sha256']}.counts.pickle"
+    
+    old_entries = {entry['path']: entry for entry in previous}
+    for entry in previous:
+        if entry['path'] not in {filename for filename, _, _ in pgn_files}:
+            print(f"Removed: {entry['path']} ({entry['games']} games)")
+    
+    entries = []
+    parsed = {}
+    for filename, player_name, weight in pgn_files:
+        old = old_entries.get(filename)
+        entry = {'path': filename, 'player': player_name, 'weight': weight}
+        entry.update(file_fingerprint(filename, old))
+        if old is not None and old['sha256'] == entry['sha256']:
+            entry['games'] = old['games']
+            run_stats.total_bytes -= entry['size']
+        else:
+            if old is not None:
+                print(f"Changed: {filename}")
+            partial = PGNAnalyzer()
+            partial.run_stats = run_stats
+            partial.numpy_batch = numpy_batch
+            if jobs > 1:
+                entry['games'] = partial.parse_pgn_files_parallel([(filename, player_name, UNIT_WEIGHT)], jobs)
+            else:
+                entry['games'] = partial.parse_pgn_file(filename, player_name, UNIT_WEIGHT)
+            counts = parsed[filename] = partial.export_counts()
+            write_atomic(partial_path(entry), lambda f: pickle.dump(counts, f, pickle.HIGHEST_PROTOCOL))
+        entries.append(entry)
+    
+    # What the saved combination has to lose and gain
+    def versions(files):
+        return {(e['path'], e['sha256'], e['weight']) for e in files}
+    
+    current, saved = versions(entries), versions(previous)
+    stale = [entry for entry in previous if (entry['path'], entry['sha256'], entry['weight']) not in current]
+    added = [entry for entry in entries if (entry['path'], entry['sha256'], entry['weight']) not in saved]
+    # Updating reads the counts of the stale and added files, re-summing
+    # those of every current file; file sizes stand in for their counts
+    update_size = sum(entry['size'] for entry in stale + added)
+    if (previous and (np is not None or not stale) and update_size <= sum(entry['size'] for entry in entries)
+            and all(partial_path(entry).exists() for entry in stale)):
+        analyzer = PGNAnalyzer.from_counts(_load_pickle(counts_path))
+        changes = [(entry, -weight_units(entry['weight'])) for entry in stale]
+    else:
+        analyzer = PGNAnalyzer()
+        stale = []
+        added = entries
+        changes = []
+    changes += [(entry, weight_units(entry['weight'])) for entry in added]
+    for entry, factor in changes:
+        if not factor:
+            continue
+        # Removals read the old counts; partial_path() follows the content
+        counts = (factor > 0 and parsed.get(entry['path'])) or _load_pickle(partial_path(entry))
+        with run_stats.stage('merge'):
+            analyzer.merge_counts(counts, factor)
+    if stale:
+        with run_stats.stage('merge'):
+            analyzer = _drop_zero_entries(analyzer)
+    
+    # Saved counts of files that are no longer referenced can go
+    live = {partial_path(entry) for entry in entries}
+    for entry in previous:
+        if partial_path(entry) not in live and partial_path(entry).exists():
+            partial_path(entry).unlink()
+    
+    counts = analyzer.export_counts()
+    write_atomic(counts_path, lambda f: pickle.dump(counts, f, pickle.HIGHEST_PROTOCOL))
+    manifest = {'version': STATE_VERSION, 'files': entries}
+    write_atomic(manifest_path, lambda f: f.write(json.dumps(manifest, indent=2).encode('utf-8')))
+    
+    return analyzer, sum(entry['games'] for entry in entries if weight_units(entry['weight']))
+
+
+class SourceCounts:
+    """Unweighted counts of every (position, move) per input file
+    
+    Files are parsed one after another at UNIT_WEIGHT into one analyzer,
+    and add() keeps how much each table entry grew while a file was read
+    as that file's column. save() writes the tables with one uint32
+    column per file, so reweighted() can rebuild the weighted tables for
+    any file weights without parsing again: the units of every entry are
+    the sum of its columns times the weights.
+    """
+    
+    def __init__(self, analyzer, sources=(), columns=None):
+        self.analyzer = analyzer
+        # {'path', 'player', 'weight', 'games'} of every file, in order
+        self.sources = list(sources)
+        self._columns = columns or ([], [], [])
+        self._previous = [np.zeros(0, dtype=np.int64)] * 3
+    
+    def add(self, filename, player, weight, games):
+        """Record the counts of the file just parsed into the analyzer"""
+        self.sources.append({'path': str(filename), 'player': player, 'weight': weight, 'games': games})
+        for phase, table in enumerate(self.analyzer.export_counts()):
+            # Entries are only appended, so earlier files' entries come first
+            current = np.array(table._units, dtype=np.int64)
+            column = current.copy()
+            column[:len(self._previous[phase])] -= self._previous[phase]
+            self._columns[phase].append(column)
+            self._previous[phase] = current
+    
+    def save(self, path):
+        """Save the unit-weight tables and the per-file columns
+        
+        The file is also a --from-npz input, giving the unweighted counts.
+        """
+        columns = {}
+        for phase, table, phase_columns in zip(('opening', 'middlegame', 'endgame'),
+                                               self.analyzer.export_counts(), self._columns):
+            counts = np.zeros((table.entries, len(phase_columns)), dtype=np.uint32)
+            for source, column in enumerate(phase_columns):
+                counts[:len(column), source] = column
+            columns[f'{phase}.sources'] = counts
+        games = sum(source['games'] for source in self.sources)
+        self.analyzer.save_npz(path, games, sources=np.array(json.dumps(self.sources)), **columns)
+    
+    @classmethod
+    def load(cls, path):
+        """Read a file written by save()"""
+        analyzer, _ = PGNAnalyzer.load_npz(path)
+        with np.load(path) as data:
+            if 'sources' not in data.files:
+                raise ValueError(f"{path} has no per-file counts")
+            sources = json.loads(str(data['sources']))
+            columns = tuple(list(data[f'{phase}.sources'].T) for phase in ('opening', 'middlegame', 'endgame'))
+        return cls(analyzer, sources, columns)
+    
+    def weights(self, overrides=None):
+        """Weight of every file, with overrides by path, file name or player
+        
+        A path override wins over a file name one, and that over a player
+        one. Names that match no file raise ValueError.
+        """
+        overrides = overrides or {}
+        names = set()
+        weights = []
+        for source in self.sources:
+            candidates = (source['path'], Path(source['path']).name, source['player'])
+            names.update(candidates)
+            weights.append(next((overrides[name] for name in candidates if name in overrides), source['weight']))
+        unknown = sorted(set(overrides) - names)
+        if unknown:
+            raise ValueError(f"no input file or player named {', '.join(map(repr, unknown))}")
+        return weights
+    
+    def reweighted(self, overrides=None):
+        """Return (analyzer, games) counted with the weights from weights(overrides)
+        
+        Moves only played in files weighted 0 are left out, as if those
+        files had not been parsed.
+        """
+        factors = [weight_units(weight) for weight in self.weights(overrides)]
+        counts = []
+        for table, columns in zip(self.analyzer.export_counts(), self._columns):
+            units = np.zeros(table.entries, dtype=np.int64)
+            for column, factor in zip(columns, factors):
+                if factor:
+                    units[:len(column)] += column.astype(np.int64) * factor
+            arrays = table.arrays()
+            arrays['units'] = units
+            if not units.all():
+                arrays = _drop_entries(arrays, units > 0)
+            counts.append(CountTable.from_arrays(arrays, table.moves, table.empty_label))
+        games = sum(source['games'] for source, factor in zip(self.sources, factors) if factor)
+        analyzer = self.analyzer
+        return PGNAnalyzer.from_counts(counts, analyzer.phase_plies, analyzer.windows), games
+
+
+class Checkpoint:
+    """Periodic snapshots of a serial build, which --resume continues from
+    
+    A snapshot holds the analyzer's counts (with its duplicate
+    fingerprints and sketch, when those are on), the number of games
+    counted and where reading stopped: the index of the current input
+    file and the byte offset of its next game. Snapshots are written
+    atomically, so a run killed at any point leaves the last one intact,
+    and one is only taken between games, when everything read so far has
+    been counted. Resuming from it gives the same counts as a run that
+    was never interrupted.
+    
+    options are the settings that change the counts; a snapshot is only
+    resumed with the same options and unchanged input files.
+    """
+    
+    def __init__(self, path, pgn_files, options, interval=CHECKPOINT_INTERVAL):
+        self.path = Path(path)
+        self.interval = interval
+        self.options = options
+        self.files = []
+        for filename, _, weight in pgn_files:
+            stat = os.stat(filename)
+            self.files.append((str(filename), weight, stat.st_size, stat.st_mtime_ns))
+        self.saves = 0
+        self._due = time.perf_counter() + interval
+    
+    def restore(self, analyzer):
+        """Load the snapshot into analyzer; return (file index, offset), or None without one"""
+        if not self.path.exists():
+            return None
+        saved = _load_pickle(self.path)
+        if saved.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"{self.path} is checkpoint version {saved.get('version')}, "
+                             f"expected {CHECKPOINT_VERSION}")
+        if saved['files'] != self.files:
+            raise ValueError(f"the input files have changed since {self.path} was saved")
+        if saved['options'] != self.options:
+            raise ValueError(f"{self.path} was saved with different options: {saved['options']}")
+        analyzer.opening_book, analyzer.middlegame_patterns, analyzer.endgame_patterns = saved['counts']
+        analyzer.moves = analyzer.opening_book.moves
+        analyzer.games_counted = saved['games']
+        analyzer.replay_errors = saved['replay_errors']
+        analyzer.setup_games = saved['setup_games']
+        analyzer.dedupe = saved['dedupe']
+        analyzer.sketch = saved['sketch']
+        if saved['sketch'] is not None:
+            analyzer.min_weight = saved['min_weight']
+        return saved['file'], saved['offset']
+    
+    def save(self, analyzer, file_index, offset):
+        """Snapshot analyzer with reading stopped before offset in the file_index-th file"""
+        saved = {
+            'version': CHECKPOINT_VERSION,
+            'files': self.files,
+            'options': self.options,
+            'file': file_index,
+            'offset': offset,
+            'games': analyzer.games_counted,
+            'replay_errors': analyzer.replay_errors,
+            'setup_games': analyzer.setup_games,
+            'counts': analyzer.export_counts(),
+            'dedupe': analyzer.dedupe,
+            'sketch': analyzer.sketch,
+            'min_weight': getattr(analyzer, 'min_weight', None),
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.path, lambda f: pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL))
+        self.saves += 1
+        self._due = time.perf_counter() + self.interval
+        print(f"  Checkpoint: {analyzer.games_counted} games counted, saved to {self.path}", flush=True)
+    
+    def games(self, analyzer, file_index, spans):
+        """Yield the texts of (offset, size, text) spans, saving a snapshot when one is due"""
+        for offset, _, game_text in spans:
+            # The previous game has been counted by the time the next is asked for
+            if time.perf_counter() >= self._due:
+                self.save(analyzer, file_index, offset)
+            yield game_text
+    
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+def analyzer_records(analyzer):
+    """Yield shard records (phase, key, window, [(move, units), ...]) of an analyzer
+    
+    Records come in (phase, key) order with moves sorted by name, the
+    order write_shard and merge_records expect.
+    """
+    tables = (analyzer.opening_book, analyzer.middlegame_patterns, analyzer.endgame_patterns)
+    names = analyzer.moves.names
+    for phase, table in enumerate(tables):
+        positions = dict(table.iter_positions())
+        for pos_id in sorted(positions, key=table.key):
+            moves = sorted((names[move_id], units) for move_id, units in positions[pos_id])
+            yield phase, table.key(pos_id), table.window(pos_id), moves
+
+
+def write_shard(path, records, games, moves, phase_plies=PHASE_PLIES, windows=PHASE_WINDOWS):
+    """Write shard records to a versioned binary file of raw counts
+    
+    records must be in (phase, key) order (see analyzer_records and
+    merge_records) and moves must include every move name they use;
+    phase_plies and windows are those the records were counted with.
+    Returns the number of positions written.
+    """
+    names = sorted(set(moves))
+    index = {name: i for i, name in enumerate(names)}
+    
+    def write(f):
+        nonlocal count
+        f.write(SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, 0, len(names), games, *phase_plies, *windows))
+        for name in names:
+            data = name.encode('utf-8')
+            f.write(struct.pack('<H', len(data)) + data)
+        for phase, key, window, position_moves in records:
+            f.write(SHARD_POSITION.pack(phase, key, len(window), len(position_moves)))
+            f.write(struct.pack(f'<{len(window)}I', *[index[m] for m in window]))
+            f.write(b''.join(SHARD_MOVE.pack(index[move], units) for move, units in position_moves))
+            count += 1
+        f.write(SHARD_POSITION.pack(SHARD_END, 0, 0, 0))
+    
+    count = 0
+    write_atomic(path, write)
+    return count
+
+
+class Shard:
+    """Streaming reader for a file written by write_shard
+    
+    games, moves, phase_plies and windows come from the header; iterating
+    yields the records in file order, reading one position at a time.
+    """
+    
+    def __init__(self, path):
+        self.path = str(path)
+        self._file = open(self.path, 'rb')
+        header = SHARD_HEADER.unpack(self._file.read(SHARD_HEADER.size))
+        magic, version, _, move_count, self.games = header[:5]
+        if magic != SHARD_MAGIC:
+            raise ValueError(f"{self.path} is not a count shard")
+        if version != SHARD_VERSION:
+            raise ValueError(f"{self.path} is shard version {version}, expected {SHARD_VERSION}")
+        self.phase_plies = header[5:7]
+        self.windows = header[7:]
+        self.moves = []
+        for _ in range(move_count):
+            length, = struct.unpack('<H', self._file.read(2))
+            self.moves.append(self._file.read(length).decode('utf-8'))
+    
+    def __iter__(self):
+        read = self._file.read
+        names = self.moves
+        while True:
+            phase, key, window_length, move_count = SHARD_POSITION.unpack(read(SHARD_POSITION.size))
+            if phase == SHARD_END:
+                return
+            window = [names[m] for m in struct.unpack(f'<{window_length}I', read(4 * window_length))]
+            moves = [(names[m], units) for m, units in SHARD_MOVE.iter_unpack(read(SHARD_MOVE.size * move_count))]
+            yield phase, key, window, moves
+    
+    def close(self):
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+def merge_records(streams):
+    """k-way merge of sorted record streams, summing the units of equal positions
+    
+    Integer units make the merge associative and commutative: any grouping
+    of shards gives the same records.
+    """
+    merged = heapq.merge(*streams, key=lambda record: (record[0], record[1]))
+    for (phase, key), group in itertools.groupby(merged, key=lambda record: (record[0], record[1])):
+        window = None
+        totals = {}
+        for _, _, window, moves in group:
+            for move, units in moves:
+                totals[move] = totals.get(move, 0) + units
+        yield phase, key, window, sorted(totals.items())
+
+
+def load_records(analyzer, records):
+    """Add shard records to an analyzer's tables"""
+    tables = (analyzer.opening_book, analyzer.middlegame_patterns, analyzer.endgame_patterns)
+    intern = analyzer.moves.intern
+    for phase, key, window, moves in records:
+        history = [intern(m) for m in window]
+        add = tables[phase].add
+        for move, units in moves:
+            add(key, intern(move), units, history, len(history), len(history))
+
+
+def _year_range(text):
+    """argparse type for 1950 or 1950-1990"""
+    first, _, last = text.partition('-')
+    if not first.isdigit() or not (last or first).isdigit():
+        raise argparse.ArgumentTypeError(f"expected a year or a range like 1950-1990, got {text!r}")
+    return int(first), int(last or first)
+
+
+def _eco_range(text):
+    """argparse type for B, B33 or B20-B99"""
+    first, _, last = text.upper().partition('-')
+    if len(first) == 1 and not last:
+        first, last = first + '00', first + '99'
+    codes = eco_code(first), eco_code(last or first)
+    if -1 in codes:
+        raise argparse.ArgumentTypeError(f"expected an ECO code, letter or range like B20-B99, got {text!r}")
+    return codes
+
+
+def _source_weight(text):
+    """argparse type for NAME=WEIGHT"""
+    name, _, weight = text.rpartition('=')
+    try:
+        value = float(weight)
+    except ValueError:
+        value = -1.0
+    if not name or value < 0:
+        raise argparse.ArgumentTypeError(f"expected NAME=WEIGHT, e.g. 'Paul Morphy=1.5', got {text!r}")
+    return name, value
+
+
+def _argument_parser():
+    parser = argparse.ArgumentParser(
+        description='Build the master pattern database from PGN files',
+        epilog='Without a command the database is built from the PGN files in /app.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='worker processes for parsing; large files are split at game boundaries (default: 1)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='reuse saved counts and only parse new or changed files')
+    parser.add_argument('--state-dir', default='/app/pgn_analyzer_state',
+                        help='where --incremental keeps its manifest and counts (default: %(default)s)')
+    parser.add_argument('--format', choices=['json', 'ndjson'], default='json',
+                        help='master database format: streamed JSON (master_database.json) or one '
+                             'position per line (master_database.ndjson) (default: %(default)s)')
+    parser.add_argument('--binary-book', metavar='PATH',
+                        help='also write the opening repertoire as a memory-mappable binary book')
+    parser.add_argument('--approximate', action='store_true',
+                        help='count through a count-min sketch and only keep moves whose weight '
+                             'reaches --min-weight (bounded memory, error bounds in the statistics)')
+    parser.add_argument('--sketch-mb', type=int, default=SKETCH_BUDGET >> 20,
+                        help='memory budget of the --approximate sketch in MiB (default: %(default)s)')
+    parser.add_argument('--min-weight', type=float, default=SKETCH_MIN_WEIGHT,
+                        help='weight a move needs from a position to be kept by --approximate '
+                             '(default: %(default)s)')
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help='keep the counts in a new SQLite database at PATH instead of in memory, '
+                             'and rank positions with SQL; the database can be queried afterwards')
+    parser.add_argument('--sqlite-batch', type=int, default=SQLITE_BATCH_SIZE,
+                        help='(position, move) increments buffered per --sqlite transaction '
+                             '(default: %(default)s)')
+    parser.add_argument('--sqlite-overwrite', action='store_true',
+                        help='replace the --sqlite database (and its -wal and -shm files) if PATH exists')
+    parser.add_argument('--dedupe', choices=['exact', 'bloom'],
+                        help='skip games already read from another file (same main line and players, '
+                             'date, round and result); bloom uses a fixed-size filter for huge corpora')
+    parser.add_argument('--bloom-capacity', type=int, default=BLOOM_CAPACITY,
+                        help='games the --dedupe bloom filter is sized for (default: %(default)s)')
+    parser.add_argument('--bloom-error', type=float, default=BLOOM_ERROR_RATE,
+                        help='false positive rate of the --dedupe bloom filter (default: %(default)s)')
+    parser.add_argument('--board', action='store_true',
+                        help='replay every game on a board and key positions by Zobrist hash, so move '
+                             'orders that transpose share one entry; positions are labeled by FEN')
+    parser.add_argument('--numpy', action=argparse.BooleanOptionalAction,
+                        help='count plies in NumPy batches: the same counts in about half the time, for a '
+                             'little more memory (default: on when numpy is installed, except with --board, '
+                             '--checkpoint and --approximate); --no-numpy counts ply by ply')
+    parser.add_argument('--numpy-batch', type=int, default=NUMPY_BATCH_GAMES, metavar='GAMES',
+                        help='games per --numpy batch (default: %(default)s)')
+    parser.add_argument('--npz', metavar='PATH',
+                        help='also save the aggregated counts as NumPy arrays for --from-npz')
+    parser.add_argument('--from-npz', metavar='PATH',
+                        help='generate the database from counts saved with --npz instead of parsing')
+    parser.add_argument('--sources', metavar='PATH',
+                        help='also save unweighted counts of every input file to PATH, so the reweight '
+                             'command can try other weights without parsing (needs numpy)')
+    parser.add_argument('--phases', type=int, nargs=2, default=[PHASE_PLIES[0] // 2, PHASE_PLIES[1] // 2],
+                        metavar=('MIDDLEGAME', 'ENDGAME'),
+                        help='moves after which the middlegame and the endgame start (default: 15 40); '
+                             'merge, reweight and --from-npz use those of their saved counts')
+    parser.add_argument('--windows', type=int, nargs=3, default=list(PHASE_WINDOWS),
+                        metavar=('OPENING', 'MIDDLEGAME', 'ENDGAME'),
+                        help='moves in the position key of each phase (default: 8 6 4); '
+                             'database_reader.py expects the defaults')
+    parser.add_argument('--corpus', action='store_true',
+                        help='count from compiled corpora of the input files instead of parsing their text; '
+                             'a file is compiled into --corpus-dir the first time and again when it changes')
+    parser.add_argument('--corpus-dir', default='/app/pgn_analyzer_state/corpus',
+                        help='where compiled corpora are kept (default: %(default)s)')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_READERS, metavar='THREADS',
+                        help='reader threads that read and decompress the next files while one is '
+                             'parsed, 0 to read inline (default: %(default)s)')
+    parser.add_argument('--checkpoint', metavar='PATH',
+                        help='save the counts and the read position to PATH every --checkpoint-interval '
+                             'seconds, so an interrupted build can be continued with --resume')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL, metavar='SECONDS',
+                        help='seconds between checkpoints (default: %(default)s)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the checkpoint at --checkpoint; the result is the same as '
+                             'an uninterrupted build')
+    preview = parser.add_argument_group(
+        'preview', 'build from a random sample of each file and compare it with the last full build, '
+                   'writing master_database_preview.json instead of the database')
+    sample_size = preview.add_mutually_exclusive_group()
+    sample_size.add_argument('--preview', type=int, metavar='GAMES',
+                             help='sample this many games per file (reservoir sampling)')
+    sample_size.add_argument('--preview-fraction', type=float, metavar='FRACTION',
+                             help='sample this fraction of the games of every file')
+    preview.add_argument('--preview-seed', type=int, default=0, help='sampling random seed (default: %(default)s)')
+    parser.add_argument('--progress', type=float, default=10.0, metavar='SECONDS',
+                        help='print games/s, ETA and RSS this often while parsing, 0 to disable '
+                             '(default: %(default)s)')
+    parser.add_argument('--profile', action='store_true',
+                        help='also time the read, tokenize and count steps of every game')
+    filters = parser.add_argument_group(
+        'game filters', 'only count matching games; each file gets a cached tag index of byte offsets, '
+                        'so rebuilds read just those games')
+    filters.add_argument('--player', help='either player\'s name contains this (case-insensitive)')
+    filters.add_argument('--years', type=_year_range, metavar='RANGE', help='a year or range, e.g. 1950-1990')
+    filters.add_argument('--min-elo', type=int, metavar='ELO', help='both players rated at least this')
+    filters.add_argument('--eco', type=_eco_range, metavar='RANGE',
+                         help='an ECO code, letter or range, e.g. B20-B99')
+    filters.add_argument('--tag-dir', default='/app/pgn_analyzer_state/tags',
+                         help='where tag indexes are cached (default: %(default)s)')
+    parser.add_argument('--shard', metavar='PATH',
+                        help='write the raw weighted counts to a shard file at PATH instead of '
+                             'generating the database (see the merge command)')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    merge_parser = commands.add_parser(
+        'merge', help='combine count shards and generate the database from the result',
+        description='Combine count shards with a streaming k-way merge. The database options '
+                    '(--format, --binary-book, --sqlite, --shard) go before the command.')
+    merge_parser.add_argument('shards', nargs='+', metavar='SHARD', help='shard files written with --shard')
+    commands.add_parser(
+        'compile', help='compile the input files into --corpus-dir for --corpus, without building',
+        description='Tokenize every input file once into a compiled corpus (move ids, game offsets and the '
+                    'file\'s hash); files whose corpus is up to date are skipped.')
+    reweight_parser = commands.add_parser(
+        'reweight', help='generate the database from per-file counts saved with --sources, with new weights',
+        description='Recombine per-file counts saved with --sources using new file weights, without parsing. '
+                    'The database options (--format, --binary-book, --npz, --shard) go before the command.')
+    reweight_parser.add_argument('counts', metavar='SOURCES', help='per-file counts written with --sources')
+    reweight_parser.add_argument('--weight', type=_source_weight, action='append', default=[],
+                                 metavar='NAME=WEIGHT',
+                                 help='new weight for a file (path or file name) or for all files of a '
+                                      'player; 0 leaves them out; may be repeated')
+    return parser
+
+
+# Options that cannot be used together, checked by _check_options(). The
+# names are attributes of the parsed arguments (in use when true), the
+# commands, 'jobs' (more than one), 'preview' (either sample size),
+# 'filters' (any game filter) and 'phases' (other --phases or --windows
+# than the defaults).
+OPTION_CONFLICTS = [
+    # Pairs below the threshold are dropped, so per-file or per-chunk
+    # counts could not be combined into the same result
+    ('approximate', ('incremental', 'jobs')),
+    ('sqlite', ('incremental', 'approximate')),
+    # Shards hold exact in-memory counts
+    ('shard', ('sqlite', 'approximate')),
+    ('merge', ('approximate', 'incremental')),
+    # Files and chunks are counted separately there, so a repeat could
+    # not be recognized before it is counted
+    ('dedupe', ('incremental', 'jobs', 'merge', 'from_npz')),
+    ('preview', ('incremental', 'jobs', 'merge', 'from_npz', 'checkpoint', 'shard', 'npz')),
+    # Those keep positions as move windows, or count them in a sketch
+    ('board', ('incremental', 'merge', 'reweight', 'compile', 'from_npz', 'shard', 'npz', 'sqlite', 'numpy',
+               'binary_book', 'sources', 'approximate')),
+    # Columns are taken between files of one serial, exact build
+    ('sources', ('incremental', 'jobs', 'merge', 'reweight', 'compile', 'from_npz', 'approximate', 'sqlite',
+                 'checkpoint', 'preview')),
+    # The counts were taken when --sources was saved
+    ('reweight', ('incremental', 'jobs', 'from_npz', 'approximate', 'sqlite', 'dedupe', 'checkpoint', 'preview')),
+    # Incremental state is counted with the default phases; merge, reweight
+    # and --from-npz take those of their inputs instead (see _input_phases)
+    ('phases', ('incremental', 'compile')),
+    # A corpus has no tags and no byte offsets, only the moves
+    ('corpus', ('incremental', 'jobs', 'merge', 'reweight', 'compile', 'from_npz', 'dedupe', 'checkpoint',
+                'preview')),
+    # Snapshots need every game read so far to be counted in memory
+    ('checkpoint', ('incremental', 'jobs', 'merge', 'from_npz', 'sqlite', 'numpy')),
+    ('npz', ('sqlite', 'merge')),
+    ('from_npz', ('merge', 'reweight', 'compile', 'incremental', 'jobs', 'approximate', 'sqlite')),
+    ('filters', ('incremental', 'jobs', 'merge', 'reweight', 'compile', 'from_npz', 'checkpoint', 'preview',
+                 'corpus')),
+]
+_OPTION_LABELS = {'merge': 'merge', 'reweight': 'reweight', 'compile': 'compile', 'filters': 'game filters',
+                  'phases': '--phases and --windows'}
+GAME_FILTERS = ('player', 'years', 'min_elo', 'eco')
+
+
+def _check_options(parser, args):
+    """Stop with a usage error unless the options can be used together
+    
+    Returns the names of the OPTION_CONFLICTS entries in use.
+    """
+    if not 0 < args.phases[0] <= args.phases[1]:
+        parser.error('--phases needs 0 < MIDDLEGAME <= ENDGAME')
+    used = {name for name in ('incremental', 'approximate', 'sqlite', 'shard', 'dedupe', 'board', 'numpy', 'npz',
+                              'from_npz', 'sources', 'corpus', 'checkpoint', 'binary_book') if getattr(args, name)}
+    if args.jobs > 1:
+        used.add('jobs')
+    if args.command:
+        used.add(args.command)
+    if args.preview is not None or args.preview_fraction is not None:
+        used.add('preview')
+    if any(getattr(args, name) is not None for name in GAME_FILTERS):
+        used.add('filters')
+    if (2 * args.phases[0], 2 * args.phases[1]) != PHASE_PLIES or tuple(args.windows) != PHASE_WINDOWS:
+        used.add('phases')
+    
+    def label(name):
+        return _OPTION_LABELS.get(name, '--' + name.replace('_', '-'))
+    
+    for name, conflicts in OPTION_CONFLICTS:
+        clashes = [label(other) for other in conflicts if other in used]
+        if name in used and clashes:
+            parser.error(f"{label(name)} cannot be combined with {', '.join(clashes)}")
+    
+    if args.sqlite_overwrite and not args.sqlite:
+        parser.error('--sqlite-overwrite needs --sqlite PATH')
+    if args.sqlite and os.path.exists(args.sqlite) and not args.sqlite_overwrite:
+        parser.error(f'--sqlite: {args.sqlite} exists; pass --sqlite-overwrite to replace it')
+    if args.resume and not args.checkpoint:
+        parser.error('--resume needs --checkpoint PATH')
+    if used & {'numpy', 'npz', 'from_npz', 'sources', 'reweight'} and np is None:
+        parser.error('--numpy, --npz, --from-npz, --sources and reweight need the numpy package')
+    return used
+
+
+def _input_phases(parser, args, used):
+    """(phase_plies, windows) to count with: those of the saved counts read, or else the flags
+    
+    Counts saved by merge shards, reweight sources and --from-npz files
+    were keyed with the phases they were parsed with, so those are used.
+    They must agree with each other, and with --phases and --windows when
+    those are given.
+    """
+    flags = (2 * args.phases[0], 2 * args.phases[1]), tuple(args.windows)
+    if args.command == 'merge':
+        saved = {}
+        for path in args.shards:
+            with Shard(path) as shard:
+                saved[path] = shard.phase_plies, shard.windows
+    elif args.command == 'reweight':
+        saved = {args.counts: PGNAnalyzer.npz_phases(args.counts)}
+    elif args.from_npz:
+        saved = {args.from_npz: PGNAnalyzer.npz_phases(args.from_npz)}
+    else:
+        return flags
+    
+    def describe(phases):
+        (middlegame, endgame), windows = phases
+        return f"phases at plies {middlegame} and {endgame} and windows {' '.join(map(str, windows))}"
+    
+    phases = next(iter(saved.values()))
+    if len(set(saved.values())) > 1:
+        parser.error('inputs were counted with different phases: ' +
+                     ', '.join(f"{path} with {describe(path_phases)}" for path, path_phases in saved.items()))
+    if 'phases' in used and phases != flags:
+        parser.error(f"{', '.join(saved)} counted with {describe(phases)}, but --phases and --windows "
+                     f"give {describe(flags)}")
+    return phases
 
 
-def main():
-    analyzer = PGNAnalyzer()
+def main(argv=None):
+    parser = _argument_parser()
+    args = parser.parse_args(argv)
+    used = _check_options(parser, args)
+    previewing = 'preview' in used
+    game_filters = {name: getattr(args, name) for name in GAME_FILTERS if getattr(args, name) is not None}
+    phase_plies, windows = _input_phases(parser, args, used)
+    
+    try:
+        analyzer = PGNAnalyzer(phase_plies, windows)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if args.approximate:
+        analyzer.enable_sketch(args.sketch_mb << 20, args.min_weight)
+    if args.sqlite:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.sqlite + suffix):
+                os.remove(args.sqlite + suffix)
+        analyzer.use_sqlite(args.sqlite, args.sqlite_batch)
+    if args.numpy is None:
+        # Batches are the default wherever they count exactly like plies
+        args.numpy = np is not None and not (args.board or args.checkpoint or args.approximate)
+    if args.numpy:
+        analyzer.enable_numpy(args.numpy_batch)
+    if args.board:
+        analyzer.enable_board()
+    if args.dedupe:
+        analyzer.enable_dedupe(args.dedupe, args.bloom_capacity, args.bloom_error)
+    
+    if args.command == 'merge':
+        merge_shards(analyzer, args)
+        return
+    if args.command == 'reweight':
+        reweight_sources(parser, args)
+        return
     
     # Parse all PGN files with appropriate weights
     # AlphaZero gets highest weight for brilliant play
@@ -160,22 +3625,245 @@ def main():
         ('Morphy.pgn', 'Paul Morphy', 2.2),
     ]
     
+    # Each file may also be present compressed, e.g. Fischer.pgn.gz
+    pgn_files = [
+        (find_pgn(Path('/app') / filename), player, weight)
+        for filename, player, weight in pgn_files
+        if find_pgn(Path('/app') / filename)
+    ]
+    
+    if args.command == 'compile':
+        for filepath, _, _ in pgn_files:
+            load_corpus(filepath, args.corpus_dir, RunStats(pgn_size(filepath) or 0, args.progress)).close()
+        return
+    
+    # ETA needs every uncompressed size
+    sizes = [pgn_size(path) for path, _, _ in pgn_files]
+    total_bytes = sum(sizes) if None not in sizes else 0
+    checkpoint = None
+    first_file, start = 0, 0
+    if args.checkpoint:
+        options = {name: getattr(args, name) for name in
+                   ('dedupe', 'bloom_capacity', 'bloom_error', 'approximate', 'sketch_mb', 'min_weight', 'board',
+                    'phases', 'windows')}
+        checkpoint = Checkpoint(args.checkpoint, pgn_files, options, args.checkpoint_interval)
+        if args.resume:
+            try:
+                resumed = checkpoint.restore(analyzer)
+            except ValueError as exc:
+                parser.error(f"cannot resume: {exc}")
+            if resumed is None:
+                print(f"No checkpoint at {args.checkpoint}, starting from the beginning")
+            else:
+                first_file, start = resumed
+                print(f"Resuming from {args.checkpoint}: {analyzer.games_counted} games counted, "
+                      f"file {first_file + 1} of {len(pgn_files)} at byte {start}")
+    
+    run_stats = RunStats(total_bytes, args.progress, args.profile)
+    analyzer.run_stats = run_stats
+    # Files are counted at unit weight and weighted from the saved columns
+    sources = SourceCounts(analyzer) if args.sources else None
+    
     total_games = 0
-    for filename, player, weight in pgn_files:
-        filepath = Path('/app') / filename
-        if filepath.exists():
-            games = analyzer.parse_pgn_file(str(filepath), player, weight)
-            total_games += games
+    with run_stats.stage('parse'):
+        if args.from_npz:
+            print(f"Loading counts from {args.from_npz}...")
+            analyzer, total_games = PGNAnalyzer.load_npz(args.from_npz)
+        elif previewing:
+            rng = random.Random(args.preview_seed)
+            sampling = {}
+            for filepath, player, weight in pgn_files:
+                games = iter_pgn_games(filepath)
+                if args.preview is not None:
+                    sample, seen = reservoir_sample(games, args.preview, rng)
+                else:
+                    sample, seen = bernoulli_sample(games, args.preview_fraction, rng)
+                # Scaling the weight up by the sampling rate keeps each
+                # file's share of the total weight
+                scale = seen / len(sample) if sample else 0.0
+                counted = analyzer.parse_games(sample, weight * scale, filepath)
+                print(f"Sampled {len(sample)} of {seen} games from {filepath} for {player} ({counted} counted)")
+                sampling[str(filepath)] = {'games': seen, 'sampled': len(sample), 'counted': counted}
+                total_games += counted
+        elif game_filters:
+            for filepath, player, weight in pgn_files:
+                with run_stats.stage('index'):
+                    index = load_tag_index(filepath, args.tag_dir)
+                spans = index.select(**game_filters)
+                print(f"Parsing {len(spans)} of {len(index)} games in {filepath} for {player}...")
+                if sources is not None:
+                    counted = analyzer.parse_games(read_pgn_games(filepath, spans), UNIT_WEIGHT, filepath)
+                    sources.add(filepath, player, weight, counted)
+                else:
+                    counted = analyzer.parse_games(read_pgn_games(filepath, spans), weight, filepath)
+                total_games += counted
+                if analyzer.dedupe is not None:
+                    print(f"  Skipped {analyzer.dedupe.dropped[str(filepath)]} duplicate games")
+        elif args.incremental:
+            analyzer, total_games = build_incremental(pgn_files, args.state_dir, args.jobs, run_stats,
+                                                      analyzer.numpy_batch)
+        elif args.jobs > 1:
+            print(f"Parsing {len(pgn_files)} files with {args.jobs} worker processes...")
+            total_games = analyzer.parse_pgn_files_parallel(pgn_files, args.jobs)
+        elif args.corpus:
+            # Compiling keeps its own progress, apart from the counting
+            run_stats.total_bytes = 0
+            for filepath, player, weight in pgn_files:
+                with run_stats.stage('compile'):
+                    corpus = load_corpus(filepath, args.corpus_dir, RunStats(pgn_size(filepath) or 0, args.progress))
+                with corpus:
+                    counted = analyzer.parse_corpus(corpus, UNIT_WEIGHT if sources is not None else weight)
+                print(f"Counted {counted} games of {filepath} for {player} from its compiled corpus")
+                if sources is not None:
+                    sources.add(filepath, player, weight, counted)
+                total_games += counted
+        else:
+            # Files before first_file were counted before the checkpoint
+            # was saved, and first_file is resumed at start
+            remaining = pgn_files[first_file:]
+            prefetcher = None
+            if args.prefetch > 0:
+                prefetcher = Prefetcher([path for path, _, _ in remaining], args.prefetch,
+                                        starts={remaining[0][0]: start} if remaining else None)
+                run_stats.prefetch = prefetcher
+            try:
+                for index, (filepath, player, weight) in enumerate(remaining, first_file):
+                    if prefetcher is not None:
+                        spans = prefetcher.spans(filepath)
+                    else:
+                        spans = iter_pgn_game_spans(filepath, start if index == first_file else 0)
+                    if checkpoint is not None:
+                        games = checkpoint.games(analyzer, index, spans)
+                    else:
+                        games = (game_text for _, _, game_text in spans)
+                    if sources is not None:
+                        sources.add(filepath, player, weight,
+                                    analyzer.parse_pgn_file(filepath, player, UNIT_WEIGHT, games))
+                    else:
+                        analyzer.parse_pgn_file(filepath, player, weight, games)
+            finally:
+                if prefetcher is not None:
+                    prefetcher.close()
+            total_games = analyzer.games_counted
+            if checkpoint is not None:
+                checkpoint.save(analyzer, len(pgn_files), 0)
+    
+    if previewing:
+        write_preview(analyzer, total_games, args, run_stats, sampling)
+        return
+    if sources is not None:
+        sources.save(args.sources)
+        print(f"\nSaved per-file counts of {total_games} games to {args.sources}")
+        dedupe = analyzer.dedupe
+        with run_stats.stage('reweight'):
+            analyzer, total_games = sources.reweighted()
+        analyzer.dedupe = dedupe
+    if args.npz:
+        analyzer.save_npz(args.npz, total_games)
+        print(f"\nSaved counts of {total_games} games to {args.npz}")
+    if args.shard:
+        positions = write_shard(args.shard, analyzer_records(analyzer), total_games, analyzer.moves.names,
+                                analyzer.phase_plies, analyzer.windows)
+        print(f"\nSaved counts of {total_games} games ({positions} positions) to {args.shard}")
+    else:
+        write_outputs(analyzer, total_games, args, run_stats)
+    # The run is complete, so there is nothing left to resume
+    if checkpoint is not None:
+        checkpoint.remove()
+
+
+def merge_shards(analyzer, args):
+    """The merge command: combine count shards into a shard or the database"""
+    shards = [Shard(path) for path in args.shards]
+    total_games = sum(shard.games for shard in shards)
+    print(f"Merging {len(shards)} shards ({total_games} games)...")
+    records = merge_records(shards)
+    if args.shard:
+        moves = set().union(*(shard.moves for shard in shards))
+        positions = write_shard(args.shard, records, total_games, moves, analyzer.phase_plies, analyzer.windows)
+        print(f"Saved merged shard ({positions} positions) to {args.shard}")
+    else:
+        run_stats = RunStats(interval=0)
+        with run_stats.stage('merge'):
+            load_records(analyzer, records)
+        write_outputs(analyzer, total_games, args, run_stats)
+    for shard in shards:
+        shard.close()
+
+
+def reweight_sources(parser, args):
+    """The reweight command: recombine counts saved with --sources with new weights"""
+    run_stats = RunStats(interval=0)
+    with run_stats.stage('load'):
+        sources = SourceCounts.load(args.counts)
+    overrides = dict(args.weight)
+    try:
+        weights = sources.weights(overrides)
+    except ValueError as exc:
+        parser.error(str(exc))
+    print(f"Reweighting {len(sources.sources)} files from {args.counts}:")
+    for source, weight in zip(sources.sources, weights):
+        changed = f" (was {source['weight']})" if weight != source['weight'] else ''
+        print(f"  {source['path']} ({source['player']}, {source['games']} games): {weight}{changed}")
+    with run_stats.stage('reweight'):
+        analyzer, total_games = sources.reweighted(overrides)
+    if args.npz:
+        analyzer.save_npz(args.npz, total_games)
+        print(f"\nSaved counts of {total_games} games to {args.npz}")
+    if args.shard:
+        positions = write_shard(args.shard, analyzer_records(analyzer), total_games, analyzer.moves.names,
+                                analyzer.phase_plies, analyzer.windows)
+        print(f"\nSaved counts of {total_games} games ({positions} positions) to {args.shard}")
+    else:
+        write_outputs(analyzer, total_games, args, run_stats)
+
+
+def write_preview(analyzer, total_games, args, run_stats, sampling):
+    """Save a sampled build for main() and report how it differs from the last full build"""
+    with run_stats.stage('tactical_book'):
+        tactical_book = analyzer.generate_tactical_book()
+    with run_stats.stage('repertoire'):
+        repertoire = analyzer.generate_opening_repertoire(top_n=5)
+    metadata = {
+        'total_games': total_games,
+        'preview': {'seed': args.preview_seed, 'files': sampling},
+        'phase_plies': list(analyzer.phase_plies),
+        'windows': list(analyzer.windows),
+        'statistics': analyzer.get_statistics(),
+    }
+    
+    builds = [path for path in ('/app/master_database.json', '/app/master_database.ndjson') if os.path.exists(path)]
+    if builds:
+        full_build = max(builds, key=os.path.getmtime)
+        with run_stats.stage('compare'):
+            comparison = compare_databases(repertoire, tactical_book, *load_database(full_build)[:2])
+        metadata['comparison'] = {'database': Path(full_build).name, **comparison}
+        openings = comparison['repertoire']
+        print(f"\nPreview vs {Path(full_build).name} (its {openings['positions_compared']} most played positions):")
+        print(f"  Opening coverage {openings['coverage']:.1%}, same top move {openings['top_move_agreement']:.1%}, "
+              f"top moves overlap {openings['top_moves_overlap']:.1%}, "
+              f"weight distance {openings['weight_distance']:.3f}")
+        for phase, patterns in comparison['tactical_book'].items():
+            if not patterns['positions_compared']:
+                continue
+            print(f"  Tactical {phase}: coverage {patterns['coverage']:.1%}, "
+                  f"same top move {patterns['top_move_agreement']:.1%}")
+    else:
+        print("\nNo full build (master_database.json) to compare with")
     
+    write_database_json('/app/master_database_preview.json', metadata, repertoire.items(), tactical_book)
+    print(f"\nSaved preview of {total_games} games to master_database_preview.json "
+          f"({run_stats.report()['wall_seconds']:.1f}s)")
+
+
+def write_outputs(analyzer, total_games, args, run_stats):
+    """Generate and save the master database and its companions for main()"""
     print(f"\n{'='*60}")
     print(f"Total games analyzed: {total_games}")
     
-    # Generate databases
-    print("\nGenerating opening repertoire...")
-    opening_repertoire = analyzer.generate_opening_repertoire(top_n=5)
-    
-    print("Generating tactical patterns...")
-    tactical_book = analyzer.generate_tactical_book()
+    print("\nGenerating tactical patterns...")
+    with run_stats.stage('tactical_book'):
+        tactical_book = analyzer.generate_tactical_book()
     
     stats = analyzer.get_statistics()
     print(f"\nDatabase Statistics:")
@@ -183,34 +3871,84 @@ def main():
     print(f"  Middlegame positions: {stats['middlegame_positions']}")
     print(f"  Endgame positions: {stats['endgame_positions']}")
     print(f"  Total unique positions: {stats['total_positions']}")
+    if 'duplicates' in stats:
+        print(f"  Duplicate games skipped: {stats['duplicates']['games_dropped']}")
+    if 'approximate' in stats:
+        bounds = stats['approximate']
+        print(f"  Approximate counts: moves below weight {bounds['min_weight']} dropped; kept weights "
+              f"overstated by at most {bounds['max_overcount']:.3f} with probability {1 - bounds['delta']:.3f} "
+              f"({bounds['sketch_bytes'] >> 20} MiB sketch, epsilon={bounds['epsilon']:.2e})")
     
-    # Save to JSON
-    output = {
-        'metadata': {
-            'total_games': total_games,
-            'masters': ['AlphaZero', 'Bobby Fischer', 'Anatoly Karpov', 'Magnus Carlsen', 'Paul Morphy'],
-            'statistics': stats
-        },
-        'opening_repertoire': opening_repertoire,
-        'tactical_book': tactical_book
+    metadata = {
+        'total_games': total_games,
+        'masters': ['AlphaZero', 'Bobby Fischer', 'Anatoly Karpov', 'Magnus Carlsen', 'Paul Morphy'],
+        # How position keys were made, for readers such as database_reader
+        'phase_plies': list(analyzer.phase_plies),
+        'windows': list(analyzer.windows),
+        'statistics': stats
     }
     
-    print("\nSaving master database...")
-    with open('/app/master_database.json', 'w') as f:
-        json.dump(output, f, indent=2)
+    # The repertoire is generated while it is written; the first 200
+    # entries are kept for the compact version, and all of them go into
+    # the binary book
+    compact_openings = {}
+    book = BookBuilder(analyzer.windows[0]) if args.binary_book else None
+    
+    def opening_repertoire():
+        ranked = iter(analyzer.iter_opening_repertoire(top_n=5))
+        while True:
+            with run_stats.stage('repertoire'):
+                entry = next(ranked, None)
+            if entry is None:
+                return
+            position, moves = entry
+            if len(compact_openings) < 200:
+                compact_openings[position] = moves
+            if book is not None:
+                book.add(position, moves)
+            yield position, moves
+    
+    print("\nGenerating and saving master database...")
+    with run_stats.stage('write_database'):
+        if args.format == 'ndjson':
+            database_path = '/app/master_database.ndjson'
+            entries = write_database_ndjson(database_path, metadata, opening_repertoire(), tactical_book)
+        else:
+            database_path = '/app/master_database.json'
+            entries = write_database_json(database_path, metadata, opening_repertoire(), tactical_book)
+    # The repertoire is generated while the database is written
+    run_stats.timers['write_database'] -= run_stats.timers['repertoire']
+    print(f"  Opening repertoire: {entries} positions")
     
     # Create compact version for embedding
     compact_output = {
-        'openings': {k: v for k, v in list(opening_repertoire.items())[:200]},
+        'openings': compact_openings,
         'tactics': tactical_book
     }
     
     with open('/app/master_database_compact.json', 'w') as f:
         json.dump(compact_output, f, separators=(',', ':'))
     
+    if book is not None:
+        records = book.write(args.binary_book)
+        print(f"Saved binary book ({records} moves) to {args.binary_book}")
+    
+    if args.sqlite:
+        analyzer.store.close()
+        print(f"Saved counts to {args.sqlite}")
+    
+    report = run_stats.report()
+    report.update(total_games=total_games, statistics=stats, database=Path(database_path).name)
+    write_atomic('/app/master_database_stats.json', lambda f: json.dump(report, f, indent=2), 'w')
+    print(f"\nRun statistics ({report['wall_seconds']:.1f}s, {report['games_per_second']:.0f} games/s, "
+          f"peak RSS {report['peak_rss_bytes'] >> 20} MiB):")
+    for stage, seconds in report['stages'].items():
+        print(f"  {stage}: {seconds:.2f}s")
+    
     print("\n✅ Master database generated successfully!")
-    print(f"   - Full database: master_database.json")
+    print(f"   - Full database: {Path(database_path).name}")
     print(f"   - Compact database: master_database_compact.json")
+    print(f"   - Run statistics: master_database_stats.json")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+PGN Benchmark - Time the analyzer on synthetic PGN corpora
+Generates well-formed games with comments, NAGs and nested variations,
+times each PGNAnalyzer stage and reports the results as JSON
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from pgn_analyzer import (Board, Corpus, PGNAnalyzer, WEIGHT_SCALE, build_incremental, compile_corpus,
+                          current_rss, iter_pgn_games, peak_rss, tokenize_movetext, write_database_json)
+
+# Bump when the corpus generator changes, so cached corpora are not reused
+CORPUS_VERSION = 1
+
+PLAYERS = ['Carlsen, Magnus', 'Fischer, Robert James', 'Karpov, Anatoly', 'Morphy, Paul',
+           'Anand, Viswanathan', 'Kasparov, Garry', 'Tal, Mikhail', 'Capablanca, Jose Raul']
+RESULTS = ['1-0', '0-1', '1/2-1/2']
+COMMENTS = ['the only move', 'threatening mate (but not for long)', 'an improvement over the game',
+            'White is better', 'a typical idea in this structure', 'time trouble']
+
+
+def _vocabulary():
+    """SAN-shaped move strings: pawn moves, piece moves and captures, castling"""
+    files = 'abcdefgh'
+    moves = ['O-O', 'O-O-O']
+    for f in files:
+        for rank in '345678':
+            moves.append(f + rank)
+    for i, f in enumerate(files):
+        for g in files[max(0, i - 1):i + 2:2]:
+            for rank in '3456':
+                moves.append(f + 'x' + g + rank)
+    for piece in 'NBRQK':
+        for f in files:
+            for rank in '12345678':
+                moves.append(piece + f + rank)
+                moves.append(piece + 'x' + f + rank)
+    return moves
+
+
+def _number(ply, tokens, resume):
+    """Append the move number before a move if one is due"""
+    if ply % 2 == 0:
+        tokens.append(f'{ply // 2 + 1}.')
+    elif resume:
+        tokens.append(f'{ply // 2 + 1}...')
+
+
+def _variation(rng, vocab, ply, depth):
+    """Tokens of a side line starting at ply, possibly with nested lines"""
+    tokens = []
+    resume = True
+    for p in range(ply, ply + rng.randint(1, 5)):
+        _number(p, tokens, resume)
+        tokens.append(rng.choice(vocab))
+        resume = False
+        if depth < 3 and rng.random() < 0.15:
+            tokens += ['('] + _variation(rng, vocab, p, depth + 1) + [')']
+            resume = True
+        if rng.random() < 0.1:
+            tokens.append('{ ' + rng.choice(COMMENTS) + ' }')
+            resume = True
+    return tokens
+
+
+def generate_game(rng, vocab, number):
+    """Text of one synthetic game
+
+    Main lines follow a deterministic move tree (the candidates at each
+    ply depend only on the moves so far), so openings repeat across games
+    the way real ones do while later moves spread out.
+    """
+    result = rng.choice(RESULTS)
+    white, black = rng.sample(PLAYERS, 2)
+    tags = [
+        ('Event', f'Synthetic {number}'),
+        ('Site', '?'),
+        ('Date', f'{rng.randint(1850, 2024)}.{rng.randint(1, 12):02d}.{rng.randint(1, 28):02d}'),
+        ('Round', str(rng.randint(1, 13))),
+        ('White', white),
+        ('Black', black),
+        ('Result', result),
+        ('WhiteElo', str(rng.randint(2000, 2880))),
+        ('BlackElo', str(rng.randint(2000, 2880))),
+        ('ECO', f'{rng.choice("ABCDE")}{rng.randint(0, 99):02d}'),
+    ]
+
+    tokens = []
+    state = 0
+    resume = False
+    for ply in range(rng.randint(8, 160)):
+        rate = 0.8 if ply < 20 else 0.15
+        index = (state + int(rng.expovariate(rate)) * 7919) % len(vocab)
+        state = (state * 1000003 + index + 1) & 0xFFFFFFFF
+        _number(ply, tokens, resume)
+        move = vocab[index]
+        tokens.append(move + '+' if rng.random() < 0.04 else move)
+        resume = False
+        if rng.random() < 0.03:
+            tokens.append(f'${rng.randint(1, 6)}')
+        if rng.random() < 0.03:
+            tokens.append('{ ' + rng.choice(COMMENTS) + ' }')
+            resume = True
+        if rng.random() < 0.04:
+            tokens += ['('] + _variation(rng, vocab, ply, 1) + [')']
+            resume = True
+    tokens.append(result)
+
+    # Wrap the movetext the way PGN exporters do
+    lines = []
+    line = ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > 79:
+            lines.append(line)
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    lines.append(line)
+
+    header = '\n'.join(f'[{name} "{value}"]' for name, value in tags)
+    return header + '\n\n' + '\n'.join(lines) + '\n'
+
+
+def generate_corpus(path, games, seed=0):
+    """Write a synthetic PGN file of games games; the same seed gives the same file"""
+    rng = random.Random(seed)
+    vocab = _vocabulary()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for number in range(games):
+            f.write(generate_game(rng, vocab, number))
+            f.write('\n')
+    os.replace(tmp_path, path)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).resolve().parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _timed(function, repeat=1):
+    """Run function repeat times; return the last result and the best time"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def write_database(analyzer, path, total_games):
+    """Write the master database the way main() does, minus the player list"""
+    metadata = {'total_games': total_games, 'statistics': analyzer.get_statistics()}
+    return write_database_json(path, metadata, analyzer.iter_opening_repertoire(top_n=5),
+                               analyzer.generate_tactical_book())
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stage_memory(stage, corpus, work_dir):
+    """Run one stage in this (fresh) process; returns (RSS before it, peak RSS after it)
+
+    Stages after parsing start from the counts run_benchmark saved, so
+    their RSS before includes the loaded tables.
+    """
+    analyzer = None
+    if stage in ('generate_opening_repertoire', 'generate_tactical_book', 'write_database'):
+        with open(work_dir / 'counts.pickle', 'rb') as f:
+            analyzer = PGNAnalyzer.from_counts(pickle.load(f))
+
+    def parse_corpus():
+        with Corpus(work_dir / 'corpus.bin') as games_corpus:
+            PGNAnalyzer().parse_corpus(games_corpus, 1.0)
+
+    stages = {
+        'parse_pgn_file': lambda: PGNAnalyzer().parse_pgn_file(corpus, 'Synthetic', 1.0),
+        'compile_corpus': lambda: compile_corpus(corpus, work_dir / 'memory.bin'),
+        'parse_corpus': parse_corpus,
+        'generate_opening_repertoire': lambda: analyzer.generate_opening_repertoire(top_n=5),
+        'generate_tactical_book': lambda: analyzer.generate_tactical_book(),
+        'write_database': lambda: write_database(analyzer, work_dir / 'memory.json', 0),
+    }
+    before = current_rss()
+    with redirect_stdout(io.StringIO()):
+        stages[stage]()
+    return before, peak_rss()
+
+
+def measure_memory(corpus, work_dir, stages):
+    """Peak RSS of each stage, each run once in its own spawned process
+
+    A process's peak RSS only ever grows, so one read at the end of a
+    run says nothing about the stages before the largest one.
+    """
+    context = multiprocessing.get_context('spawn')
+    memory = {}
+    for stage in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            before, peak = executor.submit(_stage_memory, stage, corpus, work_dir).result()
+        memory[stage] = {
+            'peak_rss_bytes': peak,
+            'rss_growth_bytes': peak - before if before is not None else None,
+        }
+    return memory
+
+
+def run_benchmark(corpus, work_dir, repeat=1, jobs=2, reference=None):
+    """Time each stage on corpus and check alternative paths give the same database
+
+    The checks compare the corpus, parallel and incremental builds with the
+    serial build of this same tree. A reference database only matches one
+    written by a commit with the same output: databases from before the
+    streaming writer (one entry per line instead of indent=2) and the heap
+    ranking (ties broken by move and position key) never match.
+    """
+    quiet = io.StringIO()
+
+    def parse():
+        analyzer = PGNAnalyzer()
+        with redirect_stdout(quiet):
+            games = analyzer.parse_pgn_file(corpus, 'Synthetic', 1.0)
+        return analyzer, games
+
+    (analyzer, games), parse_seconds = _timed(parse, repeat)
+    plies = sum(table.total_units for table in analyzer.export_counts()) // WEIGHT_SCALE
+    repertoire, repertoire_seconds = _timed(lambda: analyzer.generate_opening_repertoire(top_n=5), repeat)
+    tactical_book, tactical_seconds = _timed(analyzer.generate_tactical_book, repeat)
+
+    database = work_dir / 'master_database.json'
+    _, write_seconds = _timed(lambda: write_database(analyzer, database, games), repeat)
+    digest = _sha256(database)
+
+    # Counting from the compiled corpus skips reading and tokenizing the text
+    compiled = work_dir / 'corpus.bin'
+    _, compile_seconds = _timed(lambda: compile_corpus(corpus, compiled), repeat)
+
+    def parse_compiled():
+        analyzer = PGNAnalyzer()
+        with Corpus(compiled) as games_corpus:
+            games = analyzer.parse_corpus(games_corpus, 1.0)
+        return analyzer, games
+
+    (from_corpus, corpus_games), corpus_seconds = _timed(parse_compiled, repeat)
+
+    # The serial build is the reference; the other builds must match it byte for byte
+    checks = {}
+    write_database(from_corpus, work_dir / 'corpus.json', corpus_games)
+    checks['corpus'] = _sha256(work_dir / 'corpus.json') == digest
+    parallel = PGNAnalyzer()
+    with redirect_stdout(quiet):
+        parallel_games = parallel.parse_pgn_files_parallel(
+            [(corpus, 'Synthetic', 1.0)], jobs, chunk_size=max(1, os.path.getsize(corpus) // (4 * jobs)))
+    write_database(parallel, work_dir / 'parallel.json', parallel_games)
+    checks['parallel'] = _sha256(work_dir / 'parallel.json') == digest
+
+    with redirect_stdout(quiet):
+        incremental, incremental_games = build_incremental([(corpus, 'Synthetic', 1.0)], work_dir / 'state')
+    write_database(incremental, work_dir / 'incremental.json', incremental_games)
+    checks['incremental'] = _sha256(work_dir / 'incremental.json') == digest
+
+    if reference:
+        checks['reference'] = _sha256(reference) == digest
+
+    stages = {
+        'parse_pgn_file': {
+            'seconds': parse_seconds,
+            'games_per_second': games / parse_seconds,
+            'plies_per_second': plies / parse_seconds,
+        },
+        'compile_corpus': {'seconds': compile_seconds, 'bytes': compiled.stat().st_size},
+        'parse_corpus': {
+            'seconds': corpus_seconds,
+            'games_per_second': games / corpus_seconds,
+            'plies_per_second': plies / corpus_seconds,
+            'speedup': parse_seconds / corpus_seconds,
+        },
+        'generate_opening_repertoire': {'seconds': repertoire_seconds, 'positions': len(repertoire)},
+        'generate_tactical_book': {
+            'seconds': tactical_seconds,
+            'patterns': sum(len(patterns) for patterns in tactical_book.values()),
+        },
+        'write_database': {'seconds': write_seconds, 'bytes': database.stat().st_size},
+    }
+    # Memory is measured apart from the timings, one process per stage
+    with open(work_dir / 'counts.pickle', 'wb') as f:
+        pickle.dump(analyzer.export_counts(), f, pickle.HIGHEST_PROTOCOL)
+    for stage, memory in measure_memory(corpus, work_dir, stages).items():
+        stages[stage].update(memory)
+
+    return {
+        'games': games,
+        'plies': plies,
+        'stages': stages,
+        'database_sha256': digest,
+        'checks': checks,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def run_replay_benchmark(pgn, repeat=1):
+    """Time board replay against move-window keys on a PGN file of legal games
+
+    The synthetic corpus is not legal chess, so replay is measured on a
+    real file: the board alone (resolve and apply every move) and full
+    parses in both modes, with the table sizes each one ends up with.
+    """
+    quiet = io.StringIO()
+    lines = []
+    for game_text in iter_pgn_games(pgn):
+        start = game_text.find('\n\n')
+        moves = tokenize_movetext(game_text[start + 2:]) if start >= 0 else None
+        if moves:
+            lines.append(moves)
+
+    def replay():
+        plies = 0
+        for moves in lines:
+            board = Board()
+            for move in moves:
+                try:
+                    board.play(move)
+                except ValueError:
+                    break
+                plies += 1
+        return plies
+
+    plies, replay_seconds = _timed(replay, repeat)
+    results = {'board_only': {'seconds': replay_seconds, 'plies': plies, 'plies_per_second': plies / replay_seconds}}
+
+    for mode in ('window', 'board'):
+        def parse():
+            analyzer = PGNAnalyzer()
+            if mode == 'board':
+                analyzer.enable_board()
+            with redirect_stdout(quiet):
+                games = analyzer.parse_pgn_file(pgn, 'Replay', 1.0)
+            return analyzer, games
+
+        (analyzer, games), seconds = _timed(parse, repeat)
+        tables = analyzer.export_counts()
+        counted = sum(table.total_units for table in tables) // WEIGHT_SCALE
+        results[mode] = {
+            'seconds': seconds,
+            'games': games,
+            'plies': counted,
+            'plies_per_second': counted / seconds,
+            'positions': sum(len(table) for table in tables),
+            'entries': sum(table.entries for table in tables),
+            'replay_errors': analyzer.replay_errors,
+        }
+    results['position_reduction'] = 1 - results['board']['positions'] / results['window']['positions']
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=10000,
+                        help='games in the synthetic corpus (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='corpus random seed (default: %(default)s)')
+    parser.add_argument('--corpus-dir', default=str(Path(tempfile.gettempdir()) / 'pgn_benchmark'),
+                        help='where generated corpora are cached (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='run each timed stage this many times and keep the best (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='worker processes for the parallel build check (default: %(default)s)')
+    parser.add_argument('--reference', metavar='DATABASE',
+                        help='master database JSON from another commit that must match byte for byte; '
+                             'databases from before the streaming writer and heap ranking never do')
+    parser.add_argument('--save-database', metavar='PATH',
+                        help='keep the generated database, e.g. as a --reference for later commits')
+    parser.add_argument('--replay', metavar='PGN',
+                        help='also benchmark board replay on this PGN file of legal games')
+    parser.add_argument('--output', metavar='PATH', help='write the results JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    corpus_dir = Path(args.corpus_dir)
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    corpus = corpus_dir / f'synthetic-v{CORPUS_VERSION}-{args.games}-{args.seed}.pgn'
+    generate_seconds = None
+    if not corpus.exists():
+        print(f"Generating {args.games} games into {corpus}...", file=sys.stderr)
+        _, generate_seconds = _timed(lambda: generate_corpus(corpus, args.games, args.seed))
+
+    print(f"Benchmarking {corpus.name}...", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmark(str(corpus), Path(work_dir), args.repeat, args.jobs, args.reference)
+        if args.save_database:
+            os.replace(Path(work_dir) / 'master_database.json', args.save_database)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': {
+            'games': args.games,
+            'seed': args.seed,
+            'version': CORPUS_VERSION,
+            'bytes': corpus.stat().st_size,
+            'generate_seconds': generate_seconds,
+        },
+        **results,
+    }
+    if args.replay:
+        print(f"Benchmarking board replay on {args.replay}...", file=sys.stderr)
+        report['replay'] = run_replay_benchmark(args.replay, args.repeat)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    else:
+        print(text)
+
+    if not all(report['checks'].values()):
+        failed = ', '.join(name for name, ok in report['checks'].items() if not ok)
+        print(f"Database mismatch: {failed}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Board tests - SAN replay, FEN set-up and replay errors in board mode
+Run with: python -m unittest
+"""
+
+import io
+import unittest
+from contextlib import redirect_stdout
+
+from pgn_analyzer import Board, PGNAnalyzer
+
+NAJDORF = 'e4 c5 Nf3 d6 d4 cxd4 Nxd4 Nf6 Nc3 a6'.split()
+
+
+def replay(moves, fen=None):
+    board = Board(fen)
+    for move in moves:
+        board.play(move)
+    return board
+
+
+def pgn_game(moves, result='1-0', **tags):
+    """Text of one game as iter_pgn_games yields it"""
+    header = '\n'.join(f'[{name} "{value}"]' for name, value in {'Event': 'Test', **tags}.items())
+    return f"{header}\n\n{' '.join(moves)} {result}\n"
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_start_position(self):
+        self.assertEqual(Board().fen(), 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -')
+
+    def test_opening(self):
+        self.assertEqual(replay(NAJDORF).fen(), 'rnbqkb1r/1p2pppp/p2p1n2/8/3NP3/2N5/PPP2PPP/R1BQKB1R w KQkq -')
+
+    def test_castling_moves_the_rook_and_clears_rights(self):
+        board = replay('e4 e5 Nf3 Nc6 Bc4 Bc5 O-O Nf6'.split())
+        self.assertEqual(board.fen(), 'r1bqk2r/pppp1ppp/2n2n2/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQ1RK1 w kq -')
+
+    def test_queenside_castling(self):
+        board = replay('d4 d5 Nc3 Nc6 Bf4 Bf5 Qd2 Qd7 O-O-O O-O-O'.split())
+        self.assertEqual(board.fen(), '2kr1bnr/pppqpppp/2n5/3p1b2/3P1B2/2N5/PPPQPPPP/2KR1BNR w - -')
+
+    def test_en_passant(self):
+        board = replay('e4 a6 e5 d5'.split())
+        # The double step can be taken, so it is part of the position
+        self.assertTrue(board.fen().endswith(' d6'))
+        board.play('exd6')
+        self.assertEqual(board.fen(), 'rnbqkbnr/1pp1pppp/p2P4/8/8/8/PPPP1PPP/RNBQKBNR b KQkq -')
+
+    def test_unusable_double_step_is_not_part_of_the_key(self):
+        self.assertEqual(replay(['e4']).key, Board('rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3').key)
+
+    def test_promotion(self):
+        board = replay(['a8=Q'], '8/P7/8/8/8/8/8/k6K w - -')
+        self.assertEqual(board.fen(), 'Q7/8/8/8/8/8/8/k6K b - -')
+
+    def test_pinned_piece_is_not_the_one_that_moves(self):
+        # Both knights reach c3, but the one on d1 is pinned by the rook
+        board = replay(['Nc3'], '4k3/8/8/8/8/8/4N3/r2NK3 w - -')
+        self.assertEqual(board.fen(), '4k3/8/8/8/8/2N5/8/r2NK3 b - -')
+
+    def test_transpositions_share_a_key(self):
+        self.assertEqual(replay('Nf3 Nf6 c4'.split()).key, replay('c4 Nf6 Nf3'.split()).key)
+        self.assertNotEqual(replay('Nf3 Nf6 c4'.split()).key, replay('c4 Nf6 Nc3'.split()).key)
+
+    def test_key_matches_a_set_up_position(self):
+        moves = 'e4 e5 Nf3 Nc6 Bc4 Bc5'.split()
+        fen = 'r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4'
+        self.assertEqual(replay(moves).key, Board(fen).key)
+        self.assertEqual(replay(moves + ['O-O']).key, replay(['O-O'], fen).key)
+
+
+class IllegalMoveTest(unittest.TestCase):
+
+    def assertIllegal(self, moves, move, fen=None):
+        board = replay(moves, fen)
+        with self.assertRaises(ValueError):
+            board.resolve(move)
+
+    def test_not_san(self):
+        self.assertIllegal([], 'Zz9')
+
+    def test_no_piece_can_move_there(self):
+        self.assertIllegal([], 'Nd4')
+
+    def test_blocked_pawn(self):
+        self.assertIllegal(['e4', 'e5'], 'e5')
+
+    def test_pawn_capture_of_nothing(self):
+        self.assertIllegal([], 'exd3')
+
+    def test_capture_of_own_piece(self):
+        self.assertIllegal([], 'Nxd2')
+
+    def test_castling_through_pieces(self):
+        self.assertIllegal(['e4', 'e5'], 'O-O')
+
+    def test_castling_through_check(self):
+        # The queen attacks f1 or d1, not the king
+        self.assertIllegal([], 'O-O', 'r3k2r/8/8/8/8/5q2/8/R3K2R w KQkq -')
+        self.assertIllegal([], 'O-O-O', 'r3k2r/8/8/8/8/3q4/8/R3K2R w KQkq -')
+        self.assertEqual(replay(['O-O'], 'r3k2r/8/8/8/8/8/8/R3K2R w KQkq -').fen(), 'r3k2r/8/8/8/8/8/8/R4RK1 b kq -')
+
+    def test_castling_without_rights(self):
+        self.assertIllegal([], 'O-O', 'r3k2r/8/8/8/8/8/8/R3K2R w Qkq -')
+        self.assertIllegal('Kf1 Kd8 Ke1 Ke8'.split(), 'O-O', 'r3k2r/8/8/8/8/8/8/R3K2R w KQkq -')
+
+    def test_bad_fen(self):
+        for fen in ('', 'not a fen', '8/8/8/8/8/8/8/8 w - -', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w HAha -'):
+            with self.assertRaises(ValueError):
+                Board(fen)
+
+
+class BoardModeTest(unittest.TestCase):
+
+    def count(self, games):
+        analyzer = PGNAnalyzer()
+        analyzer.enable_board()
+        with redirect_stdout(io.StringIO()):
+            analyzer.parse_games(iter(games))
+        return analyzer
+
+    def test_illegal_move_ends_the_game(self):
+        moves = NAJDORF + ['Nxd4'] + 'Be2 e5'.split()
+        analyzer = self.count([pgn_game(moves)])
+        self.assertEqual(analyzer.replay_errors, 1)
+        # The plies before the illegal one stay counted
+        self.assertEqual(analyzer.opening_book.total_units, 10 * 1000)
+
+    def test_games_start_from_their_fen(self):
+        fen = 'r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4'
+        tail = 'O-O Nf6 d3 d6 c3 O-O h3 h6 Re1 a6 a4 Ba7'.split()
+        analyzer = self.count([pgn_game(tail, SetUp='1', FEN=fen),
+                               pgn_game('e4 e5 Nf3 Nc6 Bc4 Bc5'.split() + tail)])
+        self.assertEqual(analyzer.setup_games, 1)
+        self.assertEqual(analyzer.replay_errors, 0)
+        # Both games reach the FEN's position, so its move was played twice
+        book = dict(analyzer.opening_book.items())
+        self.assertEqual(book[fen.rsplit(' ', 2)[0]], {'O-O': 2000})
+
+    def test_unreadable_fen_is_a_replay_error(self):
+        fen = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w HAha - 0 1'
+        analyzer = self.count([pgn_game(NAJDORF, SetUp='1', FEN=fen)])
+        self.assertEqual((analyzer.setup_games, analyzer.replay_errors), (1, 1))
+        self.assertEqual(len(analyzer.opening_book), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
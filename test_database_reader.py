@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Database reader tests - position keys, phases and sharded lookups
+Run with: python -m unittest
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from database_reader import DatabaseReader, game_phase, position_key
+from pgn_analyzer import PGNAnalyzer, write_database_json, write_database_ndjson
+
+HISTORY = 'e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7'.split()
+
+
+class PositionKeyTest(unittest.TestCase):
+
+    def test_opening_window(self):
+        self.assertEqual(position_key([], 'opening'), 'start')
+        self.assertEqual(position_key(HISTORY[:3], 'opening'), 'e4 e5 Nf3')
+        self.assertEqual(position_key(HISTORY, 'opening'), ' '.join(HISTORY[2:]))
+
+    def test_short_history_has_the_empty_key(self):
+        self.assertEqual(position_key(HISTORY[:5], 'middlegame'), 'middlegame')
+        self.assertEqual(position_key(HISTORY[:6], 'middlegame'), ' '.join(HISTORY[:6]))
+        self.assertEqual(position_key(HISTORY[:3], 'endgame'), 'endgame')
+        self.assertEqual(position_key(HISTORY, 'endgame'), 'Ba4 Nf6 O-O Be7')
+
+    def test_empty_window(self):
+        windows = {'opening': 0, 'middlegame': 0, 'endgame': 2}
+        self.assertEqual(position_key(HISTORY, 'opening', windows), 'start')
+        self.assertEqual(position_key(HISTORY, 'middlegame', windows), 'middlegame')
+        self.assertEqual(position_key(HISTORY, 'endgame', windows), 'O-O Be7')
+
+    def test_game_phase(self):
+        self.assertEqual(game_phase(HISTORY), 'opening')
+        self.assertEqual(game_phase(['e4'] * 30), 'middlegame')
+        self.assertEqual(game_phase(['e4'] * 80), 'endgame')
+        self.assertEqual([game_phase(HISTORY[:n], (4, 6)) for n in (3, 4, 5, 6)],
+                         ['opening', 'middlegame', 'middlegame', 'endgame'])
+
+
+class DatabaseReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write_database(self, name, write):
+        # Short phases and windows, so the reader has to key positions the way they were counted
+        analyzer = PGNAnalyzer(phase_plies=(4, 6), windows=(2, 2, 1))
+        analyzer.count_games([HISTORY, HISTORY[:4] + 'Bc4 Bc5 c3 Nf6'.split(), 'd4 d5 c4 e6 Nc3 Nf6'.split()])
+        metadata = {'phase_plies': list(analyzer.phase_plies), 'windows': list(analyzer.windows)}
+        path = os.path.join(self.tmp.name, name)
+        write(path, metadata, analyzer.iter_opening_repertoire(), analyzer.generate_tactical_book())
+        return path
+
+    def test_lookups_use_the_database_windows(self):
+        for name, write in (('db.json', write_database_json), ('db.ndjson', write_database_ndjson)):
+            path = self.write_database(name, write)
+            reader = DatabaseReader.open(path, os.path.join(self.tmp.name, name + '_shards'))
+            self.assertEqual((reader.phase_plies, reader.windows),
+                             ([4, 6], {'opening': 2, 'middlegame': 2, 'endgame': 1}))
+            start = reader.get_moves([])
+            self.assertEqual([move['move'] for move in start], ['e4', 'd4'])
+            self.assertAlmostEqual(start[0]['weight'], 2 / 3)
+            self.assertEqual(reader.position(HISTORY[:4]), ('middlegame', 'Nf3 Nc6'))
+            self.assertEqual(reader.get_moves(HISTORY[:4]), ['Bb5', 'Bc4'])
+            # Only one move was played there, so it is not in the database
+            self.assertIsNone(reader.get_moves(HISTORY[:2]))
+            self.assertEqual(reader.get_moves(HISTORY[:4]), ['Bb5', 'Bc4'])
+            self.assertEqual(reader.stats()['hits'], 1)
+
+    def test_reader_does_not_import_the_analyzer(self):
+        code = "import sys, database_reader; print('pgn_analyzer' in sys.modules)"
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.stdout.strip(), 'False')
+
+
+if __name__ == '__main__':
+    unittest.main()
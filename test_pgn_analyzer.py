@@ -0,0 +1,880 @@
+#!/usr/bin/env python3
+"""
+Analyzer tests - reading, counting, merging and the file formats of pgn_analyzer
+Run with: python -m unittest
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+
+from database_format import load_database
+from pgn_analyzer import (BinaryBook, BloomFilter, Checkpoint, Corpus, CountMinSketch, CountTable,
+                          GameDeduplicator, OPTION_CONFLICTS, PGNAnalyzer, Prefetcher, RunStats, Shard,
+                          SourceCounts, TagIndex, UNIT_WEIGHT, _drop_zero_entries, analyzer_records,
+                          bernoulli_sample, build_incremental, compare_databases, compile_corpus, eco_code,
+                          find_game_boundaries, find_pgn, iter_pgn_game_spans, iter_pgn_games, load_records,
+                          load_tag_index, main, merge_records, np, pgn_size, position_key, read_pgn_games,
+                          reservoir_sample, tokenize_movetext, write_binary_book, write_database_json,
+                          write_database_ndjson, write_shard)
+
+GAMES = [
+    'e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5'.split(),
+    'e4 c5 Nf3 d6 d4 cxd4 Nxd4 Nf6 Nc3 a6 Be3 e5'.split(),
+    'd4 Nf6 c4 e6 Nc3 Bb4 e3 O-O Bd3 d5 Nf3 c5'.split(),
+    'e4 e5 Nf3 Nc6 Bc4 Bc5 c3 Nf6 d3 d6 O-O O-O'.split(),
+]
+
+
+def pgn_game(moves, result='1-0', **tags):
+    """Text of one game as iter_pgn_games yields it"""
+    header = '\n'.join(f'[{name} "{value}"]' for name, value in {'Event': 'Test', **tags}.items())
+    return f"{header}\n\n{' '.join(moves)} {result}"
+
+
+def contents(analyzer):
+    """{position: {move: units}} of each phase table"""
+    return [dict(table.items()) for table in analyzer.export_counts()]
+
+
+def counted(games, weight=1.0, **options):
+    analyzer = PGNAnalyzer(**options)
+    analyzer.count_games(games, weight)
+    return analyzer
+
+
+def random_games(count, plies, seed=1):
+    """Games over a small move set, so positions repeat and tie"""
+    rng = random.Random(seed)
+    moves = 'e4 d4 c4 Nf3 e5 d5 c5 Nf6 g3 b3'.split()
+    return [[rng.choice(moves) for _ in range(plies)] for _ in range(count)]
+
+
+class FileTestCase(unittest.TestCase):
+    """Test case with a temporary directory for its files"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def write_pgn(self, name, games):
+        """Write game texts to a PGN file, one blank line apart; returns its path"""
+        with open(self.path(name), 'w', encoding='utf-8') as f:
+            f.write('\n\n'.join(games) + '\n')
+        return self.path(name)
+
+
+class StreamingReaderTest(FileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.games = [pgn_game(moves, Round=str(n)) for n, moves in enumerate(GAMES * 5)]
+        self.pgn = self.write_pgn('games.pgn', self.games)
+
+    def test_games_come_back_one_at_a_time(self):
+        self.assertEqual(list(iter_pgn_games(self.pgn, buffer_size=64)), self.games)
+
+    def test_chunks_split_between_games(self):
+        chunks = find_game_boundaries(self.pgn, chunk_size=300)
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual((chunks[0][0], chunks[-1][1]), (0, os.path.getsize(self.pgn)))
+        games = [game for start, end in chunks for game in iter_pgn_games(self.pgn, start, end)]
+        self.assertEqual(games, self.games)
+
+    def test_spans_read_the_same_games(self):
+        spans = [(offset, size) for offset, size, _ in iter_pgn_game_spans(self.pgn)]
+        self.assertEqual(list(read_pgn_games(self.pgn, spans[3:7])), self.games[3:7])
+
+    def test_parse_pgn_file_counts_every_game(self):
+        analyzer = PGNAnalyzer()
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(analyzer.parse_pgn_file(self.pgn, 'Test'), len(self.games))
+        self.assertEqual(contents(analyzer), contents(counted(GAMES * 5)))
+
+
+class CountTableTest(unittest.TestCase):
+
+    def test_counts_accumulate(self):
+        opening = contents(counted([['e4', 'e5', 'Nf3'], ['e4', 'c5']], 2.0))[0]
+        self.assertEqual(opening, {'start': {'e4': 4000}, 'e4': {'e5': 2000, 'c5': 2000}, 'e4 e5': {'Nf3': 2000}})
+
+    def test_growth_keeps_every_entry(self):
+        table = CountTable()
+        e4, d4 = table.moves.intern('e4'), table.moves.intern('d4')
+        for _ in range(2):
+            for key in range(1, 3001):
+                table.add(key, e4, key)
+                table.add(key, d4, 1)
+        self.assertGreater(table._mask, 1023)
+        self.assertEqual((len(table), table.entries), (3000, 6000))
+        self.assertEqual(table.total_units, 2 * (sum(range(1, 3001)) + 3000))
+        # Position 41 was first seen as key 42
+        self.assertEqual((table.key(41), dict(table.iter_positions())[41]), (42, [(e4, 84), (d4, 2)]))
+
+
+class PositionKeyTest(unittest.TestCase):
+
+    def test_keys_hash_the_window(self):
+        analyzer = counted(GAMES + random_games(50, 100))
+        for table in analyzer.export_counts():
+            for pos_id, _ in table.iter_positions():
+                self.assertEqual(table.key(pos_id), position_key(table.window(pos_id)))
+
+    def test_labels_are_the_window(self):
+        opening = contents(counted([GAMES[0]]))[0]
+        self.assertEqual(list(opening)[-1], ' '.join(GAMES[0][3:11]))
+
+    def test_phase_windows(self):
+        analyzer = counted([GAMES[0][:7]], phase_plies=(4, 6), windows=(2, 2, 1))
+        opening, middlegame, endgame = contents(analyzer)
+        self.assertEqual(list(opening), ['start', 'e4', 'e4 e5', 'e5 Nf3'])
+        self.assertEqual(middlegame, {'Nf3 Nc6': {'Bb5': 1000}, 'Nc6 Bb5': {'a6': 1000}})
+        self.assertEqual(endgame, {'a6': {'Ba4': 1000}})
+
+    def test_short_history_uses_the_empty_key(self):
+        analyzer = counted([GAMES[0][:3]], phase_plies=(1, 2), windows=(8, 6, 4))
+        self.assertEqual(contents(analyzer)[1:], [{'middlegame': {'e5': 1000}}, {'endgame': {'Nf3': 1000}}])
+
+
+class ParallelTest(FileTestCase):
+
+    def test_pool_gives_the_serial_counts(self):
+        games = random_games(60, 30)
+        files = [(self.write_pgn('a.pgn', [pgn_game(moves) for moves in games[:40]]), 'A', 1.0),
+                 (self.write_pgn('b.pgn', [pgn_game(moves) for moves in games[40:]]), 'B', 0.35)]
+        serial = PGNAnalyzer()
+        parallel = PGNAnalyzer()
+        with redirect_stdout(io.StringIO()):
+            for filename, player, weight in files:
+                serial.parse_pgn_file(filename, player, weight)
+            self.assertEqual(parallel.parse_pgn_files_parallel(files, jobs=2, chunk_size=2000), 60)
+        # Weights are integer units, so the chunks add up exactly
+        self.assertEqual(contents(parallel), contents(serial))
+
+
+class MergeTest(unittest.TestCase):
+
+    def merged(self, parts, factor, batch, board=False):
+        analyzer = PGNAnalyzer()
+        if board:
+            analyzer.enable_board()
+        for part in parts:
+            if batch:
+                analyzer.merge_counts(part.export_counts(), factor)
+            else:
+                for table, partial in zip(analyzer.export_counts(), part.export_counts()):
+                    table._merge_entries(partial, factor)
+        return analyzer
+
+    def check_merge(self, batch):
+        games = random_games(200, 40)
+        parts = [counted(games[:120]), counted(games[120:])]
+        self.assertEqual(contents(self.merged(parts, 3, batch)), contents(counted(games, 3.0)))
+
+    def test_merge_one_entry_at_a_time(self):
+        self.check_merge(batch=False)
+
+    @unittest.skipIf(np is None, "needs numpy")
+    def test_merge_batch(self):
+        self.check_merge(batch=True)
+
+    @unittest.skipIf(np is None, "needs numpy")
+    def test_merge_batch_keeps_adding(self):
+        # Tables filled by add_batch still find their entries with add()
+        analyzer = self.merged([counted(GAMES[:2]), counted(GAMES[2:])], 1, batch=True)
+        analyzer.count_games(GAMES)
+        self.assertEqual(contents(analyzer), contents(counted(GAMES, 2.0)))
+
+    @unittest.skipIf(np is None, "needs numpy")
+    def test_negative_merge_drops_zero_entries(self):
+        games = random_games(200, 40)
+        analyzer = counted(games)
+        analyzer.merge_counts(counted(games[150:]).export_counts(), -1)
+        analyzer = _drop_zero_entries(analyzer)
+        self.assertEqual(contents(analyzer), contents(counted(games[:150])))
+        self.assertNotIn(0, [units for table in analyzer.export_counts() for units in table._units])
+        # The refilled indexes still find every entry
+        analyzer.count_games(games[150:])
+        self.assertEqual(contents(analyzer), contents(counted(games)))
+
+    def test_board_tables_keep_their_fens(self):
+        part = PGNAnalyzer()
+        part.enable_board()
+        part.count_games(GAMES)
+        expected = [{fen: {move: 3 * units for move, units in moves.items()} for fen, moves in phase.items()}
+                    for phase in contents(part)]
+        for batch in ([False, True] if np is not None else [False]):
+            self.assertEqual(contents(self.merged([part, part, part], 1, batch, board=True)), expected)
+            self.assertEqual(contents(self.merged([part], 3, batch, board=True)), expected)
+
+
+class IncrementalTest(FileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.games = random_games(90, 30)
+        self.files = {name: self.write_pgn(name, [pgn_game(moves) for moves in self.games[30 * n:30 * n + 30]])
+                      for n, name in enumerate(('a.pgn', 'b.pgn', 'c.pgn'))}
+
+    def build(self, weights, numpy_batch=0):
+        pgn_files = [(self.files[name], name, weight) for name, weight in weights.items()]
+        with redirect_stdout(io.StringIO()):
+            return build_incremental(pgn_files, self.path('state'), numpy_batch=numpy_batch)
+
+    def expected(self, weights):
+        analyzer = PGNAnalyzer()
+        for name, weight in weights.items():
+            if weight:
+                analyzer.parse_games(iter_pgn_games(self.files[name]), weight)
+        return contents(analyzer)
+
+    def check(self, weights, games, numpy_batch=0):
+        analyzer, total_games = self.build(weights, numpy_batch)
+        self.assertEqual(total_games, games)
+        self.assertEqual(contents(analyzer), self.expected(weights))
+
+    def test_updates_match_a_full_build(self):
+        self.check({'a.pgn': 1.0, 'b.pgn': 2.0}, 60)
+        # A new file, then a reweighted one, then a removed one
+        self.check({'a.pgn': 1.0, 'b.pgn': 2.0, 'c.pgn': 0.5}, 90)
+        self.check({'a.pgn': 1.0, 'b.pgn': 1.5, 'c.pgn': 0.5}, 90)
+        self.check({'a.pgn': 1.0, 'c.pgn': 0.5}, 60)
+
+    def test_changed_file_is_parsed_again(self):
+        self.check({'a.pgn': 1.0, 'b.pgn': 2.0}, 60)
+        self.write_pgn('b.pgn', [pgn_game(moves) for moves in self.games[30:50]])
+        self.check({'a.pgn': 1.0, 'b.pgn': 2.0}, 50)
+
+    def test_files_weighted_0_are_not_counted(self):
+        self.check({'a.pgn': 1.0, 'b.pgn': 0}, 30)
+        self.check({'a.pgn': 1.0, 'b.pgn': 0, 'c.pgn': 1.0}, 60)
+
+    @unittest.skipIf(np is None, "needs numpy")
+    def test_numpy_batches(self):
+        self.check({'a.pgn': 1.0, 'b.pgn': 2.0}, 60, numpy_batch=7)
+        self.check({'b.pgn': 2.0}, 30, numpy_batch=7)
+
+
+class BinaryBookTest(FileTestCase):
+
+    def test_lookups(self):
+        repertoire = {
+            'start': [{'move': 'e4', 'weight': 0.75}, {'move': 'd4', 'weight': 0.25}],
+            'e4 e5': [{'move': 'Nf3', 'weight': 0.5}, {'move': 'Bc4', 'weight': 0.5}],
+        }
+        self.assertEqual(write_binary_book(repertoire, self.path('book.bin'), window=2), 4)
+        with BinaryBook(self.path('book.bin')) as book:
+            self.assertEqual([move['move'] for move in book.top_moves([])], ['e4', 'd4'])
+            self.assertAlmostEqual(book.top_moves([])[0]['weight'], 0.75, places=4)
+            # Only the last two moves key the position
+            self.assertEqual([move['move'] for move in book.top_moves('d4 d5 e4 e5'.split())], ['Bc4', 'Nf3'])
+            self.assertEqual(book.lookup(position_key(['e4', 'e5'])), book.top_moves(['e4', 'e5']))
+            self.assertEqual(book.top_moves(['c4']), [])
+
+    def test_book_of_a_build(self):
+        analyzer = counted(random_games(300, 10))
+        repertoire = analyzer.generate_opening_repertoire()
+        write_binary_book(analyzer.iter_opening_repertoire(), self.path('book.bin'))
+        with BinaryBook(self.path('book.bin')) as book:
+            for position, moves in repertoire.items():
+                history = [] if position == 'start' else position.split(' ')
+                self.assertEqual([move['move'] for move in book.top_moves(history)],
+                                 [move['move'] for move in sorted(moves, key=lambda move: -move['weight'])])
+
+
+class DatabaseFileTest(FileTestCase):
+
+    def test_json_and_ndjson(self):
+        analyzer = counted(GAMES)
+        metadata = {'games': 4, 'phase_plies': list(analyzer.phase_plies), 'windows': list(analyzer.windows)}
+        repertoire = analyzer.generate_opening_repertoire()
+        tactical_book = analyzer.generate_tactical_book()
+        for name, write in (('db.json', write_database_json), ('db.ndjson', write_database_ndjson)):
+            self.assertEqual(write(self.path(name), metadata, analyzer.iter_opening_repertoire(), tactical_book),
+                             len(repertoire))
+            loaded_repertoire, loaded_tactical_book, loaded_metadata = load_database(self.path(name))
+            self.assertEqual(loaded_repertoire, repertoire)
+            # NDJSON has no lines for a phase without patterns
+            self.assertEqual({phase: moves for phase, moves in loaded_tactical_book.items() if moves},
+                             {phase: moves for phase, moves in tactical_book.items() if moves})
+            self.assertEqual(loaded_metadata, metadata)
+
+
+class RankingTest(unittest.TestCase):
+
+    def test_heap_ranking(self):
+        table = counted(random_games(300, 6)).opening_book
+        ranked = list(table._rank_heap(3, None))
+        positions = dict(table.iter_positions())
+        self.assertEqual(len(ranked), sum(len(moves) >= 2 for moves in positions.values()))
+        totals = [sum(units for _, units in positions[pos_id]) for pos_id, _ in ranked]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+        for pos_id, top_moves in ranked:
+            best = sorted(positions[pos_id], key=lambda move: (-move[1], table.moves.names[move[0]]))
+            self.assertEqual(top_moves, best[:3])
+        self.assertEqual(list(table._rank_heap(3, 5)), ranked[:5])
+
+
+class SketchTest(unittest.TestCase):
+
+    def test_estimates_never_undercount(self):
+        sketch = CountMinSketch(64, depth=3)
+        rng = random.Random(1)
+        truth = {}
+        for _ in range(2000):
+            key = rng.getrandbits(8)
+            sketch.add(key, 1)
+            truth[key] = truth.get(key, 0) + 1
+        for key, count in truth.items():
+            self.assertGreaterEqual(sketch.estimate(key), count)
+        self.assertEqual(sketch.total, 2000)
+
+    def approximate(self, games, budget, min_weight):
+        analyzer = PGNAnalyzer()
+        analyzer.enable_sketch(budget, min_weight)
+        analyzer.count_games(games)
+        return analyzer
+
+    def test_heavy_moves_are_kept(self):
+        games = random_games(300, 12)
+        exact = contents(counted(games))
+        for budget in (1 << 20, 1 << 10):
+            approximate = contents(self.approximate(games, budget, 3.0))
+            for table, kept in zip(exact, approximate):
+                for position, moves in table.items():
+                    for move, units in moves.items():
+                        if units >= 3000:
+                            self.assertGreaterEqual(kept[position][move], units)
+                        elif move in kept.get(position, {}):
+                            self.assertGreaterEqual(kept[position][move], 3000)
+        # A sketch this wide has no collisions: light moves go, the rest are exact
+        approximate = contents(self.approximate(games, 1 << 20, 3.0))
+        self.assertEqual(approximate, [{position: heavy for position, moves in table.items()
+                                        if (heavy := {move: units for move, units in moves.items() if units >= 3000})}
+                                       for table in exact])
+
+
+class RunStatsTest(FileTestCase):
+
+    def test_parse_reports_games_and_stages(self):
+        pgn = self.write_pgn('games.pgn', [pgn_game(moves) for moves in GAMES * 5] + [pgn_game(['e4', 'e5'])])
+        analyzer = PGNAnalyzer()
+        analyzer.run_stats = RunStats(os.path.getsize(pgn), interval=1e-9, fine=True)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            self.assertEqual(analyzer.parse_pgn_file(pgn, 'Test'), 20)
+        # Every game read is ticked, including the one too short to count
+        report = analyzer.run_stats.report()
+        self.assertEqual(report['games_read'], 21)
+        self.assertGreater(report['bytes_read'], 0)
+        self.assertTrue({'read', 'tokenize', 'count'} <= set(report['stages']))
+        self.assertTrue(all(seconds >= 0 for seconds in report['stages'].values()))
+        self.assertIn('games/s, ETA', output.getvalue())
+
+    def test_stage_timers_add_up(self):
+        run_stats = RunStats(interval=0)
+        for _ in range(3):
+            with run_stats.stage('merge'):
+                pass
+        run_stats.add_timers({'merge': 1.0, 'load': 2.0})
+        self.assertGreaterEqual(run_stats.timers['merge'], 1.0)
+        self.assertEqual(run_stats.timers['load'], 2.0)
+        run_stats.tick(5, 100)
+        self.assertEqual((run_stats.games, run_stats.bytes), (5, 100))
+
+
+class TokenizerTest(unittest.TestCase):
+
+    def test_main_line(self):
+        self.assertEqual(tokenize_movetext('1. e4 e5 2. Nf3 Nc6 3. Bb5 1-0'), ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5'])
+
+    def test_black_move_numbers(self):
+        self.assertEqual(tokenize_movetext('1. e4 {best by test} 1... e5 2. Nf3 *'), ['e4', 'e5', 'Nf3'])
+
+    def test_result_in_a_comment(self):
+        self.assertEqual(tokenize_movetext('1. e4 {1-0 was agreed later} e5 0-1'), ['e4', 'e5'])
+        self.assertEqual(tokenize_movetext('1. e4 ; 0-1 to the end of the line\ne5 1/2-1/2'), ['e4', 'e5'])
+
+    def test_nested_variations(self):
+        movetext = '1. e4 (1. d4 d5 (1... Nf6 2. c4) 2. c4) e5 (1... c5 2. Nf3 (2. c3) d6) 2. Nf3 1/2-1/2'
+        self.assertEqual(tokenize_movetext(movetext), ['e4', 'e5', 'Nf3'])
+
+    def test_nags_and_glyphs(self):
+        self.assertEqual(tokenize_movetext('1. e4! $1 e5?! 2. Nf3!! $14 Nc6?? 3. Bb5+ 1-0'),
+                         ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5+'])
+
+    def test_no_result(self):
+        self.assertIsNone(tokenize_movetext('1. e4 e5 2. Nf3'))
+        # A result inside a variation does not end the main line
+        self.assertIsNone(tokenize_movetext('1. e4 (1. d4 1-0) e5'))
+        # Nor does one after a variation that is never closed
+        self.assertIsNone(tokenize_movetext('1. e4 (1. d4 d5 e5 1-0'))
+
+    def test_stray_closing_parenthesis(self):
+        self.assertEqual(tokenize_movetext('1. e4 ) e5 2. Nf3) 0-1'), ['e4', 'e5', 'Nf3'])
+
+    def test_numbers_are_not_results(self):
+        self.assertEqual(tokenize_movetext('10-0 1. e4 $0-1 e5 1-0'), ['e4', 'e5'])
+
+    def test_castling_with_zeros(self):
+        self.assertEqual(tokenize_movetext('9. 0-0 0-0-0+ 10. O-O 0-0# 1-0'), ['O-O', 'O-O-O+', 'O-O', 'O-O#'])
+        self.assertEqual(tokenize_movetext('1. e4 (1. 0-0) e5 0-1'), ['e4', 'e5'])
+
+
+class CompressedInputTest(FileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.games = [pgn_game(moves, Round=str(n)) for n, moves in enumerate(GAMES * 5)]
+        self.pgn = self.write_pgn('games.pgn', self.games)
+        with open(self.pgn, 'rb') as f:
+            self.data = f.read()
+
+    def compress(self, suffix, module):
+        with module.open(self.pgn + suffix, 'wb') as f:
+            f.write(self.data)
+        return self.pgn + suffix
+
+    def test_archives_read_like_the_plain_file(self):
+        for suffix, module in (('.gz', gzip), ('.bz2', bz2), ('.xz', lzma)):
+            archive = self.compress(suffix, module)
+            self.assertEqual(list(iter_pgn_games(archive, buffer_size=64)), self.games)
+            self.assertEqual(find_game_boundaries(archive), [(0, None)])
+            spans = [(offset, size) for offset, size, _ in iter_pgn_game_spans(archive)]
+            self.assertEqual(list(read_pgn_games(archive, spans[3:7])), self.games[3:7])
+        self.assertEqual(pgn_size(self.pgn + '.gz'), len(self.data))
+        self.assertIsNone(pgn_size(self.pgn + '.xz'))
+
+    def test_compressed_copy_is_found(self):
+        archive = self.compress('.gz', gzip)
+        os.remove(self.pgn)
+        self.assertEqual(find_pgn(self.pgn), archive)
+        analyzer = PGNAnalyzer()
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(analyzer.parse_pgn_files_parallel([(archive, 'Test', 1.0)], jobs=2), len(self.games))
+        self.assertEqual(contents(analyzer), contents(counted(GAMES * 5)))
+
+
+class CorpusTest(FileTestCase):
+
+    def test_compiled_games_keep_their_fen(self):
+        fen = 'r1bqk1nr/pppp1ppp/2n5/2b1p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4'
+        tail = 'O-O Nf6 d3 d6 c3 O-O h3 h6 Re1 a6 a4 Ba7'.split()
+        with open(self.path('games.pgn'), 'w') as f:
+            f.write(f'[Event "A"]\n\n{" ".join(GAMES[0])} 1-0\n\n'
+                    '[Event "Too short"]\n\n1. e4 e5 1/2-1/2\n\n'
+                    f'[Event "B"]\n[SetUp "1"]\n[FEN "{fen}"]\n\n{" ".join(tail)} 0-1\n')
+        self.assertEqual(compile_corpus(self.path('games.pgn'), self.path('games.corpus')), 2)
+        with Corpus(self.path('games.corpus')) as corpus:
+            self.assertEqual(list(corpus), [GAMES[0], tail])
+            self.assertEqual(corpus.setups, {1: fen})
+
+
+class SQLiteTest(FileTestCase):
+
+    def test_books_match_the_memory_build(self):
+        games = random_games(200, 40)
+        analyzer = PGNAnalyzer()
+        store = analyzer.use_sqlite(self.path('counts.sqlite'), batch_size=100)
+        self.addCleanup(store.close)
+        analyzer.count_games(games, 2.0)
+        memory = counted(games, 2.0)
+        self.assertEqual([len(table) for table in analyzer.export_counts()],
+                         [len(table) for table in memory.export_counts()])
+        self.assertEqual(analyzer.generate_opening_repertoire(), memory.generate_opening_repertoire())
+        self.assertEqual(analyzer.generate_tactical_book(), memory.generate_tactical_book())
+        connection = sqlite3.connect(self.path('counts.sqlite'))
+        self.addCleanup(connection.close)
+        (units,) = connection.execute('SELECT SUM(units) FROM counts').fetchone()
+        self.assertEqual(units, sum(table.total_units for table in memory.export_counts()))
+
+    def test_existing_database_is_not_replaced(self):
+        with open(self.path('counts.sqlite'), 'w') as f:
+            f.write('keep me')
+        stderr = io.StringIO()
+        with self.assertRaises(SystemExit), redirect_stderr(stderr):
+            main(['--sqlite', self.path('counts.sqlite')])
+        self.assertIn('--sqlite-overwrite', stderr.getvalue())
+        with open(self.path('counts.sqlite')) as f:
+            self.assertEqual(f.read(), 'keep me')
+
+
+class ShardTest(FileTestCase):
+
+    def test_shards_merge_to_the_full_counts(self):
+        first, second = counted(GAMES[:2]), counted(GAMES[1:])
+        for name, analyzer in (('first.shard', first), ('second.shard', second)):
+            write_shard(self.path(name), analyzer_records(analyzer), 2, analyzer.moves.names)
+        with Shard(self.path('first.shard')) as shard:
+            self.assertEqual(shard.games, 2)
+            self.assertEqual(list(shard), list(analyzer_records(first)))
+        with Shard(self.path('first.shard')) as a, Shard(self.path('second.shard')) as b:
+            analyzer = PGNAnalyzer()
+            load_records(analyzer, merge_records([a, b]))
+        both = counted(GAMES[:2])
+        both.count_games(GAMES[1:])
+        self.assertEqual(contents(analyzer), contents(both))
+
+
+class SavedPhasesTest(FileTestCase):
+    """Saved counts keep the phases and windows they were counted with"""
+
+    PHASES = {'phase_plies': (4, 6), 'windows': (2, 2, 1)}
+
+    def run_main(self, *argv):
+        stderr = io.StringIO()
+        with redirect_stdout(io.StringIO()), redirect_stderr(stderr):
+            try:
+                main(list(argv))
+            except SystemExit:
+                return stderr.getvalue()
+
+    def assertShard(self, name, analyzer):
+        with Shard(self.path(name)) as shard:
+            self.assertEqual((shard.phase_plies, shard.windows), ((4, 6), (2, 2, 1)))
+            self.assertEqual(list(shard), list(analyzer_records(analyzer)))
+
+    @unittest.skipIf(np is None, "needs numpy")
+    def test_npz(self):
+        analyzer = counted(GAMES, **self.PHASES)
+        analyzer.save_npz(self.path('counts.npz'), games=4)
+        self.assertEqual(PGNAnalyzer.npz_phases(self.path('counts.npz')), ((4, 6), (2, 2, 1)))
+        self.assertIsNone(self.run_main('--from-npz', self.path('counts.npz'), '--shard', self.path('out.shard')))
+        self.assertShard('out.shard', analyzer)
+        # The same phases may be given, other ones may not
+        self.assertIsNone(self.run_main('--from-npz', self.path('counts.npz'), '--phases', '2', '3',
+                                        '--windows', '2', '2', '1', '--shard', self.path('out.shard')))
+        self.assertIn('counted with phases at plies 4 and 6',
+                      self.run_main('--from-npz', self.path('counts.npz'), '--phases', '10', '30',
+                                    '--shard', self.path('out.shard')))
+
+    @unittest.skipIf(np is None, "needs numpy")
+    def test_sources(self):
+        sources = SourceCounts(PGNAnalyzer(**self.PHASES))
+        for name, games in (('a.pgn', GAMES[:2]), ('b.pgn', GAMES[2:])):
+            sources.analyzer.count_games(games, UNIT_WEIGHT)
+            sources.add(self.path(name), name, 2.0, len(games))
+        sources.save(self.path('sources.npz'))
+        self.assertIsNone(self.run_main('--shard', self.path('out.shard'), 'reweight', self.path('sources.npz'),
+                                        '--weight', 'b.pgn=0'))
+        self.assertShard('out.shard', counted(GAMES[:2], 2.0, **self.PHASES))
+
+    def test_merge(self):
+        analyzer = counted(GAMES, **self.PHASES)
+        write_shard(self.path('a.shard'), analyzer_records(analyzer), 4, analyzer.moves.names,
+                    analyzer.phase_plies, analyzer.windows)
+        self.assertIsNone(self.run_main('--shard', self.path('out.shard'), 'merge', self.path('a.shard')))
+        self.assertShard('out.shard', analyzer)
+        default = counted(GAMES)
+        write_shard(self.path('b.shard'), analyzer_records(default), 4, default.moves.names)
+        self.assertIn('different phases', self.run_main('--shard', self.path('out.shard'), 'merge',
+                                                        self.path('a.shard'), self.path('b.shard')))
+
+
+class TagIndexTest(FileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tags = [
+            {'White': 'Carlsen, Magnus', 'Black': 'Anand, V', 'Date': '2014.11.09', 'WhiteElo': '2863',
+             'BlackElo': '2792', 'ECO': 'D37'},
+            {'White': 'Fischer, Robert', 'Black': 'Spassky, Boris', 'Date': '1972.07.11', 'WhiteElo': '2785',
+             'BlackElo': '2660', 'ECO': 'E56'},
+            {'White': 'Anand, V', 'Black': 'Carlsen, Magnus', 'Date': '2013.11.22', 'ECO': 'A07'},
+            {'White': 'Morphy, Paul', 'Black': 'Anderssen, Adolf', 'Date': '1858.??.??'},
+        ]
+        self.games = [pgn_game(moves, **game_tags) for moves, game_tags in zip(GAMES, tags)]
+        self.pgn = self.write_pgn('games.pgn', self.games)
+
+    def selected(self, index, **filters):
+        return list(read_pgn_games(self.pgn, index.select(**filters)))
+
+    def test_filters(self):
+        index = TagIndex.build(self.pgn)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(self.selected(index), self.games)
+        self.assertEqual(self.selected(index, player='carlsen'), [self.games[0], self.games[2]])
+        self.assertEqual(self.selected(index, years=(1800, 1999)), [self.games[1], self.games[3]])
+        # Both players must reach min_elo, and a missing rating never does
+        self.assertEqual(self.selected(index, min_elo=2700), [self.games[0]])
+        self.assertEqual(self.selected(index, eco=(eco_code('D00'), eco_code('E99'))), self.games[:2])
+        self.assertEqual(self.selected(index, player='carlsen', years=(2014, 2014)), [self.games[0]])
+
+    def test_cached_index_is_reused_until_the_file_changes(self):
+        index = load_tag_index(self.pgn, self.path('cache'))
+        self.assertEqual(load_tag_index(self.pgn, self.path('cache')).columns, index.columns)
+        self.write_pgn('games.pgn', self.games[:2])
+        self.assertEqual(len(load_tag_index(self.pgn, self.path('cache'))), 2)
+
+
+@unittest.skipIf(np is None, "needs numpy")
+class NumpyTest(FileTestCase):
+
+    def test_batches_count_like_plies(self):
+        games = GAMES + random_games(300, 70)
+        analyzer = PGNAnalyzer()
+        analyzer.enable_numpy(batch_games=64)
+        analyzer.count_games(games, 1.5)
+        self.assertEqual(contents(analyzer), contents(counted(games, 1.5)))
+
+    def test_numpy_ranking_matches_heaps(self):
+        table = counted(random_games(300, 6)).opening_book
+        for top_n, limit in ((3, None), (2, 10), (5, 1), (1, 10000)):
+            self.assertEqual(list(table._rank_numpy(top_n, limit)), list(table._rank_heap(top_n, limit)))
+
+    def test_npz(self):
+        analyzer = counted(random_games(100, 50))
+        analyzer.save_npz(self.path('counts.npz'), games=100)
+        loaded, games = PGNAnalyzer.load_npz(self.path('counts.npz'))
+        self.assertEqual(games, 100)
+        self.assertEqual(contents(loaded), contents(analyzer))
+        # The indexes come back with the arrays
+        loaded.count_games(GAMES)
+        analyzer.count_games(GAMES)
+        self.assertEqual(contents(loaded), contents(analyzer))
+
+
+@unittest.skipIf(np is None, "needs numpy")
+class SourceCountsTest(FileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Two files parsed at unit weight into one analyzer, as --sources does
+        self.files = [random_games(80, 30, seed=2), random_games(60, 30, seed=3)]
+        analyzer = PGNAnalyzer()
+        self.sources = SourceCounts(analyzer)
+        for (name, player, weight), games in zip((('a.pgn', 'Alpha', 2.0), ('b.pgn', 'Beta', 3.0)), self.files):
+            analyzer.count_games(games, UNIT_WEIGHT)
+            self.sources.add(self.path(name), player, weight, len(games))
+
+    def weighted(self, *weights):
+        analyzer = PGNAnalyzer()
+        for games, weight in zip(self.files, weights):
+            analyzer.count_games(games, weight)
+        return analyzer
+
+    def test_reweighting_counts_like_parsing(self):
+        self.sources.save(self.path('sources.npz'))
+        sources = SourceCounts.load(self.path('sources.npz'))
+        analyzer, games = sources.reweighted()
+        self.assertEqual((contents(analyzer), games), (contents(self.weighted(2.0, 3.0)), 140))
+        # Overrides by file name, path or player; a path wins over a player
+        for overrides in ({'a.pgn': 0.5}, {'Alpha': 0.5}, {self.path('a.pgn'): 0.5, 'Alpha': 4.0}):
+            analyzer, _ = sources.reweighted(overrides)
+            self.assertEqual(contents(analyzer), contents(self.weighted(0.5, 3.0)))
+
+    def test_zero_weight_leaves_a_file_out(self):
+        analyzer, games = self.sources.reweighted({'Beta': 0})
+        self.assertEqual((contents(analyzer), games), (contents(self.weighted(2.0)), 80))
+        with self.assertRaises(ValueError):
+            self.sources.weights({'Gamma': 1.0})
+
+
+class DedupeTest(FileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        games = random_games(40, 20)
+        self.unique = games
+        first = [pgn_game(moves, White=f'Player {n}') for n, moves in enumerate(games[:30])]
+        # The same games again, annotated and numbered, then new ones
+        annotated = [pgn_game([f'{i // 2 + 1}. {move} {{ok}}' if i % 2 == 0 else move
+                               for i, move in enumerate(moves)], White=f'Player {n}')
+                     for n, moves in enumerate(games[20:30], 20)]
+        second = annotated + [pgn_game(moves, White=f'Player {n}') for n, moves in enumerate(games[30:], 30)]
+        self.files = [self.write_pgn('first.pgn', first), self.write_pgn('second.pgn', second)]
+
+    def check(self, mode):
+        analyzer = PGNAnalyzer()
+        analyzer.enable_dedupe(mode)
+        with redirect_stdout(io.StringIO()):
+            for filename in self.files:
+                analyzer.parse_pgn_file(filename, 'Test')
+        self.assertEqual(contents(analyzer), contents(counted(self.unique)))
+        stats = analyzer.dedupe.statistics()
+        self.assertEqual(stats['dropped_by_file'], {self.files[0]: 0, self.files[1]: 10})
+        return stats
+
+    def test_exact(self):
+        self.check('exact')
+
+    def test_bloom(self):
+        stats = self.check('bloom')
+        self.assertLess(stats['false_positive_rate'], 1e-6)
+
+    def test_tags_are_part_of_the_game(self):
+        dedupe = GameDeduplicator()
+        dedupe.begin('test')
+        self.assertFalse(dedupe.is_duplicate('[White "A"]', GAMES[0]))
+        self.assertTrue(dedupe.is_duplicate('[White "A"]\n[Annotator "B"]', GAMES[0]))
+        self.assertFalse(dedupe.is_duplicate('[White "C"]', GAMES[0]))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        fingerprints = [random.Random(n).randbytes(16) for n in range(1000)]
+        # A few new fingerprints may be taken for old ones, never the reverse
+        false_positives = sum(bloom.add(fingerprint) for fingerprint in fingerprints)
+        self.assertLess(false_positives, 20)
+        self.assertTrue(all(bloom.add(fingerprint) for fingerprint in fingerprints))
+        self.assertEqual(bloom.count, 1000 - false_positives)
+        self.assertAlmostEqual(bloom.false_positive_rate, 0.01, delta=0.005)
+
+
+class PrefetcherTest(FileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.games = {name: [pgn_game(moves, Round=str(n)) for n, moves in enumerate(random_games(25, 12, seed))]
+                      for seed, name in enumerate(('a.pgn', 'b.pgn', 'c.pgn'))}
+        self.files = [self.write_pgn(name, games) for name, games in self.games.items()]
+
+    def test_files_come_back_in_order(self):
+        # Small queues keep the readers waiting on the parser
+        with Prefetcher(self.files, readers=2, depth=1, batch_games=3) as prefetcher:
+            for filename, games in zip(self.files, self.games.values()):
+                self.assertEqual(list(prefetcher.games(filename)), games)
+            stats = prefetcher.statistics()
+        self.assertEqual(stats['batches'], 3 * 9)
+        self.assertLessEqual(stats['max_queue_depth'], 1)
+
+    def test_start_offsets(self):
+        spans = list(iter_pgn_game_spans(self.files[1]))
+        with Prefetcher(self.files[1:2], starts={self.files[1]: spans[10][0]}) as prefetcher:
+            self.assertEqual(list(prefetcher.spans(self.files[1])), spans[10:])
+
+    def test_reader_errors_reach_the_parser(self):
+        missing = self.path('missing.pgn')
+        with Prefetcher([self.files[0], missing]) as prefetcher:
+            self.assertEqual(list(prefetcher.games(self.files[0])), self.games['a.pgn'])
+            with self.assertRaises(FileNotFoundError):
+                list(prefetcher.games(missing))
+
+    def test_close_before_the_end(self):
+        prefetcher = Prefetcher(self.files, readers=3, depth=1, batch_games=1)
+        self.assertEqual(next(prefetcher.games(self.files[0])), self.games['a.pgn'][0])
+        prefetcher.close()
+
+
+class CheckpointTest(FileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        games = random_games(60, 20)
+        self.pgn_files = [(self.write_pgn('a.pgn', [pgn_game(moves) for moves in games[:35]]), 'A', 1.0),
+                          (self.write_pgn('b.pgn', [pgn_game(moves) for moves in games[35:]]), 'B', 2.0)]
+        self.expected = counted(games[:35])
+        self.expected.count_games(games[35:], 2.0)
+
+    def build(self, resume=False, stop_after=None, options=None):
+        """Count the files with a snapshot before every game, stopping after stop_after games"""
+        checkpoint = Checkpoint(self.path('build.checkpoint'), self.pgn_files, options or {'dedupe': None}, 0)
+        analyzer = PGNAnalyzer()
+        first_file, start = checkpoint.restore(analyzer) if resume else (0, 0)
+        read = 0
+        with redirect_stdout(io.StringIO()):
+            for index, (filename, player, weight) in enumerate(self.pgn_files[first_file:], first_file):
+                for game in checkpoint.games(analyzer, index,
+                                             iter_pgn_game_spans(filename, start if index == first_file else 0)):
+                    if read == stop_after:
+                        return analyzer
+                    read += 1
+                    analyzer.count_games([tokenize_movetext(game.split('\n\n', 1)[1])], weight)
+                    analyzer.games_counted += 1
+        return analyzer
+
+    def test_resume_gives_the_uninterrupted_counts(self):
+        for stop_after in (10, 35, 50):
+            self.build(stop_after=stop_after)
+            analyzer = self.build(resume=True)
+            self.assertEqual(analyzer.games_counted, 60)
+            self.assertEqual(contents(analyzer), contents(self.expected))
+
+    def test_other_options_are_not_resumed(self):
+        self.build(stop_after=10)
+        with self.assertRaises(ValueError):
+            self.build(resume=True, options={'dedupe': 'exact'})
+
+
+class OptionsTest(FileTestCase):
+
+    def arguments(self, name):
+        """Command-line arguments that put an OPTION_CONFLICTS name in use"""
+        values = {'jobs': ['--jobs', '2'], 'preview': ['--preview', '10'], 'filters': ['--player', 'Morphy'],
+                  'phases': ['--phases', '10', '30'], 'dedupe': ['--dedupe', 'exact'],
+                  'merge': ['merge', self.path('a.shard')], 'reweight': ['reweight', self.path('a.sources')],
+                  'compile': ['compile']}
+        if name in values:
+            return values[name]
+        flag = '--' + name.replace('_', '-')
+        if name in ('incremental', 'approximate', 'board', 'numpy', 'corpus'):
+            return [flag]
+        return [flag, self.path(name)]
+
+    def error(self, argv):
+        stderr = io.StringIO()
+        with self.assertRaises(SystemExit), redirect_stderr(stderr):
+            main(argv)
+        return stderr.getvalue().strip().splitlines()[-1]
+
+    def test_every_conflict_is_refused(self):
+        for name, conflicts in OPTION_CONFLICTS:
+            for other in conflicts:
+                # Commands go after the options
+                first, second = sorted([name, other], key=lambda option: option in ('merge', 'reweight', 'compile'))
+                argv = self.arguments(first) + self.arguments(second)
+                with self.subTest(argv=argv):
+                    self.assertIn('cannot be combined with', self.error(argv))
+
+    def test_message_names_the_options_in_use(self):
+        self.assertTrue(self.error(['--board', '--sqlite', self.path('db'), '--jobs', '2'])
+                        .endswith('--board cannot be combined with --sqlite'))
+        self.assertTrue(self.error(['--approximate', '--jobs', '2', '--incremental'])
+                        .endswith('--approximate cannot be combined with --incremental, --jobs'))
+        self.assertTrue(self.error(['--resume']).endswith('--resume needs --checkpoint PATH'))
+
+
+class SamplingTest(unittest.TestCase):
+
+    def test_reservoir_is_uniform(self):
+        rng = random.Random(1)
+        hits = [0] * 20
+        for _ in range(4000):
+            sample, seen = reservoir_sample(iter(range(20)), 5, rng)
+            self.assertEqual((len(set(sample)), seen), (5, 20))
+            for item in sample:
+                hits[item] += 1
+        # 1000 expected per item, with a standard deviation of about 27
+        self.assertTrue(all(880 < count < 1120 for count in hits), hits)
+
+    def test_reservoir_of_a_short_input(self):
+        rng = random.Random(1)
+        self.assertEqual(reservoir_sample(iter(range(3)), 5, rng), ([0, 1, 2], 3))
+        self.assertEqual(reservoir_sample(iter(range(3)), 0, rng), ([], 3))
+
+    def test_bernoulli(self):
+        sample, seen = bernoulli_sample(iter(range(10000)), 0.25, random.Random(1))
+        self.assertEqual(seen, 10000)
+        self.assertEqual(sample, sorted(set(sample)))
+        self.assertLess(abs(len(sample) - 2500), 150)
+
+    def test_same_books_compare_equal(self):
+        analyzer = counted(random_games(300, 40))
+        repertoire, tactical_book = analyzer.generate_opening_repertoire(), analyzer.generate_tactical_book()
+        comparison = compare_databases(repertoire, tactical_book, repertoire, tactical_book)
+        self.assertEqual(comparison['repertoire']['coverage'], 1.0)
+        self.assertEqual(comparison['repertoire']['top_move_agreement'], 1.0)
+        self.assertEqual(comparison['repertoire']['weight_distance'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()